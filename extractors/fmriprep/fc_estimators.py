@@ -0,0 +1,158 @@
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+import joblib
+from sklearn.covariance import OAS, GraphicalLasso, GraphicalLassoCV, LedoitWolf
+from nilearn.connectome import ConnectivityMeasure
+
+# Precision (inverse covariance) estimators of fmriprep2func_conn.py:
+#   cv          GraphicalLassoCV for every BOLD file (cross-validated alpha path, slowest)
+#   pilot       GraphicalLassoCV on a pilot subset only, the median alpha is then used for every BOLD file
+#   warm        short CV on a narrow grid around the pilot alpha (depends only on the BOLD file and the pilot)
+#   ledoit_wolf / oas    inverse of a shrunk covariance (dense, no CV)
+# The optional tangent-space embedding uses a reference (geometric mean) fitted on the pilot subset,
+# so that every BOLD file can be transformed on its own.
+# The pilot (alpha, tangent reference) is saved next to the FC store and reused until --overwrite,
+# so that BOLD files added later are estimated with the same parameters.
+
+PRECISION_MODES = ["cv", "pilot", "warm", "ledoit_wolf", "oas"]
+PILOT_MODES = ["pilot", "warm"]
+PILOT_SIZE = 10 # BOLD files used to select alpha / fit the tangent reference
+WARM_GRID = np.logspace(-0.25, 0.25, 5) # alphas tried around the pilot alpha (warm mode)
+
+def get_pilot_file(store_file):
+    return f"{os.path.splitext(store_file)[0]}_pilot.joblib"
+
+def select_pilot(bold_files, pilot_size=PILOT_SIZE):
+    """ BOLD files evenly spread over the (sorted) list
+    """
+    bold_files = sorted(bold_files)
+    if len(bold_files) <= pilot_size:
+        return bold_files
+    return [bold_files[i] for i in np.linspace(0, len(bold_files) - 1, pilot_size).round().astype(int)]
+
+def get_cv_alpha(time_series):
+    return GraphicalLassoCV().fit(time_series).alpha_
+
+def fit_pilot(pilot_time_series, pilot_ids, precision_mode, tangent=False, alphas=None):
+    """ Parameters shared by all BOLD files: alpha (median of the pilot CV alphas) and tangent reference
+        (alphas of the pilot BOLD files can be given if they were computed in parallel)
+    """
+    pilot = {"precision_mode": precision_mode, "pilot_ids": list(pilot_ids), "alpha": None, "tangent_measure": None}
+    if precision_mode in PILOT_MODES:
+        if alphas is None:
+            alphas = [get_cv_alpha(time_series) for time_series in pilot_time_series]
+        pilot["alpha"] = float(np.median(alphas))
+    if tangent:
+        tangent_measure = ConnectivityMeasure(kind="tangent")
+        tangent_measure.fit(pilot_time_series)
+        pilot["tangent_measure"] = tangent_measure
+    pilot["pilot_key"] = get_pilot_key(pilot)
+    return pilot
+
+def get_pilot_key(pilot):
+    """ Changes with the pilot BOLD files and estimated parameters (part of the FC store input keys)
+    """
+    key = [pilot["precision_mode"], str(pilot["alpha"]), str(pilot["tangent_measure"] is not None)] + pilot["pilot_ids"]
+    return hashlib.sha1("\n".join(key).encode()).hexdigest()
+
+def load_pilot(pilot_file, precision_mode, tangent=False):
+    """ Saved pilot (None if missing or fitted for another mode)
+    """
+    if not os.path.isfile(pilot_file):
+        return None
+    pilot = joblib.load(pilot_file)
+    if pilot["precision_mode"] != precision_mode or (tangent and pilot["tangent_measure"] is None):
+        return None
+    if not tangent:
+        pilot["tangent_measure"] = None
+        pilot["pilot_key"] = get_pilot_key(pilot)
+    return pilot
+
+def save_pilot(pilot_file, pilot):
+    tmp_file = f"{pilot_file}.tmp"
+    joblib.dump(pilot, tmp_file)
+    os.replace(tmp_file, pilot_file)
+
+def estimate_precision(time_series, precision_mode="cv", pilot=None):
+    """ covariance, precision and alpha (None for shrinkage estimators) of a (n_volumes x n_rois) time series
+    """
+    if precision_mode == "cv":
+        estimator = GraphicalLassoCV().fit(time_series)
+        alpha = estimator.alpha_
+    elif precision_mode == "pilot":
+        alpha = pilot["alpha"]
+        estimator = GraphicalLasso(alpha=alpha).fit(time_series)
+    elif precision_mode == "warm":
+        estimator = GraphicalLassoCV(alphas=list(pilot["alpha"] * WARM_GRID)).fit(time_series)
+        alpha = estimator.alpha_
+    elif precision_mode == "ledoit_wolf":
+        estimator = LedoitWolf().fit(time_series)
+        alpha = None
+    elif precision_mode == "oas":
+        estimator = OAS().fit(time_series)
+        alpha = None
+    else:
+        raise ValueError(f"Unknown precision mode: {precision_mode}")
+
+    return estimator.covariance_, estimator.precision_, alpha
+
+def get_tangent(time_series, pilot):
+    """ Tangent-space embedding of a time series at the pilot reference
+    """
+    return pilot["tangent_measure"].transform([time_series])[0]
+
+def get_partial_correlations(precision):
+    d = 1 / np.sqrt(np.diag(precision))
+    return -precision * np.outer(d, d)
+
+def compare_precision_modes(time_series_list, pilot_size=PILOT_SIZE, modes=PRECISION_MODES, tangent=True):
+    """ Speed / accuracy of the precision modes, relative to the per-BOLD GraphicalLassoCV ("cv").
+        accuracy: relative Frobenius error and correlation of the partial correlations (off-diagonal),
+        F1 score of the non-zero edges (sparse modes)
+    """
+    pilot_ids = [str(i) for i in range(len(time_series_list))]
+    pilot_index = select_pilot(pilot_ids, pilot_size)
+    pilot_time_series = [time_series_list[int(i)] for i in pilot_index]
+
+    start = time.perf_counter()
+    pilot = fit_pilot(pilot_time_series, pilot_index, "pilot")
+    pilot_seconds = time.perf_counter() - start
+    if tangent:
+        start = time.perf_counter()
+        pilot["tangent_measure"] = fit_pilot(pilot_time_series, pilot_index, "cv", tangent=True)["tangent_measure"]
+        tangent_pilot_seconds = time.perf_counter() - start
+
+    references = None
+    records = []
+    for mode in modes:
+        start = time.perf_counter()
+        precisions = [estimate_precision(time_series, mode, pilot)[1] for time_series in time_series_list]
+        seconds = time.perf_counter() - start
+        if mode == "cv":
+            references = precisions
+
+        record = {"precision_mode": mode, "seconds_per_bold": seconds / len(time_series_list),
+                  "pilot_seconds": pilot_seconds if mode in PILOT_MODES else 0}
+        if references is not None:
+            errors, correlations, f1_scores = [], [], []
+            for precision, reference in zip(precisions, references):
+                triu = np.triu_indices(len(reference), k=1)
+                partial, partial_ref = get_partial_correlations(precision)[triu], get_partial_correlations(reference)[triu]
+                errors.append(np.linalg.norm(partial - partial_ref) / np.linalg.norm(partial_ref))
+                correlations.append(np.corrcoef(partial, partial_ref)[0, 1])
+                edges, edges_ref = np.abs(precision[triu]) > 1e-8, np.abs(reference[triu]) > 1e-8
+                f1_scores.append(2 * (edges & edges_ref).sum() / max(edges.sum() + edges_ref.sum(), 1))
+            record.update({"rel_error": np.mean(errors), "corr_with_cv": np.mean(correlations), "edge_f1": np.mean(f1_scores)})
+        records.append(record)
+
+    if tangent:
+        start = time.perf_counter()
+        for time_series in time_series_list:
+            get_tangent(time_series, pilot)
+        records.append({"precision_mode": "tangent", "seconds_per_bold": (time.perf_counter() - start) / len(time_series_list),
+                        "pilot_seconds": tangent_pilot_seconds})
+
+    return pd.DataFrame(records)
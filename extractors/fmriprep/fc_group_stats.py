@@ -0,0 +1,175 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import h5py
+from joblib import Parallel, delayed
+
+from fc_store import get_store_file, load_roi_labels, read_index, vec_to_matrix
+
+# Group-level mean / variance of the connectivity measures of an FC store, in a single pass over the rows:
+# rows are read block_size at a time and folded into running (n, mean, M2) statistics per group (Welford),
+# so memory does not grow with the number of subjects. Shards of rows can be aggregated in parallel
+# and merged at the end (Chan et al. pairwise update).
+# Groups come from a demographics csv (e.g. tabular/demographics/demographics.csv, column "group").
+
+BLOCK_SIZE = 256 # store rows read at a time
+ALL_GROUP = "__all__" # reserved key of the statistics of all rows, with or without a group
+
+def get_participant_groups(demographics_csv, group_col="group", participant_col="participant_id", manifest_csv=None):
+    """ bids_id --> group. participant ids are mapped to bids_ids with the mr_proc manifest if given,
+        otherwise they are matched with or without the sub- prefix
+    """
+    demographics_df = pd.read_csv(demographics_csv, sep="\t" if demographics_csv.endswith(".tsv") else ",", dtype=str)
+    demographics_df = demographics_df[~demographics_df[group_col].isna()]
+    demographics_df = demographics_df.drop_duplicates(subset=[participant_col])
+
+    if manifest_csv is not None:
+        manifest_df = pd.read_csv(manifest_csv, dtype=str)
+        manifest_df = manifest_df[~manifest_df["bids_id"].isna()].drop_duplicates(subset=["participant_id"])
+        demographics_df = demographics_df.merge(manifest_df[["participant_id", "bids_id"]],
+                                                left_on=participant_col, right_on="participant_id", how="inner",
+                                                suffixes=("", "_manifest"))
+        bids_ids = demographics_df["bids_id"]
+    else:
+        bids_ids = "sub-" + demographics_df[participant_col].str.replace("^sub-", "", regex=True)
+
+    return dict(zip(bids_ids, demographics_df[group_col]))
+
+def init_stats(n_cols):
+    return {"n": 0, "mean": np.zeros(n_cols), "M2": np.zeros(n_cols)}
+
+def merge_stats(stats_a, stats_b):
+    """ Running statistics of the union of two sets of rows
+    """
+    n = stats_a["n"] + stats_b["n"]
+    if stats_b["n"] == 0:
+        return stats_a
+    if stats_a["n"] == 0:
+        return stats_b
+    delta = stats_b["mean"] - stats_a["mean"]
+    mean = stats_a["mean"] + delta * (stats_b["n"] / n)
+    M2 = stats_a["M2"] + stats_b["M2"] + delta ** 2 * (stats_a["n"] * stats_b["n"] / n)
+    return {"n": n, "mean": mean, "M2": M2}
+
+def update_stats(stats, block):
+    """ Fold a (n_rows x n_cols) block into running statistics
+    """
+    block = np.asarray(block, dtype=np.float64)
+    block_mean = block.mean(axis=0)
+    block_stats = {"n": len(block), "mean": block_mean, "M2": ((block - block_mean) ** 2).sum(axis=0)}
+    return merge_stats(stats, block_stats)
+
+def get_dataset_names(store_file, measure):
+    """ Datasets aggregated for a measure (upper triangle, and diagonal if stored)
+    """
+    with h5py.File(store_file, "r") as f:
+        return [name for name in [f"measures/{measure}", f"diagonals/{measure}"] if name in f]
+
+def aggregate_rows(store_file, dataset_names, row_groups, start, stop, block_size=BLOCK_SIZE):
+    """ Running statistics per group (and of all rows) of the store rows [start, stop)
+    """
+    group_stats = {}
+    with h5py.File(store_file, "r") as f:
+        datasets = [f[name] for name in dataset_names]
+        n_cols = sum([dataset.shape[1] for dataset in datasets])
+        for block_start in range(start, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            block = np.hstack([dataset[block_start:block_stop] for dataset in datasets])
+            block_groups = row_groups[block_start:block_stop]
+            group_stats[ALL_GROUP] = update_stats(group_stats.get(ALL_GROUP, init_stats(n_cols)), block)
+            for group in pd.unique(block_groups):
+                if pd.isna(group):
+                    continue
+                stats = group_stats.get(group, init_stats(n_cols))
+                group_stats[group] = update_stats(stats, block[block_groups == group])
+    return group_stats
+
+def aggregate_groups(store_file, measure, bids_id_groups=None, n_jobs=1, block_size=BLOCK_SIZE):
+    """ n, mean and (sample) variance of a measure in an FC store, for all rows (ALL_GROUP) and per group
+        (rows of subjects without a group are only counted in ALL_GROUP)
+    """
+    index_df = read_index(store_file)
+    if bids_id_groups is None:
+        row_groups = np.full(len(index_df), np.nan, dtype=object)
+    else:
+        if ALL_GROUP in set(bids_id_groups.values()):
+            raise ValueError(f"{ALL_GROUP} is reserved for the statistics of all rows, rename this group")
+        row_groups = index_df["participant_id"].map(bids_id_groups).values.astype(object)
+        n_missing = pd.isna(row_groups).sum()
+        if n_missing > 0:
+            print(f"{n_missing} rows without a group")
+
+    dataset_names = get_dataset_names(store_file, measure)
+    shards = [shard for shard in np.array_split(np.arange(len(index_df)), max(n_jobs, 1)) if len(shard) > 0]
+    shard_stats = Parallel(n_jobs=n_jobs, backend="loky")(delayed(aggregate_rows)(
+        store_file, dataset_names, row_groups, shard[0], shard[-1] + 1, block_size
+        ) for shard in shards)
+
+    group_stats = {}
+    for stats in shard_stats:
+        for group, group_stat in stats.items():
+            group_stats[group] = merge_stats(group_stats[group], group_stat) if group in group_stats else group_stat
+
+    results = {}
+    for group in sorted(group_stats.keys()):
+        stats = group_stats[group]
+        var = stats["M2"] / (stats["n"] - 1) if stats["n"] > 1 else np.full(len(stats["M2"]), np.nan)
+        results[group] = {"n": stats["n"], "mean": stats["mean"], "var": var}
+    return results
+
+def get_group_matrices(results, n_rois):
+    """ (n_rois x n_rois) mean and variance matrices per group
+    """
+    matrices = {}
+    n_edges = n_rois * (n_rois - 1) // 2
+    for group, stats in results.items():
+        has_diagonal = len(stats["mean"]) > n_edges
+        matrices[group] = {"n": stats["n"]}
+        for stat in ["mean", "var"]:
+            diagonal = stats[stat][n_edges:] if has_diagonal else (1 if stat == "mean" else 0)
+            matrices[group][stat] = vec_to_matrix(stats[stat][:n_edges], n_rois, diagonal)
+    return matrices
+
+def save_group_stats(output_file, results, roi_labels):
+    groups = sorted(results.keys())
+    np.savez(output_file, groups=np.array(groups, dtype=str), roi_labels=np.array(roi_labels, dtype=str),
+             n=np.array([results[group]["n"] for group in groups]),
+             mean=np.array([results[group]["mean"] for group in groups]),
+             var=np.array([results[group]["var"] for group in groups]))
+
+if __name__ == '__main__':
+    # argparse
+    HELPTEXT = """
+    Script to compute group-level mean / variance of the connectivity measures saved by fmriprep2func_conn.py
+    """
+    parser = argparse.ArgumentParser(description=HELPTEXT)
+    parser.add_argument('--output_dir', type=str, help='FC output dir (containing the FC store)', required=True)
+    parser.add_argument('--brain_atlas', type=str, default='schaefer', help='brain atlas (default: schaefer)')
+    parser.add_argument('--confound_strategy', type=str, default='no_motion_no_gsr', help='confound strategy (default: no_motion_no_gsr)')
+    parser.add_argument('--measure', type=str, default='precision', help='correlation, covariance or precision (default: precision)')
+    parser.add_argument('--demographics_csv', type=str, default=None, help='csv/tsv with a group column (default: a single group)')
+    parser.add_argument('--group_col', type=str, default='group', help='group column of the demographics csv (default: group)')
+    parser.add_argument('--participant_col', type=str, default='participant_id', help='participant column of the demographics csv')
+    parser.add_argument('--manifest_csv', type=str, default=None, help='mr_proc manifest to map participant_id to bids_id')
+    parser.add_argument('--n_jobs', type=int, default=1, help='number of shards aggregated in parallel (default: 1)')
+    parser.add_argument('--block_size', type=int, default=BLOCK_SIZE, help=f'store rows read at a time (default: {BLOCK_SIZE})')
+    parser.add_argument('--output_file', type=str, default=None, help='npz output (default: next to the FC store)')
+    args = parser.parse_args()
+
+    store_file = get_store_file(args.output_dir, args.brain_atlas, args.confound_strategy)
+    bids_id_groups = None
+    group_col = "none"
+    if args.demographics_csv is not None:
+        bids_id_groups = get_participant_groups(args.demographics_csv, args.group_col, args.participant_col, args.manifest_csv)
+        group_col = args.group_col
+
+    results = aggregate_groups(store_file, args.measure, bids_id_groups, args.n_jobs, args.block_size)
+    for group, stats in results.items():
+        print(f"{group}: {stats['n']} rows")
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = f"{os.path.splitext(store_file)[0]}_group-{group_col}_{args.measure}_stats.npz"
+    save_group_stats(output_file, results, load_roi_labels(store_file))
+    print(f"Saving group stats at {output_file}")
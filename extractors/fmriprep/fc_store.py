@@ -0,0 +1,126 @@
+import os
+import numpy as np
+import pandas as pd
+import h5py
+
+# Group-level connectivity store (one HDF5 file per atlas and confound strategy):
+# <output_dir>/FC_atlas-<atlas>_desc-<confound_strategy>.h5
+#     roi_labels                    (n_rois,)            ROI names shared by all rows
+#     index/bold_prefix             (n,)                 e.g. sub-01_ses-01_task-rest_run-1 (row key)
+#     index/participant_id          (n,)
+#     index/session_id              (n,)
+#     index/input_key               (n,)                 fingerprint of the inputs (up to date check)
+#     measures/<measure>            (n, n_edges) float32 upper triangle (without diagonal), row-major
+#     diagonals/<measure>           (n, n_rois)  float32 (covariance / precision / tangent only)
+# Rows are stored as separate chunks, so reading a single subject does not read the others.
+
+INDEX_COLUMNS = ["bold_prefix", "participant_id", "session_id", "input_key"]
+DIAGONAL_MEASURES = ["covariance", "precision", "tangent"]
+STR_DTYPE = h5py.string_dtype(encoding="utf-8")
+
+def get_store_file(output_dir, brain_atlas, confound_strategy):
+    return f"{output_dir}/FC_atlas-{brain_atlas}_desc-{confound_strategy}.h5"
+
+def get_bold_entities(bold_prefix):
+    """ participant and session ids from a BIDS filename prefix
+    """
+    entities = dict([part.split("-", 1) for part in bold_prefix.split("_") if "-" in part])
+    return f"sub-{entities.get('sub', '')}", entities.get("ses", "")
+
+def matrix_to_vec(matrix):
+    return matrix[np.triu_indices(matrix.shape[0], k=1)].astype(np.float32)
+
+def vec_to_matrix(vec, n_rois, diagonal=None):
+    """ Symmetric matrix from an upper triangle (diagonal defaults to 1, as for correlations)
+    """
+    matrix = np.zeros((n_rois, n_rois), dtype=np.float64)
+    rows, cols = np.triu_indices(n_rois, k=1)
+    matrix[rows, cols] = vec
+    matrix[cols, rows] = vec
+    np.fill_diagonal(matrix, 1 if diagonal is None else diagonal)
+    return matrix
+
+def read_index(store_file):
+    """ Row index of the store (empty if the store does not exist yet)
+    """
+    if not os.path.isfile(store_file):
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    with h5py.File(store_file, "r") as f:
+        if "index" not in f:
+            return pd.DataFrame(columns=INDEX_COLUMNS)
+        return pd.DataFrame({col: f[f"index/{col}"].asstr()[:] for col in INDEX_COLUMNS})
+
+def _create_dataset(f, name, n_cols, dtype=np.float32):
+    return f.create_dataset(name, shape=(0, n_cols), maxshape=(None, n_cols), chunks=(1, n_cols), dtype=dtype)
+
+def write_rows(store_file, rows, roi_labels):
+    """ Append (or replace, matched on bold_prefix) rows of {"bold_prefix", "input_key", <measure>: matrix}
+    """
+    n_rois = len(roi_labels)
+    n_edges = n_rois * (n_rois - 1) // 2
+    with h5py.File(store_file, "a") as f:
+        if "roi_labels" not in f:
+            f.create_dataset("roi_labels", data=np.array(roi_labels, dtype=object), dtype=STR_DTYPE)
+            for col in INDEX_COLUMNS:
+                f.create_dataset(f"index/{col}", shape=(0,), maxshape=(None,), dtype=STR_DTYPE)
+        elif len(f["roi_labels"]) != n_rois:
+            raise ValueError(f"{store_file} has {len(f['roi_labels'])} ROIs, got {n_rois}")
+
+        row_ids = {prefix: i for i, prefix in enumerate(f["index/bold_prefix"].asstr()[:])}
+        for row in rows:
+            bold_prefix = row["bold_prefix"]
+            if bold_prefix in row_ids:
+                i = row_ids[bold_prefix]
+            else:
+                i = len(row_ids)
+                row_ids[bold_prefix] = i
+                for col in INDEX_COLUMNS:
+                    f[f"index/{col}"].resize((i + 1,))
+                for name in f.get("measures", {}):
+                    f[f"measures/{name}"].resize((i + 1, n_edges))
+                for name in f.get("diagonals", {}):
+                    f[f"diagonals/{name}"].resize((i + 1, n_rois))
+
+            participant_id, session_id = get_bold_entities(bold_prefix)
+            index_values = {"bold_prefix": bold_prefix, "participant_id": participant_id,
+                            "session_id": session_id, "input_key": row["input_key"]}
+            for col, value in index_values.items():
+                f[f"index/{col}"][i] = value
+
+            for measure, matrix in row.items():
+                if measure in ["bold_prefix", "input_key"]:
+                    continue
+                if f"measures/{measure}" not in f:
+                    _create_dataset(f, f"measures/{measure}", n_edges).resize((len(row_ids), n_edges))
+                f[f"measures/{measure}"][i] = matrix_to_vec(matrix)
+                if measure in DIAGONAL_MEASURES:
+                    if f"diagonals/{measure}" not in f:
+                        _create_dataset(f, f"diagonals/{measure}", n_rois).resize((len(row_ids), n_rois))
+                    f[f"diagonals/{measure}"][i] = np.diag(matrix).astype(np.float32)
+
+def load_measure(store_file, measure, bold_prefixes=None):
+    """ Index dataframe and (n x n_edges) float32 matrix of a measure (optionally only some rows)
+    """
+    index_df = read_index(store_file)
+    rows = np.arange(len(index_df))
+    if bold_prefixes is not None:
+        rows = np.flatnonzero(index_df["bold_prefix"].isin(bold_prefixes).values)
+    with h5py.File(store_file, "r") as f:
+        # h5py fancy indexing needs increasing indices
+        vecs = f[f"measures/{measure}"][np.sort(rows)] if len(rows) > 0 else np.empty((0, f[f"measures/{measure}"].shape[1]))
+    return index_df.iloc[np.sort(rows)].reset_index(drop=True), vecs
+
+def load_roi_labels(store_file):
+    with h5py.File(store_file, "r") as f:
+        return f["roi_labels"].asstr()[:]
+
+def load_matrix(store_file, measure, bold_prefix):
+    """ Full (n_rois x n_rois) matrix of a single row
+    """
+    index_df = read_index(store_file)
+    i = np.flatnonzero(index_df["bold_prefix"].values == bold_prefix)[0]
+    with h5py.File(store_file, "r") as f:
+        n_rois = len(f["roi_labels"])
+        vec = f[f"measures/{measure}"][i]
+        diagonal = f[f"diagonals/{measure}"][i] if f"diagonals/{measure}" in f else None
+    return vec_to_matrix(vec, n_rois, diagonal)
@@ -2,93 +2,258 @@ from nilearn.maskers import NiftiLabelsMasker, NiftiSpheresMasker
 from nilearn.interfaces.fmriprep import load_confounds
 from nilearn import datasets
 from nilearn import plotting
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
 import numpy as np
 from copy import deepcopy
+import argparse
+import glob
+import hashlib
+import json
 import os
 import warnings
+from timeseries_cache import TIMESERIES_DIR, get_cache_file, get_cache_key, load_time_series, save_time_series
+from roi_extraction import ATLAS_CACHE_DIR, CHUNK_SIZE, clean_roi_signals, extract_multi_roi_signals
+from fc_store import get_store_file, load_roi_labels, read_index, write_rows
+from fc_group_stats import aggregate_groups, get_group_matrices, get_participant_groups
+from batch_connectivity import BATCH_SIZE, ENGINES, can_batch_clean, clean_signals, get_correlations
+from fc_estimators import (PILOT_MODES, PILOT_SIZE, PRECISION_MODES, compare_precision_modes, estimate_precision,
+                           fit_pilot, get_cv_alpha, get_pilot_file, get_tangent, load_pilot, save_pilot, select_pilot)
 
 warnings.simplefilter('ignore')
 
+HELPTEXT = """
+Script to extract functional connectivity (correlation, covariance, sparse precision) from fMRIPrep outputs
+"""
 
-### paths to files
-# root = '/Users/mte/Documents/McGill/JB/QPN/data/'
-# output_root = '/Users/mte/Documents/McGill/JB/QPN/FC_output/'
-
-root = '../../../../pd/qpn/derivatives/fmriprep/v20.2.7/fmriprep/'
-output_root = '../outputs/FC_outputs/'
+# Sample cmd:
+#  python fmriprep2func_conn.py --fmriprep_dir <DATASET_ROOT>/derivatives/fmriprep/v20.2.7/fmriprep/ \
+#                               --output_dir <DATASET_ROOT>/derivatives/FC_outputs/ \
+#                               --brain_atlas schaefer --confound_strategy no_motion_no_gsr \
+#                               --n_jobs 8 --n_threads 2
+#  (several atlases / confound strategies in a single pass over the BOLD files:
+#   --brain_atlas schaefer schaefer200 schaefer400 seitzman --confound_strategy no_motion no_motion_no_gsr,
+#   or --config <json> with "brain_atlases" and "confound_strategies" lists)
+#  (faster sparse precision: --precision_mode pilot, see fc_estimators.py; speed / accuracy of the modes on
+#   a subset of the data: --benchmark_precision)
 
 ### parameters
 
 reorder_conn_mat = True
-visualize = False
-brain_atlas = 'schaefer' # schaefer or seitzman
-confound_strategy = 'no_motion_no_gsr' # no_motion or no_motion_no_gsr
-
-test_output = False
+SPACE = 'MNI152NLin2009cAsym_res-2'
+BRAIN_ATLASES = ['schaefer', 'schaefer200', 'schaefer400', 'seitzman'] # schaefer: 100 ROIs
+# load_confounds arguments of each confound strategy
+CONFOUND_STRATEGY_PARAMS = {
+      'no_motion': {"strategy": ["high_pass", "motion", "wm_csf"], "motion": "basic", "wm_csf": "basic"},
+      'no_motion_no_gsr': {"strategy": ["high_pass", "motion", "wm_csf", "global_signal"],
+                           "motion": "basic", "wm_csf": "basic", "global_signal": "basic"},
+}
+CONFOUND_STRATEGIES = list(CONFOUND_STRATEGY_PARAMS.keys())
+# signal cleaning parameters of the atlas maskers
+MASKER_PARAMS = {"standardize": True, "detrend": False, "low_pass": None, "high_pass": None, "t_r": None}
+STORE_WRITE_BATCH = 16 # rows written to the FC store at once
 
 ### Load Atlas
 
-## schaefer
-if brain_atlas=='schaefer':
-      parc = datasets.fetch_atlas_schaefer_2018(n_rois=100)
-      atlas_filename = parc.maps
-      labels = parc.labels
-      # The list of labels does not contain ‘Background’ by default. 
-      # To have proper indexing, you should either manually add ‘Background’ to the list of labels:
-      # Prepend background label
-      labels = np.insert(labels, 0, 'Background')
-      # create the masker for extracting time series
-      masker = NiftiLabelsMasker(labels_img=atlas_filename, standardize=True)
-## seitzman
-if brain_atlas=='seitzman':
-      parc = datasets.fetch_coords_seitzman_2018()
-      atlas_filename = parc['rois']
-      radius = parc['radius']
-      labels = parc['regions']
-      # create the masker for extracting time series
-      masker = NiftiSpheresMasker(seeds=atlas_filename, radius=radius, standardize=True)
-
-### Load Subjects
-ALL_SUBJECTS = os.listdir(root)
-ALL_SUBJECTS = [i for i in ALL_SUBJECTS if ('sub' in i) and (not '.html' in i)]
-ALL_SUBJECTS.sort()
-print('*** '+ str(len(ALL_SUBJECTS)) + ' subjects were found.')
-for subj in ALL_SUBJECTS:
-      print('*** running '+subj)
-      ### output dictionary
+def get_atlas(brain_atlas):
+      """ Create the masker and the ROI labels of an atlas (fetched once, before the workers start)
+      """
+      ## schaefer (schaefer: 100 ROIs, schaefer<n_rois>: e.g. schaefer400)
+      if brain_atlas.startswith('schaefer'):
+            n_rois = int(brain_atlas[len('schaefer'):] or 100)
+            parc = datasets.fetch_atlas_schaefer_2018(n_rois=n_rois)
+            atlas_filename = parc.maps
+            labels = parc.labels
+            # The list of labels does not contain ‘Background’ by default.
+            # To have proper indexing, you should either manually add ‘Background’ to the list of labels:
+            # Prepend background label
+            labels = np.insert(labels, 0, 'Background')
+            # create the masker for extracting time series
+            masker = NiftiLabelsMasker(labels_img=atlas_filename, **MASKER_PARAMS)
+      ## seitzman
+      elif brain_atlas=='seitzman':
+            parc = datasets.fetch_coords_seitzman_2018()
+            atlas_filename = parc['rois']
+            radius = parc['radius']
+            labels = parc['regions']
+            # keep the same indexing as the schaefer labels (offset by one)
+            labels = np.insert(labels, 0, 'Background')
+            # create the masker for extracting time series
+            masker = NiftiSpheresMasker(seeds=atlas_filename, radius=radius, **MASKER_PARAMS)
+      else:
+            raise ValueError(f"Unknown brain atlas: {brain_atlas}")
+
+      return masker, labels
+
+### Confounds
+
+def get_confounds(bold, confound_strategy):
+      """ Load the fMRIPrep confounds of a BOLD file for a given strategy
+      """
+      if confound_strategy not in CONFOUND_STRATEGY_PARAMS:
+            raise ValueError(f"Unknown confound strategy: {confound_strategy}")
+
+      confounds, sample_mask = load_confounds(bold, **CONFOUND_STRATEGY_PARAMS[confound_strategy])
+      return confounds, sample_mask
+
+def get_extraction_params(confound_strategy, engine='nilearn'):
+      """ Parameters of the time series extraction (part of the time series cache key)
+      """
+      return {"masker": MASKER_PARAMS, "confounds": CONFOUND_STRATEGY_PARAMS[confound_strategy], "engine": engine}
+
+### Find BOLD files
+
+def find_bold_files(fmriprep_dir, participants=None, session_id=None, task=None, space=SPACE):
+      """ Preprocessed BOLD files of all subjects, sessions, tasks and runs (sessions are optional in BIDS)
+      """
+      bold_files = []
+      for func_dir in ["*/func", "*/ses-*/func"]:
+            bold_files += glob.glob(f"{fmriprep_dir}/sub-{func_dir}/sub-*_space-{space}_desc-preproc_bold.nii.gz")
+
+      bold_files = [bold for bold in bold_files if os.path.isfile(bold)]
+      if participants is not None:
+            participants = [p if p.startswith("sub-") else f"sub-{p}" for p in participants]
+            bold_files = [bold for bold in bold_files if os.path.basename(bold).split("_")[0] in participants]
+      if session_id is not None:
+            bold_files = [bold for bold in bold_files if f"_ses-{session_id}_" in os.path.basename(bold)]
+      if task is not None:
+            bold_files = [bold for bold in bold_files if f"_task-{task}_" in os.path.basename(bold)]
+
+      return sorted(bold_files)
+
+def get_bold_prefix(bold):
+      """ e.g. sub-01_ses-01_task-rest_run-1 (row key of the FC store)
+      """
+      return os.path.basename(bold).split("_space-")[0]
+
+### Functional connectivity
+
+def get_time_series_batch(bold_combinations, atlases, cache_dir, atlas_cache_dir=None, chunk_size=CHUNK_SIZE, engine='nilearn'):
+      """ Confound-cleaned ROI time series of BOLD files for their (brain_atlas, confound_strategy) combinations
+          (same output as masker.fit_transform, without resampling the atlas for every BOLD file).
+          Cached time series are reused, the others are computed from a single read of each BOLD file
+          and the confounds of each strategy are loaded once. With the batched engine, the signals of all
+          the BOLD files are cleaned together (see batch_connectivity.py).
+      """
+      time_series = {bold: {} for bold in bold_combinations.keys()}
+      to_clean = [] # (bold, combination, roi signals, confounds, sample mask)
+      for bold, combinations in bold_combinations.items():
+            missing = []
+            for brain_atlas, confound_strategy in combinations:
+                  cache_file = get_cache_file(cache_dir, bold, brain_atlas, confound_strategy)
+                  params = get_extraction_params(confound_strategy, engine)
+                  cached = load_time_series(cache_file, get_cache_key(bold, brain_atlas, confound_strategy, params))
+                  if cached is None:
+                        missing.append((brain_atlas, confound_strategy))
+                  else:
+                        time_series[bold][(brain_atlas, confound_strategy)] = cached[0]
+
+            if len(missing) > 0:
+                  missing_atlases = sorted(set([brain_atlas for brain_atlas, _ in missing]))
+                  missing_strategies = sorted(set([confound_strategy for _, confound_strategy in missing]))
+
+                  ### extract the timeseries
+                  roi_signals = extract_multi_roi_signals(bold, [atlases[brain_atlas][0] for brain_atlas in missing_atlases],
+                                                          atlas_cache_dir, chunk_size)
+                  roi_signals = dict(zip(missing_atlases, roi_signals))
+
+                  ### Confounds
+                  confounds = {confound_strategy: get_confounds(bold, confound_strategy) for confound_strategy in missing_strategies}
+
+                  for brain_atlas, confound_strategy in missing:
+                        strategy_confounds, sample_mask = confounds[confound_strategy]
+                        to_clean.append((bold, (brain_atlas, confound_strategy), roi_signals[brain_atlas], strategy_confounds, sample_mask))
+
+      ### clean the timeseries
+      cleaned = [None] * len(to_clean)
+      batches = {} # masker standardize --> indices of to_clean
+      for i, (_, (brain_atlas, _), roi_signals, strategy_confounds, sample_mask) in enumerate(to_clean):
+            atlas_masker = atlases[brain_atlas][0]
+            if engine == 'batched' and can_batch_clean(atlas_masker):
+                  batches.setdefault(atlas_masker.standardize, []).append(i)
+            else:
+                  cleaned[i] = clean_roi_signals(roi_signals, atlas_masker,
+                                          confounds=strategy_confounds,
+                                          sample_mask=sample_mask)
+      for standardize, indices in batches.items():
+            batch = clean_signals([to_clean[i][2] for i in indices], [to_clean[i][3] for i in indices],
+                                  [to_clean[i][4] for i in indices], standardize)
+            for i, atlas_time_series in zip(indices, batch):
+                  cleaned[i] = atlas_time_series
+
+      for (bold, (brain_atlas, confound_strategy), _, _, sample_mask), atlas_time_series in zip(to_clean, cleaned):
+            cache_file = get_cache_file(cache_dir, bold, brain_atlas, confound_strategy)
+            params = get_extraction_params(confound_strategy, engine)
+            save_time_series(cache_file, get_cache_key(bold, brain_atlas, confound_strategy, params), atlas_time_series, sample_mask)
+            time_series[bold][(brain_atlas, confound_strategy)] = atlas_time_series
+
+      return time_series
+
+def get_bold_time_series(bold, atlases, combinations, cache_dir, atlas_cache_dir=None, chunk_size=CHUNK_SIZE):
+      """ ROI time series of a single BOLD file (see get_time_series_batch)
+      """
+      return get_time_series_batch({bold: combinations}, atlases, cache_dir, atlas_cache_dir, chunk_size)[bold]
+
+def fit_pilot_bold(bold, atlases, combinations, cache_dir, atlas_cache_dir=None, chunk_size=CHUNK_SIZE,
+                   n_threads=1, alpha_combinations=()):
+      """ Time series (and cross-validated alphas of alpha_combinations) of a pilot BOLD file
+      """
+      with threadpool_limits(limits=n_threads):
+            time_series = get_bold_time_series(bold, atlases, combinations, cache_dir, atlas_cache_dir, chunk_size)
+            alphas = {combination: get_cv_alpha(time_series[combination]) for combination in alpha_combinations}
+      return time_series, alphas
+
+def get_pilots(bold_files, store_files, atlases, cache_dir, atlas_cache_dir, precision_mode, tangent=False,
+               pilot_size=PILOT_SIZE, n_jobs=1, n_threads=1, chunk_size=CHUNK_SIZE, overwrite=False):
+      """ Parameters shared by all BOLD files (alpha / tangent reference) of each (brain_atlas, confound_strategy),
+          fitted once on a pilot subset and saved
+      """
+      pilots = {}
+      for combination, store_file in store_files.items():
+            pilots[combination] = None if overwrite else load_pilot(get_pilot_file(store_file), precision_mode, tangent)
+
+      missing = [combination for combination, pilot in pilots.items() if pilot is None]
+      if len(missing) > 0:
+            pilot_bolds = select_pilot(bold_files, pilot_size)
+            print('*** fitting the pilot (' + precision_mode + ' mode) on ' + str(len(pilot_bolds)) + ' BOLD files.')
+            alpha_combinations = missing if precision_mode in PILOT_MODES else []
+            results = Parallel(n_jobs=n_jobs, backend="loky")(delayed(fit_pilot_bold)(
+                  bold, atlases, missing, cache_dir, atlas_cache_dir, chunk_size, n_threads, alpha_combinations
+                  ) for bold in pilot_bolds)
+
+            for combination in missing:
+                  time_series_list = [time_series[combination] for time_series, _ in results]
+                  alphas = [alphas[combination] for _, alphas in results] if precision_mode in PILOT_MODES else None
+                  pilot = fit_pilot(time_series_list, [get_bold_prefix(bold) for bold in pilot_bolds], precision_mode, tangent, alphas)
+                  save_pilot(get_pilot_file(store_files[combination]), pilot)
+                  pilots[combination] = pilot
+
+      for (brain_atlas, confound_strategy), pilot in pilots.items():
+            if pilot["alpha"] is not None:
+                  print('*** pilot alpha (' + brain_atlas + ', ' + confound_strategy + '): ' + str(pilot["alpha"]))
+      return pilots
+
+def get_input_key(bold, brain_atlas, confound_strategy, precision_mode='cv', pilot=None, engine='nilearn'):
+      """ Fingerprint of the inputs of a row of the FC store (BOLD, confounds, atlas, engine, estimator and pilot)
+      """
+      input_key = get_cache_key(bold, brain_atlas, confound_strategy, get_extraction_params(confound_strategy, engine))
+      if precision_mode == 'cv' and pilot is None:
+            return input_key
+      pilot_key = pilot["pilot_key"] if pilot is not None else ""
+      return hashlib.sha1(f"{input_key}:{precision_mode}:{pilot_key}".encode()).hexdigest()
+
+def compute_FC(time_series, labels, precision_mode='cv', pilot=None, visualize=False, correlation_matrix=None):
+      """ Connectivity matrices of an ROI time series (the correlation can be given if it was computed in a batch)
+      """
       FC = {}
-      
-      ### functional data
-      bold = root + subj + '/ses-01/func/'+ subj +'_ses-01_task-rest_run-1_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz'
-
-      ### Confounds
-
-      if confound_strategy=='no_motion':
-            confounds_simple, sample_mask = load_confounds(
-                  bold,
-                  strategy=["high_pass", "motion", "wm_csf"],
-                  motion="basic", wm_csf="basic"
-                  )
-      if confound_strategy=='no_motion_no_gsr':
-            confounds_minimal_no_gsr, sample_mask = load_confounds(
-                  bold,
-                  strategy=["high_pass", "motion", "wm_csf", "global_signal"],
-                  motion="basic", wm_csf="basic", global_signal="basic"
-                  )
-
-      ### extract the timeseries
-      time_series = masker.fit_transform(bold,
-                              confounds=confounds_minimal_no_gsr,
-                              sample_mask=sample_mask)
-
-      FC['roi_labels'] = labels[1:] # Be careful that the indexing should be offset by one
 
       ### functional connectivity assessment
       ## correlation
 
-      from nilearn.connectome import ConnectivityMeasure
-      correlation_measure = ConnectivityMeasure(kind='correlation')
-      correlation_matrix = correlation_measure.fit_transform([time_series])[0]
+      if correlation_matrix is None:
+            from nilearn.connectome import ConnectivityMeasure
+            correlation_measure = ConnectivityMeasure(kind='correlation')
+            correlation_matrix = correlation_measure.fit_transform([time_series])[0]
       FC['correlation'] = deepcopy(correlation_matrix)
 
       # Plot the correlation matrix
@@ -104,18 +269,8 @@ for subj in ALL_SUBJECTS:
                               vmax=1, vmin=-1, title="Correlation Confounds regressed",
                               reorder=reorder_conn_mat)
 
-      ## sparse inverse covariance 
-      try:
-            from sklearn.covariance import GraphicalLassoCV
-      except ImportError:
-      # for Scitkit-Learn < v0.20.0
-            from sklearn.covariance import GraphLassoCV as GraphicalLassoCV
-
-      estimator = GraphicalLassoCV()
-      estimator.fit(time_series)
-
-      # The covariance can be found at estimator.covariance_
-      covariance_mat = estimator.covariance_
+      ## sparse inverse covariance (GraphicalLassoCV, or a faster estimator, see fc_estimators.py)
+      covariance_mat, precision_mat, _ = estimate_precision(time_series, precision_mode, pilot)
       FC['covariance'] = deepcopy(covariance_mat)
       if visualize:
             np.fill_diagonal(covariance_mat, 0)
@@ -123,58 +278,239 @@ for subj in ALL_SUBJECTS:
                               figure=(9, 7), vmax=1, vmin=-1,
                               title='Covariance', reorder=reorder_conn_mat)
 
-      precision_mat = -estimator.precision_
+      precision_mat = -precision_mat
       FC['precision'] = deepcopy(precision_mat)
       if visualize:
             np.fill_diagonal(precision_mat, 0)
             plotting.plot_matrix(precision_mat, labels=labels[1:],
                               figure=(9, 7), vmax=1, vmin=-1,
                               title='Sparse inverse covariance', reorder=reorder_conn_mat)
+
+      ## tangent-space embedding at the pilot reference
+      if pilot is not None and pilot["tangent_measure"] is not None:
+            FC['tangent'] = get_tangent(time_series, pilot)
+
       if visualize:
             plotting.show()
 
-      ### save output 
-      np.save(output_root+subj+'_FC_output.npy', FC) 
+      return FC
+
+def extract_FC(bold_jobs, atlases, cache_dir, atlas_cache_dir=None, chunk_size=CHUNK_SIZE, n_threads=1, visualize=False,
+               precision_mode='cv', pilots=None, engine='nilearn'):
+      """ Compute the connectivity matrices of BOLD files for each of their (brain_atlas, confound_strategy, input_key) jobs
+          (returned as rows of the FC stores, each BOLD file is read once for all its jobs)
+      """
+      # each worker is limited to n_threads BLAS / OpenMP threads (no oversubscription with n_jobs workers)
+      with threadpool_limits(limits=n_threads):
+            for bold, _ in bold_jobs:
+                  print('*** running '+os.path.basename(bold))
+            bold_combinations = {bold: [(brain_atlas, confound_strategy) for brain_atlas, confound_strategy, _ in jobs]
+                                 for bold, jobs in bold_jobs}
+            time_series = get_time_series_batch(bold_combinations, atlases, cache_dir, atlas_cache_dir, chunk_size, engine)
+
+            jobs = [(bold, brain_atlas, confound_strategy, input_key) for bold, combination_jobs in bold_jobs
+                    for brain_atlas, confound_strategy, input_key in combination_jobs]
+            # correlations of all the jobs with the same shape at once
+            correlations = [None] * len(jobs)
+            if engine == 'batched':
+                  correlations = get_correlations([time_series[bold][(brain_atlas, confound_strategy)]
+                                                   for bold, brain_atlas, confound_strategy, _ in jobs])
+
+            rows = []
+            for (bold, brain_atlas, confound_strategy, input_key), correlation_matrix in zip(jobs, correlations):
+                  ### output dictionary
+                  FC = {'bold_prefix': get_bold_prefix(bold), 'input_key': input_key}
+                  pilot = pilots.get((brain_atlas, confound_strategy)) if pilots is not None else None
+                  FC.update(compute_FC(time_series[bold][(brain_atlas, confound_strategy)], atlases[brain_atlas][1],
+                                       precision_mode, pilot, visualize, correlation_matrix))
+                  rows.append(((brain_atlas, confound_strategy), FC))
+
+      return rows
+
+def run(fmriprep_dir, output_dir, brain_atlases=['schaefer'], confound_strategies=['no_motion_no_gsr'], participants=None,
+        session_id=None, task=None, space=SPACE, n_jobs=1, n_threads=1, overwrite=False, visualize=False,
+        chunk_size=CHUNK_SIZE, precision_mode='cv', tangent=False, pilot_size=PILOT_SIZE, engine='nilearn',
+        batch_size=BATCH_SIZE):
+      """ Extract functional connectivity of all BOLD files that are not up to date,
+          for every combination of brain atlas and confound strategy (one FC store per combination)
+      """
+      os.makedirs(output_dir, exist_ok=True)
+      if isinstance(brain_atlases, str):
+            brain_atlases = [brain_atlases]
+      if isinstance(confound_strategies, str):
+            confound_strategies = [confound_strategies]
+
+      ### Load Subjects
+      bold_files = find_bold_files(fmriprep_dir, participants, session_id, task, space)
+      n_subjects = len(set([os.path.basename(bold).split("_")[0] for bold in bold_files]))
+      print('*** '+ str(len(bold_files)) + ' BOLD files (' + str(n_subjects) + ' subjects) were found.')
 
-print('*** FC measurement finished successfully.')
+      store_files = {}
+      for brain_atlas in brain_atlases:
+            for confound_strategy in confound_strategies:
+                  store_files[(brain_atlas, confound_strategy)] = get_store_file(output_dir, brain_atlas, confound_strategy)
+      cache_dir = f"{output_dir}/{TIMESERIES_DIR}"
+      atlas_cache_dir = f"{output_dir}/{ATLAS_CACHE_DIR}"
+      atlases, pilots = {}, None
+      if (precision_mode != 'cv' or tangent) and len(bold_files) > 0:
+            atlases = {brain_atlas: get_atlas(brain_atlas) for brain_atlas in brain_atlases}
+            pilots = get_pilots(bold_files, store_files, atlases, cache_dir, atlas_cache_dir, precision_mode, tangent,
+                                pilot_size, n_jobs, n_threads, chunk_size, overwrite)
+
+      # (BOLD file, atlas, strategy) whose inputs did not change since they were added to the store are skipped
+      pending = {}
+      n_jobs_total = 0
+      for (brain_atlas, confound_strategy), store_file in store_files.items():
+            stored_keys = read_index(store_file).set_index("bold_prefix")["input_key"].to_dict()
+            pilot = pilots[(brain_atlas, confound_strategy)] if pilots is not None else None
+            for bold in bold_files:
+                  input_key = get_input_key(bold, brain_atlas, confound_strategy, precision_mode, pilot, engine)
+                  if overwrite or stored_keys.get(get_bold_prefix(bold)) != input_key:
+                        pending.setdefault(bold, []).append((brain_atlas, confound_strategy, input_key))
+                        n_jobs_total += 1
+      n_total = len(bold_files) * len(store_files)
+      print('*** ' + str(n_total - n_jobs_total) + ' BOLD x atlas x strategy outputs are up to date, ' + str(n_jobs_total) + ' to run ('
+            + str(len(pending)) + ' BOLD files).')
+
+      if len(pending) > 0:
+            for brain_atlas in brain_atlases:
+                  if brain_atlas not in atlases:
+                        atlases[brain_atlas] = get_atlas(brain_atlas)
+            # masking and GraphicalLassoCV are CPU bound --> one process per BOLD file
+            # (per batch of BOLD files with the batched engine, cleaning and correlations are computed for the whole batch)
+            pending_items = list(pending.items())
+            if engine != 'batched':
+                  batch_size = 1
+            tasks = [pending_items[i:i + batch_size] for i in range(0, len(pending_items), batch_size)]
+            results = Parallel(n_jobs=n_jobs, backend="loky", return_as="generator_unordered")(delayed(extract_FC)(
+                  bold_jobs, atlases, cache_dir, atlas_cache_dir, chunk_size, n_threads, visualize, precision_mode, pilots, engine
+                  ) for bold_jobs in tasks)
+
+            # only the main process writes to the stores (in batches, as results come in)
+            rows = {combination: [] for combination in store_files.keys()}
+            for bold_rows in results:
+                  for combination, FC in bold_rows:
+                        rows[combination].append(FC)
+                        if len(rows[combination]) == STORE_WRITE_BATCH:
+                              # Be careful that the indexing should be offset by one
+                              write_rows(store_files[combination], rows[combination], atlases[combination[0]][1][1:])
+                              rows[combination] = []
+            for combination, combination_rows in rows.items():
+                  if len(combination_rows) > 0:
+                        write_rows(store_files[combination], combination_rows, atlases[combination[0]][1][1:])
+            for combination in sorted(set([(a, s) for jobs in pending.values() for a, s, _ in jobs])):
+                  print('*** FC saved in ' + store_files[combination])
+
+      print('*** FC measurement finished successfully.')
+
+def benchmark_precision(fmriprep_dir, output_dir, brain_atlas='schaefer', confound_strategy='no_motion_no_gsr',
+                        participants=None, session_id=None, task=None, space=SPACE, benchmark_size=20,
+                        pilot_size=PILOT_SIZE, n_jobs=1, n_threads=1, chunk_size=CHUNK_SIZE):
+      """ Speed / accuracy of the precision modes (vs. GraphicalLassoCV) on a subset of the BOLD files
+      """
+      os.makedirs(output_dir, exist_ok=True)
+      bold_files = select_pilot(find_bold_files(fmriprep_dir, participants, session_id, task, space), benchmark_size)
+      print('*** benchmarking the precision modes on ' + str(len(bold_files)) + ' BOLD files.')
+      atlases = {brain_atlas: get_atlas(brain_atlas)}
+      cache_dir = f"{output_dir}/{TIMESERIES_DIR}"
+      atlas_cache_dir = f"{output_dir}/{ATLAS_CACHE_DIR}"
+      combination = (brain_atlas, confound_strategy)
+      results = Parallel(n_jobs=n_jobs, backend="loky")(delayed(fit_pilot_bold)(
+            bold, atlases, [combination], cache_dir, atlas_cache_dir, chunk_size, n_threads
+            ) for bold in bold_files)
+
+      with threadpool_limits(limits=n_threads):
+            report = compare_precision_modes([time_series[combination] for time_series, _ in results], pilot_size)
+      print(report.to_string(index=False))
+      report_file = f"{output_dir}/precision_benchmark_atlas-{brain_atlas}_desc-{confound_strategy}.csv"
+      report.to_csv(report_file, index=False)
+      print('*** benchmark saved in ' + report_file)
+      return report
 
 ### test outputs
-if test_output:
-      # calc average static FC
-
-      metric = 'precision' # correlation , covariance , precision 
-      dir = './FC_outputs/'
-
-      ALL_RECORDS = os.listdir(dir)
-      ALL_RECORDS = [i for i in ALL_RECORDS if 'FC_output' in i]
-      ALL_RECORDS.sort()
-      print(str(len(ALL_RECORDS))+' subjects were found.')
-
-      FC_all = list()
-      FC_MNI = list()
-      FC_PD = list()
-      for subj in ALL_RECORDS:
-            FC = np.load(dir+subj,allow_pickle='TRUE').item()
-            FC_all.append(FC[metric])
-            if 'MNI' in subj:
-                  FC_MNI.append(FC[metric])
-            if 'PD' in subj:
-                  FC_PD.append(FC[metric])
-      print(str(len(FC_MNI))+' MNI subjects were found.')
-      print(str(len(FC_PD))+' PD subjects were found.')
-      avg_FC = np.mean(np.array(FC_all), axis=0)
-      avg_FC_MNI = np.mean(np.array(FC_MNI), axis=0)
-      avg_FC_PD = np.mean(np.array(FC_PD), axis=0)
-      np.fill_diagonal(avg_FC, 0)
-      plotting.plot_matrix(avg_FC, labels=FC['roi_labels'],
-                  figure=(9, 7), vmax=1, vmin=-1,
-                  title=metric+' ALL', reorder=False)
-      np.fill_diagonal(avg_FC_MNI, 0)
-      plotting.plot_matrix(avg_FC_MNI, labels=FC['roi_labels'],
-                  figure=(9, 7), vmax=1, vmin=-1,
-                  title=metric+' MNI', reorder=False)
-      np.fill_diagonal(avg_FC_PD, 0)
-      plotting.plot_matrix(avg_FC_PD, labels=FC['roi_labels'],
-                  figure=(9, 7), vmax=1, vmin=-1,
-                  title=metric+' PD', reorder=False)
-      plotting.show()
\ No newline at end of file
+def test_outputs(output_dir, brain_atlas='schaefer', confound_strategy='no_motion_no_gsr', metric='precision',
+                 demographics_csv=None, group_col='group', n_jobs=1):
+      # plot the average static FC (of all subjects and per group of the demographics csv)
+
+      # metric: correlation , covariance , precision
+      store_file = get_store_file(output_dir, brain_atlas, confound_strategy)
+      roi_labels = load_roi_labels(store_file)
+      bids_id_groups = None
+      if demographics_csv is not None:
+            bids_id_groups = get_participant_groups(demographics_csv, group_col)
+
+      group_matrices = get_group_matrices(aggregate_groups(store_file, metric, bids_id_groups, n_jobs), len(roi_labels))
+      for group, matrices in group_matrices.items():
+            print(str(matrices['n'])+' '+group+' subjects were found.')
+            avg_FC = matrices['mean']
+            np.fill_diagonal(avg_FC, 0)
+            plotting.plot_matrix(avg_FC, labels=roi_labels,
+                        figure=(9, 7), vmax=1, vmin=-1,
+                        title=metric+' '+group, reorder=False)
+      plotting.show()
+
+if __name__ == '__main__':
+      parser = argparse.ArgumentParser(description=HELPTEXT)
+
+      parser.add_argument('--fmriprep_dir', help='path to fmriprep output dir with all the subjects', required=True)
+      parser.add_argument('--output_dir', help='path to save the FC outputs', required=True)
+      parser.add_argument('--brain_atlas', nargs='+', default=['schaefer'], choices=BRAIN_ATLASES,
+                          help='brain atlas(es) (default: schaefer)')
+      parser.add_argument('--confound_strategy', nargs='+', default=['no_motion_no_gsr'], choices=CONFOUND_STRATEGIES,
+                          help='confound strategy(ies) (default: no_motion_no_gsr)')
+      parser.add_argument('--config', default=None,
+                          help='json with "brain_atlases" and "confound_strategies" lists (overrides --brain_atlas / --confound_strategy)')
+      parser.add_argument('--participants', nargs='+', default=None, help='participants to run (default: all)')
+      parser.add_argument('--session_id', default=None, help='session to run (default: all)')
+      parser.add_argument('--task', default=None, help='task to run (default: all)')
+      parser.add_argument('--space', default=SPACE, help=f'output space of the BOLD files (default: {SPACE})')
+      parser.add_argument('--n_jobs', type=int, default=1, help='number of BOLD files processed in parallel (default: 1)')
+      parser.add_argument('--n_threads', type=int, default=1, help='number of BLAS threads per worker (default: 1)')
+      parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE,
+                          help=f'number of BOLD volumes read at a time, bounds memory per worker (0: whole scan, default: {CHUNK_SIZE})')
+      parser.add_argument('--precision_mode', default='cv', choices=PRECISION_MODES,
+                          help='sparse precision estimator: GraphicalLassoCV per BOLD (cv), alpha of a pilot subset (pilot), '
+                               'short CV around the pilot alpha (warm), or shrinkage (ledoit_wolf, oas) (default: cv)')
+      parser.add_argument('--tangent', action='store_true', help='also save the tangent-space embedding (reference fitted on the pilot subset)')
+      parser.add_argument('--pilot_size', type=int, default=PILOT_SIZE,
+                          help=f'number of BOLD files of the pilot subset (default: {PILOT_SIZE})')
+      parser.add_argument('--benchmark_precision', action='store_true',
+                          help='report the speed / accuracy of the precision modes on a subset of the BOLD files')
+      parser.add_argument('--benchmark_size', type=int, default=20, help='number of BOLD files of the benchmark (default: 20)')
+      parser.add_argument('--engine', default='nilearn', choices=ENGINES,
+                          help='signal cleaning / correlation with nilearn per BOLD file, or batched over BOLD files '
+                               'with the same shape (same results, see batch_connectivity.py) (default: nilearn)')
+      parser.add_argument('--batch_size', type=int, default=BATCH_SIZE,
+                          help=f'number of BOLD files per worker task with the batched engine (default: {BATCH_SIZE})')
+      parser.add_argument('--overwrite', action='store_true', help='re-run BOLD files with up to date outputs (and re-fit the pilot)')
+      parser.add_argument('--visualize', action='store_true', help='plot the connectivity matrices')
+      parser.add_argument('--test_output', action='store_true', help='plot the average FC of the saved outputs')
+      parser.add_argument('--demographics_csv', default=None, help='csv with the groups plotted by --test_output (default: all subjects only)')
+      parser.add_argument('--group_col', default='group', help='group column of the demographics csv (default: group)')
+      args = parser.parse_args()
+
+      brain_atlases, confound_strategies = args.brain_atlas, args.confound_strategy
+      if args.config is not None:
+            with open(args.config, 'r') as f:
+                  config = json.load(f)
+            brain_atlases = config.get("brain_atlases", brain_atlases)
+            confound_strategies = config.get("confound_strategies", confound_strategies)
+            unknown = [a for a in brain_atlases if a not in BRAIN_ATLASES] + [c for c in confound_strategies if c not in CONFOUND_STRATEGIES]
+            if len(unknown) > 0:
+                  parser.error(f"unknown brain atlases / confound strategies in {args.config}: {unknown}")
+
+      if args.test_output:
+            for brain_atlas in brain_atlases:
+                  for confound_strategy in confound_strategies:
+                        test_outputs(args.output_dir, brain_atlas, confound_strategy,
+                                     demographics_csv=args.demographics_csv, group_col=args.group_col, n_jobs=args.n_jobs)
+      elif args.benchmark_precision:
+            for brain_atlas in brain_atlases:
+                  for confound_strategy in confound_strategies:
+                        benchmark_precision(args.fmriprep_dir, args.output_dir, brain_atlas, confound_strategy, args.participants,
+                                            args.session_id, args.task, args.space, args.benchmark_size, args.pilot_size,
+                                            args.n_jobs, args.n_threads, args.chunk_size)
+      else:
+            run(args.fmriprep_dir, args.output_dir, brain_atlases, confound_strategies, args.participants,
+                args.session_id, args.task, args.space, args.n_jobs, args.n_threads, args.overwrite, args.visualize,
+                args.chunk_size, args.precision_mode, args.tangent, args.pilot_size, args.engine, args.batch_size)
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from sklearn import neighbors
+from nilearn import image, signal
+from nilearn.maskers import NiftiLabelsMasker, NiftiSpheresMasker
+
+# ROI signal extraction without per-subject atlas resampling:
+# the atlas is resampled (labels) or intersected with the voxel grid (spheres) once per
+# (atlas, affine, shape) and stored as a sparse ROI x voxel averaging matrix:
+# <output_dir>/atlas_cache/<atlas>_<grid hash>.npz
+# ROI signals are then a single sparse product with the BOLD voxels, followed by the same
+# nilearn signal.clean call that NiftiLabelsMasker / NiftiSpheresMasker use.
+
+ATLAS_CACHE_DIR = "atlas_cache"
+CHUNK_SIZE = 64 # volumes read at a time (0: read the whole BOLD at once)
+
+# per-process cache (workers process many BOLD files on the same grid)
+_roi_weights_cache = {}
+
+def get_atlas_key(masker):
+    """ Identity of the atlas definition used by a masker
+    """
+    if isinstance(masker, NiftiLabelsMasker):
+        labels_img = masker.labels_img
+        atlas_id = os.path.abspath(labels_img) if isinstance(labels_img, str) else \
+            hashlib.sha1(np.ascontiguousarray(labels_img.get_fdata()).tobytes()).hexdigest()
+        return f"labels:{atlas_id}:{masker.background_label}"
+    elif isinstance(masker, NiftiSpheresMasker):
+        seeds = np.ascontiguousarray(np.asarray(masker.seeds, dtype=np.float64))
+        return f"spheres:{hashlib.sha1(seeds.tobytes()).hexdigest()}:{masker.radius}:{masker.allow_overlap}"
+    else:
+        raise ValueError(f"Unsupported masker: {type(masker).__name__}")
+
+def get_label_weights(labels_img, background_label, affine, shape):
+    """ ROI membership of the voxels of a grid (nearest-neighbour resampled labels, as in NiftiLabelsMasker)
+    """
+    labels_img = image.load_img(labels_img)
+    target_img = nib.Nifti1Image(np.zeros(shape, dtype=np.int8), affine)
+    if not (np.allclose(labels_img.affine, affine) and labels_img.shape[:3] == tuple(shape)):
+        labels_img = image.resample_to_img(labels_img, target_img, interpolation="nearest")
+
+    labels_data = np.asarray(labels_img.dataobj).ravel()
+    roi_ids = np.unique(labels_data)
+    roi_ids = roi_ids[roi_ids != background_label]
+
+    voxels = np.flatnonzero(labels_data != background_label)
+    rows = np.searchsorted(roi_ids, labels_data[voxels])
+    membership = sparse.csr_matrix((np.ones(len(voxels)), (rows, voxels)), shape=(len(roi_ids), len(labels_data)))
+    return membership
+
+def get_sphere_weights(seeds, radius, allow_overlap, affine, shape):
+    """ Voxels of a grid within each sphere (same rules as NiftiSpheresMasker without a mask)
+    """
+    seeds = np.asarray(seeds, dtype=np.float64)
+    voxel_coords = np.indices(shape).reshape(3, -1).T
+    world_coords = image.resampling.coord_transform(voxel_coords[:, 0], voxel_coords[:, 1], voxel_coords[:, 2], affine)
+    world_coords = np.asarray(world_coords).T
+
+    clf = neighbors.NearestNeighbors(radius=radius)
+    membership = clf.fit(world_coords).radius_neighbors_graph(seeds).tolil()
+
+    # the voxel nearest to each seed is always included
+    nearests = np.round(image.resampling.coord_transform(seeds[:, 0], seeds[:, 1], seeds[:, 2], np.linalg.inv(affine)))
+    nearests = np.asarray(nearests).T.astype(int)
+    for i, nearest in enumerate(nearests):
+        if np.all(nearest >= 0) and np.all(nearest < shape):
+            membership[i, np.ravel_multi_index(tuple(nearest), shape)] = True
+
+    # ... and so is the first voxel whose (truncated) world coordinates are the (truncated) seed
+    int_coords = world_coords.astype(int)
+    for i, seed in enumerate(seeds.astype(int)):
+        matches = np.flatnonzero(np.all(int_coords == seed, axis=1))
+        if len(matches) > 0:
+            membership[i, matches[0]] = True
+
+    membership = membership.tocsr()
+    sphere_sizes = np.asarray(membership.sum(axis=1)).ravel()
+    empty_spheres = np.nonzero(sphere_sizes == 0)[0]
+    if len(empty_spheres) != 0:
+        raise ValueError(f"These spheres are empty: {empty_spheres}")
+    if (not allow_overlap) and np.any(membership.sum(axis=0) >= 2):
+        raise ValueError("Overlap detected between spheres")
+    return membership
+
+def get_roi_weights(masker, affine, shape, cache_dir=None):
+    """ Sparse (n_rois x n_voxels) averaging matrix of an atlas on a voxel grid,
+        cached in memory and in cache_dir per (atlas, affine, shape)
+    """
+    shape = tuple(int(d) for d in shape[:3])
+    grid_key = hashlib.sha1(f"{get_atlas_key(masker)}\n{np.round(affine, 6).tolist()}\n{shape}".encode()).hexdigest()
+    if grid_key in _roi_weights_cache:
+        return _roi_weights_cache[grid_key]
+
+    cache_file = None
+    if cache_dir is not None:
+        atlas_type = "labels" if isinstance(masker, NiftiLabelsMasker) else "spheres"
+        cache_file = f"{cache_dir}/{atlas_type}_{grid_key}.npz"
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        membership = sparse.load_npz(cache_file)
+    else:
+        if isinstance(masker, NiftiLabelsMasker):
+            membership = get_label_weights(masker.labels_img, masker.background_label, affine, shape)
+        else:
+            membership = get_sphere_weights(masker.seeds, masker.radius, masker.allow_overlap, affine, shape)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # one tmp file per process (workers can build the weights of the same grid at the same time)
+            tmp_file = f"{cache_file[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+            sparse.save_npz(tmp_file, membership)
+            os.replace(tmp_file, cache_file)
+
+    # mean over the voxels of each ROI
+    membership = membership.tocsr().astype(np.float64)
+    sizes = np.asarray(membership.sum(axis=1)).ravel()
+    weights = sparse.diags(1 / sizes) @ membership
+
+    # only the voxels covered by the atlas need to be read
+    voxels = np.unique(weights.indices)
+    weights = (weights[:, voxels].tocsr(), voxels)
+    _roi_weights_cache[grid_key] = weights
+    return weights
+
+def extract_roi_signals(bold, masker, cache_dir=None, chunk_size=CHUNK_SIZE):
+    """ Raw (uncleaned) ROI signals of a 4D BOLD file, shape: (n_volumes, n_rois).
+        Volumes are read chunk_size at a time, so peak memory is bounded by the chunk and not the scan length
+        (.nii files are memory-mapped, .nii.gz files are decompressed once, front to back).
+    """
+    return extract_multi_roi_signals(bold, [masker], cache_dir, chunk_size)[0]
+
+def extract_multi_roi_signals(bold, maskers, cache_dir=None, chunk_size=CHUNK_SIZE):
+    """ Raw ROI signals of several atlases, computed from a single (chunked) read of the BOLD file
+    """
+    bold_img = nib.load(bold, keep_file_open=True)
+    roi_weights = [get_roi_weights(masker, bold_img.affine, bold_img.shape[:3], cache_dir) for masker in maskers]
+
+    n_volumes = bold_img.shape[3]
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = n_volumes
+
+    signals = [np.empty((n_volumes, weights.shape[0])) for weights, _ in roi_weights]
+    for start in range(0, n_volumes, chunk_size):
+        stop = min(start + chunk_size, n_volumes)
+        data = np.asanyarray(bold_img.dataobj[..., start:stop])
+        data = data.reshape(-1, stop - start)
+        for (weights, voxels), atlas_signals in zip(roi_weights, signals):
+            atlas_data = np.nan_to_num(data[voxels], copy=False)
+            atlas_signals[start:stop] = np.asarray(weights @ atlas_data).T
+
+    bold_img.uncache()
+    return signals
+
+def clean_roi_signals(signals, masker, confounds=None, sample_mask=None):
+    """ Detrending / filtering / confound removal / standardization with the masker parameters
+    """
+    clean_kwargs = getattr(masker, "clean_kwargs", None) or {}
+    return signal.clean(
+        signals,
+        detrend=masker.detrend,
+        standardize=masker.standardize,
+        standardize_confounds=masker.standardize_confounds,
+        t_r=masker.t_r,
+        low_pass=masker.low_pass,
+        high_pass=masker.high_pass,
+        confounds=confounds,
+        sample_mask=sample_mask,
+        **clean_kwargs,
+    )
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Per-BOLD cache of the extracted (confound-cleaned) ROI time series:
+# <output_dir>/timeseries/<bold_prefix>_atlas-<atlas>_desc-<confound_strategy>_timeseries.npz
+# Arrays: time_series (n_volumes x n_rois, float32), sample_mask (kept volumes, -1 if all volumes are kept), key
+# The key changes with the BOLD / confounds files (path, size, mtime), the atlas, the confound strategy and the
+# extraction parameters (masker standardize / detrend / filters, load_confounds arguments of the strategy),
+# so connectivity measures can be recomputed from the cache without touching the BOLD file.
+
+CACHE_VERSION = 2
+TIMESERIES_DIR = "timeseries"
+
+def get_input_files(bold):
+    """ BOLD file and the fMRIPrep confounds it is cleaned with
+    """
+    confounds_file = bold.split("_space-")[0] + "_desc-confounds_timeseries.tsv"
+    return [bold, confounds_file]
+
+def get_cache_key(bold, brain_atlas, confound_strategy, params=None):
+    """ params: json-serializable parameters of the extraction (see get_extraction_params in fmriprep2func_conn.py)
+    """
+    key = [f"version:{CACHE_VERSION}", f"atlas:{brain_atlas}", f"confounds:{confound_strategy}",
+           f"params:{json.dumps(params, sort_keys=True, default=str)}"]
+    for f in get_input_files(bold):
+        if os.path.isfile(f):
+            f_stat = os.stat(f)
+            key.append(f"{os.path.abspath(f)}:{f_stat.st_size}:{f_stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(key).encode()).hexdigest()
+
+def get_cache_file(cache_dir, bold, brain_atlas, confound_strategy):
+    bold_prefix = os.path.basename(bold).split("_space-")[0]
+    return f"{cache_dir}/{bold_prefix}_atlas-{brain_atlas}_desc-{confound_strategy}_timeseries.npz"
+
+def load_time_series(cache_file, key):
+    """ Cached time series and sample mask (None if missing or stale)
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    with np.load(cache_file) as cached:
+        if str(cached["key"]) != key:
+            return None
+        time_series = cached["time_series"].astype(np.float64)
+        sample_mask = cached["sample_mask"]
+    if len(sample_mask) == 1 and sample_mask[0] == -1:
+        sample_mask = None
+    return time_series, sample_mask
+
+def save_time_series(cache_file, key, time_series, sample_mask):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    sample_mask = np.array([-1]) if sample_mask is None else np.asarray(sample_mask)
+    # np.savez adds the .npz extension to paths without it
+    tmp_file = f"{cache_file[:-len('.npz')]}.tmp.npz"
+    np.savez_compressed(tmp_file, key=np.array(key), time_series=time_series.astype(np.float32),
+                        sample_mask=sample_mask.astype(np.int64))
+    os.replace(tmp_file, cache_file)
+
+def get_time_series(bold, brain_atlas, confound_strategy, cache_dir, extract_func, params=None):
+    """ Cached ROI time series of a BOLD file, extract_func() --> (time_series, sample_mask) is only called on a cache miss
+    """
+    key = get_cache_key(bold, brain_atlas, confound_strategy, params)
+    cache_file = get_cache_file(cache_dir, bold, brain_atlas, confound_strategy)
+    cached = load_time_series(cache_file, key)
+    if cached is not None:
+        return cached
+
+    time_series, sample_mask = extract_func()
+    save_time_series(cache_file, key, time_series, sample_mask)
+    return time_series, sample_mask
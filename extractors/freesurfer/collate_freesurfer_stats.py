@@ -3,7 +3,9 @@ import pandas as pd
 import os
 import glob
 import argparse
-from freesurfer_stats import CorticalParcellationStats
+import joblib
+from joblib import Parallel, delayed
+from fs_stats_parser import read_stats, get_structural_measurements, get_aseg_measurements
 
 HELPTEXT = """
 Script to parse and collate FreeSurfer stats files across subjects
@@ -20,57 +22,309 @@ Date: May-5-2022
 #                                     --aseg \
 #                                     --save_dir ./
 
-parser = argparse.ArgumentParser(description=HELPTEXT)
-
-# data
-# TODO: Not sure how to handle multiple visits..
-# parser.add_argument('--participants_list', dest='participants_list',                      
-#                     help='path to participants list (csv or tsv')
-
-parser.add_argument('--fs_output_dir', help='path to fs_output_dir with all the subjects')
-parser.add_argument('--stat_file', default='aparc.DKTatlas.stats', help='name of a standard FS stat file')
-parser.add_argument('--stat_measure', default='average_thickness_mm', help='path to bids_dir')                    
-parser.add_argument('--ukbb_dkt_ct_fields', help='UKBB lookup table with fields ID and DKT ROI names')
-parser.add_argument('--ukbb_aseg_vol_fields', default="", help='UKBB lookup table with fields ID and ASEG ROI names')
-parser.add_argument('--aseg', action='store_true', help='Parse aseg.stats to collate subcortical volumes')
-parser.add_argument('--save_dir', default='./', help='path to save_dir')
-args = parser.parse_args()
-
 def parse_aseg(aseg_file, stat_measure):
     """Function to parse aseg.stats file from freesurfer"""
+    return get_aseg_measurements(read_stats(aseg_file), stat_measure)
 
-    aseg_data = np.loadtxt(aseg_file, dtype="i1,i1,i4,f4,S32,f4,f4,f4,f4,f4")
+ERROR_COLUMNS = ["subject_id", "session_id", "stat_file", "hemi", "error_type", "error_message"]
 
-    aseg_df = pd.DataFrame(data=aseg_data)
-    aseg_df = aseg_df[["f4","f3"]].rename(columns={"f3":stat_measure, "f4":"hemi_ROI"})
-    aseg_df["hemi_ROI"] = aseg_df["hemi_ROI"].str.decode('utf-8') 
-
-    # print(f"number of ROIs in aseg file: {len(aseg_df)}")
-
-    # Get global volumes from the "measure" lines
-    file_data = open(aseg_file, 'r')
-    lines = file_data.readlines()
-    measure_lines = []
-    for line in lines:
-        if "Measure" in line:
-            measure_lines.append(line)
+def get_subject_ids(fs_output_dir):
+    subject_dir_list = glob.glob(f"{fs_output_dir}sub*")
+    return sorted([os.path.basename(x) for x in subject_dir_list])
+
+def get_error_record(subject_id, stat_file, hemi, e):
+    return {"subject_id": subject_id, "stat_file": stat_file, "hemi": hemi,
+            "error_type": type(e).__name__, "error_message": str(e).strip()}
+
+def parse_cortical_stats(fs_output_dir, subject_id, hemi, stat_file, stat_measure):
+    """ (record, error) of a subject hemisphere: record is {"subject_id", <ROI>: value}
+    """
+    try:
+        fs_stats_dir = f"{fs_output_dir}{subject_id}/stats/"
+        stats = get_structural_measurements(read_stats(f"{fs_stats_dir}{hemi}.{stat_file}"))
+        record = dict(zip(stats["structure_name"].values, stats[stat_measure].values))
+        return {"subject_id": subject_id, **record}, None
+    except Exception as e:
+        return None, get_error_record(subject_id, stat_file, hemi, e)
+
+def parse_subcortical_stats(fs_output_dir, subject_id, stat_file, stat_measure):
+    """ (record, error) of a subject aseg file: record is {"subject_id", <ROI / global measure>: value}
+    """
+    try:
+        aseg_file = f"{fs_output_dir}{subject_id}/stats/{stat_file}"
+        stats = parse_aseg(aseg_file, stat_measure)
+        record = dict(zip(stats["hemi_ROI"].values, stats[stat_measure].values))
+        return {"subject_id": subject_id, **record}, None
+    except Exception as e:
+        return None, get_error_record(subject_id, stat_file, "", e)
+
+def collate_records(results):
+    """ One dataframe from the worker records (built once) and the list of errors
+    """
+    records = [record for record, _ in results if record is not None]
+    errors = [error for _, error in results if error is not None]
+    df = pd.DataFrame.from_records(records)
+    if len(df) == 0:
+        df = pd.DataFrame(columns=["subject_id"])
+    return df, errors
+
+def collate_cortical_stats(fs_output_dir, subject_id_list, stat_file, stat_measure, ukbb_dkt_ct_fields_df, n_jobs=1):
+    """ lh and rh stat_measure of all subjects (columns renamed with UKBB field IDs) and parsing errors
+    """
+    hemispheres = ["lh", "rh"]
+    results = Parallel(n_jobs=n_jobs, backend="loky")(delayed(parse_cortical_stats)(
+        fs_output_dir, subject_id, hemi, stat_file, stat_measure
+        ) for hemi in hemispheres for subject_id in subject_id_list)
 
-    global_df = pd.DataFrame(measure_lines)
-    global_df = global_df.replace('\n','', regex=True)
-    global_df = global_df[0].str.split(",", expand=True)
-    global_df[0] = global_df[0].str.split(" ", expand=True)[2]
-    global_df[0] = global_df[0].replace({"EstimatedTotalIntraCranialVol":"EstimatedTotalIntraCranial"}) #To match UKB field names
-    global_df = global_df[[0,3]]
+    hemi_stat_measures_dict = {}
+    errors = []
+    n_subjects = len(subject_id_list)
+    for i, hemi in enumerate(hemispheres):
+        stat_measure_df, hemi_errors = collate_records(results[i * n_subjects:(i + 1) * n_subjects])
+        errors += hemi_errors
 
-    global_df = global_df.rename(columns = {0:"hemi_ROI",3:stat_measure})
+        # replace columns names with ukbb field IDs
+        field_df = ukbb_dkt_ct_fields_df[ukbb_dkt_ct_fields_df["hemi"]==hemi][["Field ID","roi"]]
+        roi_field_id_dict = dict(zip(field_df["roi"], field_df["Field ID"]))
+        stat_measure_df = stat_measure_df.rename(columns=roi_field_id_dict)
 
-    aseg_df = pd.concat([aseg_df,global_df],axis=0)
+        hemi_stat_measures_dict[hemi] = stat_measure_df
 
-    return aseg_df
+    # merge left and right dfs
+    stat_measure_LR_df = pd.merge(hemi_stat_measures_dict["lh"],hemi_stat_measures_dict["rh"], on="subject_id")
 
+    # Drop columns ommited by DKT atlas
+    if stat_file == "aparc.DKTatlas.stats":
+        drop_ROIs = ["temporalpole","frontalpole","banks of the superior temporal sulcus"]
+        stat_measure_LR_df = stat_measure_LR_df.drop(columns=[d_roi for d_roi in drop_ROIs if d_roi in stat_measure_LR_df.columns])
+
+    return stat_measure_LR_df, errors
+
+def collate_subcortical_stats(fs_output_dir, subject_id_list, ukbb_aseg_vol_fields_df, n_jobs=1):
+    """ aseg volumes of all subjects (only the ROIs with UKBB field IDs) and parsing errors
+    """
+    stat_file = "aseg.stats"
+    stat_measure = "Volume_mm3"
+    results = Parallel(n_jobs=n_jobs, backend="loky")(delayed(parse_subcortical_stats)(
+        fs_output_dir, subject_id, stat_file, stat_measure
+        ) for subject_id in subject_id_list)
+    stat_measure_df, errors = collate_records(results)
+
+    field_df = ukbb_aseg_vol_fields_df[ukbb_aseg_vol_fields_df["hemi_ROI"].isin(stat_measure_df.columns)]
+    common_rois = list(field_df["hemi_ROI"].values)
+    roi_field_id_dict = dict(zip(field_df["hemi_ROI"], field_df["Field ID"]))
+
+    print(f"Number of aseg vol ROIs after UKBB merge: {len(roi_field_id_dict)}")
+
+    # Rename ROIs with ukbb ids (remove the ROIs which don't have ukbb ids)
+    stat_measure_df = stat_measure_df[["subject_id"] + common_rois].copy()
+    stat_measure_df = stat_measure_df.rename(columns=roi_field_id_dict)
+
+    return stat_measure_df, errors
+
+PARCELLATIONS = ["aparc", "aparc.a2009s", "aparc.DKTatlas"]
+LONG_COLUMNS = ["subject_id", "session_id", "parcellation", "hemi", "roi", "measure", "value"]
+ASEG_ID_COLUMNS = ["Index", "SegId", "StructName"]
+UKBB_FIELDS = {"aparc.DKTatlas": "average_thickness_mm", "aseg": "Volume_mm3"} # measure of the UKBB lookup tables
+FEATURE_COLUMNS = ["parcellation", "hemi", "roi", "measure"] # ROI axis of the longitudinal array
+
+# --all_measures parses each subject of each session once and caches its long table (and errors) in
+# <cache_dir>/<session_id>/<subject_id>.joblib, with the mtime / size of its stats files: later runs only
+# parse the subjects whose stats files were added, changed or removed, and rebuild the group outputs from the cache.
+
+def get_long_table(subject_id, parcellation, hemi, rois, measures):
+    """ Long-format rows (subject_id, parcellation, hemi, roi, measure, value) of {measure: values per ROI}
+    """
+    n_rois = len(rois)
+    measure_names = list(measures.keys())
+    return pd.DataFrame({"subject_id": subject_id, "parcellation": parcellation, "hemi": hemi,
+                         "roi": np.tile(rois, len(measure_names)),
+                         "measure": np.repeat(measure_names, n_rois),
+                         "value": np.concatenate([np.asarray(measures[m], dtype=np.float64) for m in measure_names])})
+
+def parse_subject_stats(fs_output_dir, subject_id, parcellations=PARCELLATIONS, aseg=True):
+    """ (long table, errors) of all the structural measures of a subject, each stats file read once:
+        ?h.<parcellation>.stats (freesurfer_stats measure names) and aseg.stats (ColHeader measure names,
+        global Measure volumes as Volume_mm3 rows)
+    """
+    fs_stats_dir = f"{fs_output_dir}{subject_id}/stats/"
+    tables = []
+    errors = []
+    for parcellation in parcellations:
+        for hemi in ["lh", "rh"]:
+            stat_file = f"{parcellation}.stats"
+            try:
+                stats = get_structural_measurements(read_stats(f"{fs_stats_dir}{hemi}.{stat_file}"))
+                measures = {col: stats[col].values for col in stats.columns if col != "structure_name"}
+                tables.append(get_long_table(subject_id, parcellation, hemi, stats["structure_name"].values, measures))
+            except Exception as e:
+                errors.append(get_error_record(subject_id, stat_file, hemi, e))
 
+    if aseg:
+        stat_file = "aseg.stats"
+        try:
+            stats = read_stats(f"{fs_stats_dir}{stat_file}")
+            columns = stats["columns"]
+            measures = {col: values for col, values in columns.items() if col not in ASEG_ID_COLUMNS}
+            tables.append(get_long_table(subject_id, "aseg", "", columns["StructName"], measures))
+            global_df = get_aseg_measurements(stats, "Volume_mm3").iloc[len(columns["StructName"]):]
+            volumes = stats["measures"]["unit"] == "mm^3"
+            tables.append(get_long_table(subject_id, "aseg", "", global_df["hemi_ROI"].values[volumes],
+                                         {"Volume_mm3": global_df["Volume_mm3"].values[volumes]}))
+        except Exception as e:
+            errors.append(get_error_record(subject_id, stat_file, "", e))
+
+    stats_df = pd.concat(tables, axis=0, ignore_index=True) if tables else None
+    return stats_df, errors
+
+def get_ukbb_lookup(ukbb_dkt_ct_fields_df=None, ukbb_aseg_vol_fields_df=None):
+    """ (parcellation, hemi, roi, measure) --> ukbb_field_id, from the UKBB DKT thickness and ASEG volume tables
+    """
+    lookup_dfs = []
+    if ukbb_dkt_ct_fields_df is not None:
+        lookup_dfs.append(pd.DataFrame({"parcellation": "aparc.DKTatlas", "hemi": ukbb_dkt_ct_fields_df["hemi"],
+                                        "roi": ukbb_dkt_ct_fields_df["roi"], "measure": UKBB_FIELDS["aparc.DKTatlas"],
+                                        "ukbb_field_id": ukbb_dkt_ct_fields_df["Field ID"]}))
+    if ukbb_aseg_vol_fields_df is not None:
+        lookup_dfs.append(pd.DataFrame({"parcellation": "aseg", "hemi": "", "roi": ukbb_aseg_vol_fields_df["hemi_ROI"],
+                                        "measure": UKBB_FIELDS["aseg"], "ukbb_field_id": ukbb_aseg_vol_fields_df["Field ID"]}))
+    if not lookup_dfs:
+        return pd.DataFrame(columns=["parcellation", "hemi", "roi", "measure", "ukbb_field_id"])
+    lookup_df = pd.concat(lookup_dfs, axis=0, ignore_index=True)
+    return lookup_df.drop_duplicates(subset=["parcellation", "hemi", "roi", "measure"])
+
+def add_ukbb_field_ids(stats_df, ukbb_lookup_df):
+    """ ukbb_field_id column (<NA> for the rows without a UKBB field), joined on (parcellation, hemi, roi, measure)
+    """
+    stats_df = stats_df.merge(ukbb_lookup_df, on=["parcellation", "hemi", "roi", "measure"], how="left")
+    stats_df["ukbb_field_id"] = stats_df["ukbb_field_id"].astype("Int64")
+    return stats_df
+
+def get_session_dirs(fs_output_dir, sessions=None):
+    """ session_id --> FreeSurfer output dir of the session: <fs_output_dir>ses-<session>/ for the given sessions,
+        or all the ses-* dirs, or fs_output_dir itself (single session, named after it if it is a ses-* dir)
+    """
+    if sessions:
+        session_ids = [session if session.startswith("ses-") else f"ses-{session}" for session in sessions]
+        return {session_id: f"{fs_output_dir}{session_id}/" for session_id in session_ids}
+
+    session_dir_list = sorted(glob.glob(f"{fs_output_dir}ses-*/"))
+    if session_dir_list:
+        return {os.path.basename(os.path.dirname(x)): x for x in session_dir_list}
+
+    session_id = os.path.basename(os.path.normpath(fs_output_dir))
+    return {session_id if session_id.startswith("ses-") else "": fs_output_dir}
+
+def get_stat_files(parcellations=PARCELLATIONS, aseg=True):
+    stat_files = [f"{hemi}.{parcellation}.stats" for parcellation in parcellations for hemi in ["lh", "rh"]]
+    return stat_files + (["aseg.stats"] if aseg else [])
+
+def get_stats_key(fs_stats_dir, stat_files):
+    """ {stat_file: (mtime_ns, size)} (None if missing) of the stats files of a subject
+    """
+    stats_key = {}
+    for stat_file in stat_files:
+        try:
+            file_stat = os.stat(f"{fs_stats_dir}{stat_file}")
+            stats_key[stat_file] = (file_stat.st_mtime_ns, file_stat.st_size)
+        except FileNotFoundError:
+            stats_key[stat_file] = None
+    return stats_key
+
+def get_cache_file(cache_dir, session_id, subject_id):
+    return f"{cache_dir}/{session_id}/{subject_id}.joblib" if session_id else f"{cache_dir}/{subject_id}.joblib"
+
+def get_subject_stats(fs_output_dir, subject_id, session_id="", parcellations=PARCELLATIONS, aseg=True, cache_dir=None):
+    """ (long table, errors, parsed) of a subject session, read from the cache unless its stats files changed
+    """
+    stats_key = get_stats_key(f"{fs_output_dir}{subject_id}/stats/", get_stat_files(parcellations, aseg))
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = get_cache_file(cache_dir, session_id, subject_id)
+        if os.path.isfile(cache_file):
+            try:
+                cache = joblib.load(cache_file)
+                if cache["stats_key"] == stats_key:
+                    return cache["stats_df"], cache["errors"], False
+            except Exception as e:
+                print(f"Ignoring unreadable cache file {cache_file} ({type(e).__name__})")
+
+    stats_df, errors = parse_subject_stats(fs_output_dir, subject_id, parcellations, aseg)
+    if stats_df is not None:
+        stats_df.insert(1, "session_id", session_id)
+    for error in errors:
+        error["session_id"] = session_id
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        joblib.dump({"stats_key": stats_key, "stats_df": stats_df, "errors": errors}, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    return stats_df, errors, True
+
+def collate_all_stats(session_dirs, parcellations=PARCELLATIONS, aseg=True, n_jobs=1, cache_dir=None):
+    """ Long table of all the measures of all subjects and sessions (one pass per new / changed subject session),
+        parsing errors and number of parsed (not cached) subject sessions
+    """
+    subject_sessions = [(fs_output_dir, subject_id, session_id) for session_id, fs_output_dir in session_dirs.items()
+                        for subject_id in get_subject_ids(fs_output_dir)]
+    results = Parallel(n_jobs=n_jobs, backend="loky")(delayed(get_subject_stats)(
+        fs_output_dir, subject_id, session_id, parcellations, aseg, cache_dir
+        ) for fs_output_dir, subject_id, session_id in subject_sessions)
+
+    tables = [stats_df for stats_df, _, _ in results if stats_df is not None]
+    errors = [error for _, subject_errors, _ in results for error in subject_errors]
+    n_parsed = sum([parsed for _, _, parsed in results])
+    stats_df = pd.concat(tables, axis=0, ignore_index=True) if tables else pd.DataFrame(columns=LONG_COLUMNS)
+    return stats_df, errors, n_parsed
+
+def get_longitudinal_array(stats_df):
+    """ (subjects x sessions x ROIs) values (NaN if missing), subject ids, session ids and ROI table
+        (parcellation, hemi, roi, measure and ukbb_field_id if present) of a long table
+    """
+    subject_ids = np.array(sorted(stats_df["subject_id"].unique()), dtype=str)
+    session_ids = np.array(sorted(stats_df["session_id"].unique()), dtype=str)
+    feature_cols = FEATURE_COLUMNS + (["ukbb_field_id"] if "ukbb_field_id" in stats_df.columns else [])
+    features_df = stats_df[feature_cols].drop_duplicates(subset=FEATURE_COLUMNS).reset_index(drop=True)
+
+    subject_idx = pd.Categorical(stats_df["subject_id"], categories=subject_ids).codes
+    session_idx = pd.Categorical(stats_df["session_id"], categories=session_ids).codes
+    feature_idx = stats_df.groupby(FEATURE_COLUMNS, sort=False).ngroup().values
+
+    values = np.full((len(subject_ids), len(session_ids), len(features_df)), np.nan)
+    values[subject_idx, session_idx, feature_idx] = stats_df["value"].values
+    return values, subject_ids, session_ids, features_df
+
+def save_longitudinal_array(save_file, values, subject_ids, session_ids, features_df):
+    arrays = {col: np.array(features_df[col].values, dtype=str) for col in FEATURE_COLUMNS}
+    if "ukbb_field_id" in features_df.columns:
+        arrays["ukbb_field_id"] = features_df["ukbb_field_id"].astype("float64").values
+    np.savez(save_file, values=values, subject_ids=subject_ids, session_ids=session_ids, **arrays)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=HELPTEXT)
+
+    # data
+    # parser.add_argument('--participants_list', dest='participants_list',                      
+    #                     help='path to participants list (csv or tsv')
+
+    parser.add_argument('--fs_output_dir', help='path to fs_output_dir with all the subjects')
+    parser.add_argument('--stat_file', default='aparc.DKTatlas.stats', help='name of a standard FS stat file')
+    parser.add_argument('--stat_measure', default='average_thickness_mm', help='path to bids_dir')                    
+    parser.add_argument('--ukbb_dkt_ct_fields', help='UKBB lookup table with fields ID and DKT ROI names')
+    parser.add_argument('--ukbb_aseg_vol_fields', default="", help='UKBB lookup table with fields ID and ASEG ROI names')
+    parser.add_argument('--aseg', action='store_true', help='Parse aseg.stats to collate subcortical volumes')
+    parser.add_argument('--save_dir', default='./', help='path to save_dir')
+    parser.add_argument('--n_jobs', type=int, default=1, help='number of stats files parsed in parallel (default: 1)')
+    parser.add_argument('--all_measures', action='store_true', help='collate all the measures of --parcellations (and aseg '
+                        'with --aseg) in a single pass per subject, saved as a long table')
+    parser.add_argument('--parcellations', nargs='+', default=PARCELLATIONS, help=f'parcellations of --all_measures (default: {PARCELLATIONS})')
+    parser.add_argument('--sessions', nargs='+', default=None, help='sessions of --all_measures, in <fs_output_dir>ses-<session>/ '
+                        '(default: all the ses-* dirs, or fs_output_dir itself if there are none)')
+    parser.add_argument('--cache_dir', default=None, help='parsed stats cache of --all_measures (default: <save_dir>/freesurfer_stats_cache)')
+    args = parser.parse_args()
+
     # Read from csv
     fs_output_dir = args.fs_output_dir
     stat_file = args.stat_file
@@ -78,98 +332,72 @@ if __name__ == "__main__":
     save_dir = args.save_dir
     ukbb_dkt_ct_fields = args.ukbb_dkt_ct_fields
     ukbb_aseg_vol_fields = args.ukbb_aseg_vol_fields
+    n_jobs = args.n_jobs
 
     aseg = args.aseg
 
-    ukbb_dkt_ct_fields_df = pd.read_csv(ukbb_dkt_ct_fields)
+    print(f"Starting to collate {'all measures' if args.all_measures else stat_measure} in {fs_output_dir}\n")
 
-    print(f"Starting to collate {stat_measure} in {fs_output_dir}\n")
-    subject_dir_list = glob.glob(f"{fs_output_dir}sub*")
-    subject_id_list = [os.path.basename(x) for x in subject_dir_list]
+    if args.all_measures:
+        session_dirs = get_session_dirs(fs_output_dir, args.sessions)
+        for session_id, session_dir in session_dirs.items():
+            print(f"Found {len(get_subject_ids(session_dir))} subjects in session {session_id if session_id else '(none)'}")
 
-    print(f"Found {len(subject_id_list)} subjects\n")
+        cache_dir = args.cache_dir if args.cache_dir is not None else f"{save_dir}/freesurfer_stats_cache"
+        print(f"\n***Parsing all measures of {args.parcellations}{' and aseg' if aseg else ''}***")
+        stats_df, errors, n_parsed = collate_all_stats(session_dirs, args.parcellations, aseg, n_jobs, cache_dir)
+        print(f"Parsed {n_parsed} new or changed subject sessions, the others were read from {cache_dir}")
 
-    ### cortical surface measures 
-    print(f"***Parsing ASEG subcortical volumes***")
-    hemispheres = ["lh", "rh"]
+        # UKBB field ids (DKT thickness and aseg volumes)
+        ukbb_dkt_ct_fields_df = pd.read_csv(ukbb_dkt_ct_fields) if ukbb_dkt_ct_fields else None
+        ukbb_aseg_vol_fields_df = pd.read_csv(ukbb_aseg_vol_fields) if ukbb_aseg_vol_fields else None
+        stats_df = add_ukbb_field_ids(stats_df, get_ukbb_lookup(ukbb_dkt_ct_fields_df, ukbb_aseg_vol_fields_df))
+        print(f"Number of rows with UKBB field ids: {stats_df['ukbb_field_id'].notna().sum()}")
 
-    hemi_stat_measures_dict = {}
-    for hemi in hemispheres:
-        stat_measure_df = pd.DataFrame()
-        for subject_id in subject_id_list:
-            try:
-                fs_stats_dir = f"{fs_output_dir}{subject_id}/stats/"
-                stats = CorticalParcellationStats.read(f"{fs_stats_dir}{hemi}.{stat_file}").structural_measurements
-                
-                cols = ["subject_id"] + list(stats["structure_name"].values)
-                vals = [subject_id] + list(stats[stat_measure].values)
-                
-                df = pd.DataFrame(columns=cols)
-                df.loc[0] = vals
-                stat_measure_df = pd.concat([stat_measure_df, df], axis=0)
-            except:
-                print(f"Error parsing cortical data for {subject_id} ({hemi})")
+        save_file = f"freesurfer_stats_long.csv"
 
-        # replace columns names with ukbb field IDs
-        field_df = ukbb_dkt_ct_fields_df[ukbb_dkt_ct_fields_df["hemi"]==hemi][["Field ID","roi"]]
-        roi_field_id_dict = dict(zip(field_df["roi"], field_df["Field ID"]))
-        stat_measure_df = stat_measure_df.rename(columns=roi_field_id_dict)
-        
-        hemi_stat_measures_dict[hemi] = stat_measure_df
+        print(f"Saving all stat measures here: {save_dir}/{save_file}")
+        stats_df.to_csv(f"{save_dir}/{save_file}", index=False)
 
-    # merge left and right dfs
-    stat_measure_LR_df = pd.merge(hemi_stat_measures_dict["lh"],hemi_stat_measures_dict["rh"], on="subject_id")
+        # subjects x sessions x ROIs
+        values, subject_ids, session_ids, features_df = get_longitudinal_array(stats_df)
+        save_file = f"freesurfer_stats_longitudinal.npz"
 
-    # Drop columns ommited by DKT atlas
-    if stat_file == "aparc.DKTatlas.stats":
-        drop_ROIs = ["temporalpole","frontalpole","banks of the superior temporal sulcus"]
-        for d_roi in drop_ROIs:
-            if d_roi in stat_measure_LR_df.columns:
-                stat_measure_LR_df = stat_measure_LR_df.drop(columns=[d_roi])
+        print(f"Saving {values.shape} (subjects x sessions x ROIs) array here: {save_dir}/{save_file}\n")
+        save_longitudinal_array(f"{save_dir}/{save_file}", values, subject_ids, session_ids, features_df)
 
-    save_file = f"{stat_file.split('.')[1]}_{stat_measure.rsplit('_',1)[0]}.csv"
+    else:
+        subject_id_list = get_subject_ids(fs_output_dir)
+        print(f"Found {len(subject_id_list)} subjects\n")
 
-    print(f"Saving cortical stat measures here: {save_dir}/{save_file}\n")
-    stat_measure_LR_df.to_csv(f"{save_dir}/{save_file}")
+        ukbb_dkt_ct_fields_df = pd.read_csv(ukbb_dkt_ct_fields)
 
-    # ASEG subcortical volumes
-    if aseg:
-        print(f"***Parsing ASEG subcortical volumes***")
-        stat_file = "aseg.stats"
-        stat_measure = "Volume_mm3"
-
-        # Grab UKBB field ids lookup table
-        ukbb_aseg_vol_fields_df = pd.read_csv(ukbb_aseg_vol_fields)
-        
-        stat_measure_df = pd.DataFrame()
-        for subject_id in subject_id_list:
-            try: 
-                fs_stats_dir = f"{fs_output_dir}{subject_id}/stats/"
-                aseg_file = f"{fs_stats_dir}{stat_file}"
-                stats = parse_aseg(aseg_file,stat_measure)
-                
-                cols = ["subject_id"] + list(stats["hemi_ROI"].values)
-                vals = [subject_id] + list(stats[stat_measure].values)
-                
-                df = pd.DataFrame(columns=cols)
-                df.loc[0] = vals
-                stat_measure_df = pd.concat([stat_measure_df, df], axis=0)
-
-            except:
-                print(f"Error parsing subcortical volumes for {subject_id}")
-
-        
-        field_df = ukbb_aseg_vol_fields_df[ukbb_aseg_vol_fields_df["hemi_ROI"].isin(stat_measure_df.columns)]
-        common_rois = list(field_df["hemi_ROI"].values)
-        roi_field_id_dict = dict(zip(field_df["hemi_ROI"], field_df["Field ID"]))
-
-        print(f"Number of aseg vol ROIs after UKBB merge: {len(roi_field_id_dict)}")
-
-        # Rename ROIs with ukbb ids (remove the ROIs which don't have ukbb ids)
-        stat_measure_df = stat_measure_df[["subject_id"] + common_rois].copy()
-        stat_measure_df = stat_measure_df.rename(columns=roi_field_id_dict)
+        ### cortical surface measures 
+        print(f"***Parsing cortical {stat_measure}***")
+        stat_measure_LR_df, errors = collate_cortical_stats(fs_output_dir, subject_id_list, stat_file, stat_measure,
+                                                            ukbb_dkt_ct_fields_df, n_jobs)
+
+        save_file = f"{stat_file.split('.')[1]}_{stat_measure.rsplit('_',1)[0]}.csv"
+
+        print(f"Saving cortical stat measures here: {save_dir}/{save_file}\n")
+        stat_measure_LR_df.to_csv(f"{save_dir}/{save_file}")
+
+        # ASEG subcortical volumes
+        if aseg:
+            print(f"***Parsing ASEG subcortical volumes***")
+
+            # Grab UKBB field ids lookup table
+            ukbb_aseg_vol_fields_df = pd.read_csv(ukbb_aseg_vol_fields)
+            stat_measure_df, aseg_errors = collate_subcortical_stats(fs_output_dir, subject_id_list, ukbb_aseg_vol_fields_df, n_jobs)
+            errors += aseg_errors
+
+            save_file = f"aseg_subcortical_volumes.csv"
+            
+            print(f"Saving subcortical stat measures here: {save_dir}/{save_file}")
+            stat_measure_df.to_csv(f"{save_dir}/{save_file}")
 
-        save_file = f"aseg_subcortical_volumes.csv"
-        
-        print(f"Saving subcortical stat measures here: {save_dir}/{save_file}")
-        stat_measure_df.to_csv(f"{save_dir}/{save_file}")
+    # Error report (one row per file that could not be parsed)
+    error_file = f"{save_dir}/collate_freesurfer_stats_errors.csv"
+    pd.DataFrame(errors, columns=ERROR_COLUMNS).to_csv(error_file, index=False)
+    if len(errors) > 0:
+        print(f"\n{len(errors)} stats files could not be parsed, see {error_file}")
@@ -0,0 +1,254 @@
+import numpy as np
+import pandas as pd
+import os
+import re
+import time
+import argparse
+from freesurfer_stats import CorticalParcellationStats
+
+HELPTEXT = """
+Single-pass parser of FreeSurfer stats files (aseg.stats, wmparc.stats, ?h.aparc*.stats).
+Run with --check to compare it with freesurfer_stats (cortical files) and the np.loadtxt aseg reader.
+"""
+
+# Sample cmd:
+#  python fs_stats_parser.py --check --fs_output_dir /home/nikhil/projects/brain_changes/data/adni/derivatives/freesurfer-6.0.1/ \
+#                            --stat_files aseg.stats wmparc.stats lh.aparc.stats rh.aparc.DKTatlas.stats
+
+# read_stats returns
+#   headers      {attribute: str} of the "# <attribute> <value>" lines (subjectname, hemi, ...)
+#   measures     {"structure", "name", "description", "unit": str arrays, "value": float64 array} of the "# Measure" lines
+#   columns      {ColHeader: int64 / float64 / str array} of the table
+#   field_names  {ColHeader: column name as in freesurfer_stats} e.g. ThickAvg --> average_thickness_mm
+
+CHECK_STAT_FILES = ["aseg.stats", "wmparc.stats", "lh.aparc.stats", "rh.aparc.stats",
+                    "lh.aparc.a2009s.stats", "rh.aparc.a2009s.stats", "lh.aparc.DKTatlas.stats", "rh.aparc.DKTatlas.stats"]
+MEASURE_KEYS = ["structure", "name", "description", "value", "unit"]
+UKBB_MEASURE_NAMES = {"EstimatedTotalIntraCranialVol": "EstimatedTotalIntraCranial"} # To match UKB field names
+
+def format_field_name(field_name, unit):
+    """ freesurfer_stats column name: lower case field name with unit
+    """
+    column_name = field_name.lower()
+    if unit not in ["unitless", "NA"]:
+        column_name += "_" + unit
+    return re.sub(r"\s+", "_", column_name)
+
+def parse_measure_line(line):
+    """ (structure, name, description, value, unit) of a "Measure <structure>, <name>, <description>, <value>, <unit>" line
+    """
+    body, value, unit = line[len("Measure "):].rsplit(",", 2)
+    structure, rest = body.split(",", 1)
+    name, description = rest.strip().split(None, 1)
+    return structure.strip(), name.rstrip(","), description.strip(), float(value), unit.strip()
+
+def to_typed_array(values):
+    """ int64, float64 or str array of a table column
+    """
+    values = np.array(values, dtype=str)
+    for dtype in [np.int64, np.float64]:
+        try:
+            return values.astype(dtype)
+        except ValueError:
+            pass
+    return values
+
+def read_stats(stats_file):
+    """ headers, global measures and table columns of a FreeSurfer stats file, read in a single pass
+    """
+    headers = {}
+    measures = []
+    table_cols = {}
+    col_headers = None
+    rows = []
+    with open(stats_file, "r") as f:
+        for line in f:
+            if not line.startswith("#"):
+                row = line.split()
+                if row:
+                    rows.append(row)
+                continue
+
+            line = line[1:].strip()
+            if line.startswith("Measure "):
+                measures.append(parse_measure_line(line))
+            elif line.startswith("TableCol "):
+                _, index, key, value = line.split(None, 3)
+                table_cols.setdefault(int(index), {})[key] = value.strip()
+            elif line.startswith("ColHeaders "):
+                col_headers = line.split()[1:]
+            elif line:
+                attr = line.split(None, 1)
+                if attr[0] not in headers:
+                    headers[attr[0]] = attr[1] if len(attr) > 1 else ""
+
+    if col_headers is None:
+        col_headers = [table_cols[i]["ColHeader"] for i in sorted(table_cols.keys())]
+    if not col_headers:
+        raise ValueError(f"{stats_file}: no table header (ColHeaders / TableCol lines)")
+    n_cols = len(col_headers)
+    for i, row in enumerate(rows):
+        if len(row) != n_cols:
+            raise ValueError(f"{stats_file}: table row {i + 1} has {len(row)} values, expected {n_cols}")
+
+    col_values = list(zip(*rows)) if rows else [()] * n_cols
+    columns = {col: to_typed_array(values) for col, values in zip(col_headers, col_values)}
+
+    field_names = {}
+    for i, col in enumerate(col_headers, 1):
+        attrs = table_cols.get(i, {})
+        field_names[col] = format_field_name(attrs["FieldName"], attrs.get("Units", "NA")) if "FieldName" in attrs else col
+
+    measure_values = list(zip(*measures)) if measures else [()] * len(MEASURE_KEYS)
+    measures = {key: np.array(values, dtype=np.float64 if key == "value" else str)
+                for key, values in zip(MEASURE_KEYS, measure_values)}
+
+    return {"headers": headers, "measures": measures, "columns": columns, "field_names": field_names}
+
+def get_structural_measurements(stats):
+    """ Table with the freesurfer_stats column names (e.g. structure_name, average_thickness_mm)
+    """
+    return pd.DataFrame({stats["field_names"][col]: values for col, values in stats["columns"].items()})
+
+def get_whole_brain_measurements(stats):
+    """ {column name: value} of the Measure lines, named as freesurfer_stats whole_brain_measurements
+    """
+    measures = stats["measures"]
+    whole_brain_measurements = {}
+    for name, description, value, unit in zip(measures["name"], measures["description"], measures["value"], measures["unit"]):
+        if name == "SupraTentorialVolNotVent" and description.lower() == "supratentorial volume":
+            description += " Without Ventricles"
+        whole_brain_measurements[format_field_name(description, unit)] = value
+    return whole_brain_measurements
+
+def get_aseg_measurements(stats, stat_measure="Volume_mm3"):
+    """ hemi_ROI and stat_measure (a ColHeader) of the ROIs followed by the global Measure values
+        (same rows as the legacy parse_aseg)
+    """
+    measures = stats["measures"]
+    aseg_df = pd.DataFrame({"hemi_ROI": stats["columns"]["StructName"], stat_measure: stats["columns"][stat_measure]})
+    global_df = pd.DataFrame({"hemi_ROI": pd.Series(measures["structure"]).replace(UKBB_MEASURE_NAMES),
+                              stat_measure: measures["value"]})
+    return pd.concat([aseg_df, global_df], axis=0, ignore_index=True)
+
+def legacy_parse_aseg(aseg_file, stat_measure):
+    """ aseg.stats reader of collate_freesurfer_stats.py before the native parser (reference for --check)
+    """
+    aseg_data = np.loadtxt(aseg_file, dtype="i1,i1,i4,f4,S32,f4,f4,f4,f4,f4")
+
+    aseg_df = pd.DataFrame(data=aseg_data)
+    aseg_df = aseg_df[["f4","f3"]].rename(columns={"f3":stat_measure, "f4":"hemi_ROI"})
+    aseg_df["hemi_ROI"] = aseg_df["hemi_ROI"].str.decode('utf-8')
+
+    # Get global volumes from the "measure" lines
+    file_data = open(aseg_file, 'r')
+    lines = file_data.readlines()
+    measure_lines = []
+    for line in lines:
+        if "Measure" in line:
+            measure_lines.append(line)
+
+    global_df = pd.DataFrame(measure_lines)
+    global_df = global_df.replace('\n','', regex=True)
+    global_df = global_df[0].str.split(",", expand=True)
+    global_df[0] = global_df[0].str.split(" ", expand=True)[2]
+    global_df[0] = global_df[0].replace(UKBB_MEASURE_NAMES)
+    global_df = global_df[[0,3]]
+
+    global_df = global_df.rename(columns = {0:"hemi_ROI",3:stat_measure})
+
+    aseg_df = pd.concat([aseg_df,global_df],axis=0)
+
+    return aseg_df
+
+def compare_tables(df, ref_df):
+    """ mismatch description ("" if the tables match: same columns, same strings, numbers within float32 precision)
+    """
+    if list(df.columns) != list(ref_df.columns):
+        return f"columns differ: {list(df.columns)} vs {list(ref_df.columns)}"
+    if len(df) != len(ref_df):
+        return f"{len(df)} rows vs {len(ref_df)}"
+    for col in df.columns:
+        values = pd.to_numeric(pd.Series(df[col].values), errors="coerce")
+        ref_values = pd.to_numeric(pd.Series(ref_df[col].values), errors="coerce")
+        if values.isna().all() and ref_values.isna().all():
+            if not np.array_equal(df[col].astype(str).str.strip().values, ref_df[col].astype(str).str.strip().values):
+                return f"{col} values differ"
+        elif not np.allclose(values, ref_values, rtol=1e-6, equal_nan=True):
+            return f"{col} max abs diff {np.nanmax(np.abs(values - ref_values))}"
+    return ""
+
+def check_stats_file(stats_file):
+    """ Native parser vs reference reader of a stats file: {file, reference, n_rows, native / reference seconds, mismatch}
+    """
+    start = time.perf_counter()
+    try:
+        stats = read_stats(stats_file)
+    except Exception as e:
+        return {"stats_file": stats_file, "passed": False, "mismatch": f"read_stats failed: {type(e).__name__}: {e}"}
+    native_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = "legacy_parse_aseg" if "SegId" in stats["columns"] else "freesurfer_stats"
+    try:
+        if reference == "legacy_parse_aseg":
+            ref_df = legacy_parse_aseg(stats_file, "Volume_mm3")
+            ref_seconds = time.perf_counter() - start
+            mismatch = compare_tables(get_aseg_measurements(stats, "Volume_mm3"), ref_df)
+        else:
+            ref_stats = CorticalParcellationStats.read(stats_file)
+            ref_seconds = time.perf_counter() - start
+            mismatch = compare_tables(get_structural_measurements(stats), ref_stats.structural_measurements)
+            if not mismatch:
+                # freesurfer_stats skips the first Measure line (read as the end of the headers)
+                ref_whole_brain_df = ref_stats.whole_brain_measurements
+                whole_brain_df = pd.DataFrame([get_whole_brain_measurements(stats)])
+                whole_brain_df = whole_brain_df[[col for col in whole_brain_df.columns if col in ref_whole_brain_df.columns]]
+                mismatch = compare_tables(whole_brain_df, ref_whole_brain_df)
+    except Exception as e:
+        ref_seconds = np.nan
+        mismatch = f"{reference} failed: {type(e).__name__}: {e}"
+
+    n_rows = len(next(iter(stats["columns"].values()), []))
+    return {"stats_file": stats_file, "reference": reference, "n_rows": n_rows, "n_measures": len(stats["measures"]["value"]),
+            "native_seconds": native_seconds, "reference_seconds": ref_seconds, "passed": not mismatch, "mismatch": mismatch}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=HELPTEXT)
+    parser.add_argument('--check', action='store_true', help='compare the native parser with the reference readers')
+    parser.add_argument('--fs_output_dir', help='path to fs_output_dir with all the subjects')
+    parser.add_argument('--stat_files', nargs='+', default=CHECK_STAT_FILES, help='stats files checked for each subject')
+    parser.add_argument('--n_subjects', type=int, default=None, help='number of subjects checked (default: all)')
+    parser.add_argument('--save_dir', default=None, help='path to save the check report (csv)')
+    args = parser.parse_args()
+
+    if not args.check:
+        parser.error("nothing to do (use --check)")
+
+    fs_output_dir = args.fs_output_dir
+    subject_id_list = sorted([subject_id for subject_id in os.listdir(fs_output_dir) if subject_id.startswith("sub")])
+    subject_id_list = subject_id_list[:args.n_subjects]
+
+    records = []
+    for subject_id in subject_id_list:
+        for stat_file in args.stat_files:
+            stats_file = f"{fs_output_dir}/{subject_id}/stats/{stat_file}"
+            if os.path.isfile(stats_file):
+                records.append(check_stats_file(stats_file))
+
+    check_df = pd.DataFrame(records)
+    if len(check_df) == 0:
+        print(f"No stats files found in {fs_output_dir}")
+    else:
+        print(check_df.groupby("reference")[["passed", "native_seconds", "reference_seconds"]].agg(
+            {"passed": ["count", "sum"], "native_seconds": "sum", "reference_seconds": "sum"}))
+        failed_df = check_df[~check_df["passed"]]
+        for record in failed_df.head(10).itertuples():
+            print(f"FAILED {record.stats_file}: {record.mismatch}")
+        if len(failed_df) > 10:
+            print(f"... {len(failed_df) - 10} more failures")
+
+    if args.save_dir is not None:
+        save_file = f"{args.save_dir}/fs_stats_parser_check.csv"
+        print(f"Saving check report here: {save_file}")
+        check_df.to_csv(save_file, index=False)
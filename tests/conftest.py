@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# workflow is imported from the repo root, the tracker and extractor scripts from their own dirs (sibling imports)
+REPO_ROOT = Path(__file__).resolve().parents[1]
+for script_dir in [REPO_ROOT, REPO_ROOT / "trackers", REPO_ROOT / "extractors" / "fmriprep", REPO_ROOT / "extractors" / "freesurfer"]:
+    if str(script_dir) not in sys.path:
+        sys.path.insert(0, str(script_dir))
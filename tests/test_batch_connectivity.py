@@ -0,0 +1,47 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from nilearn import signal
+from nilearn.connectome import ConnectivityMeasure
+from nilearn.maskers import NiftiLabelsMasker
+
+import batch_connectivity
+
+LABELS_IMG = nib.Nifti1Image(np.ones((2, 2, 2), dtype=np.int32), np.eye(4))
+
+def get_inputs(rng, shapes):
+    signals_list = [rng.standard_normal((n_volumes, n_rois)) * 10 + 100 for n_volumes, n_rois, _ in shapes]
+    confounds_list = [rng.standard_normal((n_volumes, n_confounds)) for n_volumes, _, n_confounds in shapes]
+    return signals_list, confounds_list
+
+@pytest.mark.parametrize("standardize", [True, "zscore_sample"])
+def test_clean_signals_match_nilearn(standardize):
+    rng = np.random.default_rng(0)
+    shapes = [(40, 5, 3), (40, 5, 3), (35, 5, 3), (40, 4, 2)]
+    signals_list, confounds_list = get_inputs(rng, shapes)
+    # a rank deficient confound (duplicated column)
+    confounds_list[1][:, 2] = confounds_list[1][:, 0]
+    sample_masks = [None, np.arange(3, 40), None, np.arange(0, 40, 2)]
+
+    cleaned = batch_connectivity.clean_signals(signals_list, confounds_list, sample_masks, standardize)
+    for signals, confounds, sample_mask, batch_cleaned in zip(signals_list, confounds_list, sample_masks, cleaned):
+        expected = signal.clean(signals, confounds=confounds, sample_mask=sample_mask, detrend=False,
+                                standardize=standardize, standardize_confounds=True)
+        np.testing.assert_allclose(batch_cleaned, expected, atol=1e-8)
+
+def test_correlations_match_nilearn():
+    rng = np.random.default_rng(0)
+    time_series_list = [rng.standard_normal(shape) for shape in [(40, 5), (40, 5), (30, 5), (40, 1)]]
+    correlations = batch_connectivity.get_correlations(time_series_list)
+    for time_series, correlation in zip(time_series_list, correlations):
+        expected = ConnectivityMeasure(kind="correlation").fit_transform([time_series])[0]
+        np.testing.assert_allclose(correlation, expected, atol=1e-10)
+
+@pytest.mark.parametrize("masker_params,expected", [
+    ({"standardize": True}, True),
+    ({"standardize": True, "detrend": True}, False),
+    ({"standardize": True, "high_pass": 0.01, "t_r": 2}, False),
+    ({"standardize": "psc"}, False),
+])
+def test_can_batch_clean(masker_params, expected):
+    assert batch_connectivity.can_batch_clean(NiftiLabelsMasker(labels_img=LABELS_IMG, **masker_params)) == expected
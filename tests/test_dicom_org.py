@@ -0,0 +1,71 @@
+import json
+import logging
+
+import pandas as pd
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from workflow import dag
+from workflow.dicom_org import run_dicom_org
+from workflow.utils import COL_ORG_STATUS, COLS_STATUS, load_status
+
+logger = logging.getLogger(__name__)
+
+def write_dicom(dcm_file, image_type="ORIGINAL"):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.ImageType = [image_type, "PRIMARY"]
+    dcm_file.parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(dcm_file, enforce_file_format=True)
+
+def make_dataset(dataset_root):
+    """ One downloaded (not yet organized) participant with a valid and a derived dicom
+    """
+    raw_participant_dir = dataset_root / "scratch" / "raw_dicom" / "ses-1" / "MNI_001"
+    write_dicom(raw_participant_dir / "series1" / "img1.dcm")
+    write_dicom(raw_participant_dir / "series2" / "img2.dcm", image_type="DERIVED")
+
+    status_df = pd.DataFrame([["MNI_001", "ses-1", "MNI_001", "MNI001", "sub-MNI001", True, False, False]], columns=COLS_STATUS)
+    status_df.to_csv(dataset_root / "scratch" / "raw_dicom" / "doughnut.csv", index=False)
+    return {"DATASET_ROOT": str(dataset_root)}
+
+def test_get_dicom_org_dirs(tmp_path):
+    raw_dicom_dir, dicom_dir, log_dir, invalid_dicom_dir = run_dicom_org.get_dicom_org_dirs({"DATASET_ROOT": str(tmp_path)}, "ses-1")
+    assert raw_dicom_dir == f"{tmp_path}/scratch/raw_dicom/ses-1/"
+    assert dicom_dir == f"{tmp_path}/dicom/ses-1/"
+    assert log_dir == f"{tmp_path}/scratch/logs/"
+    assert invalid_dicom_dir.startswith(log_dir)
+
+def test_dag_dicom_org(tmp_path):
+    global_configs = make_dataset(tmp_path)
+
+    tasks = dag.run(global_configs, ["1"], [dag.STAGE_DICOM_ORG], 1, logger, skip_dcm_check=True)
+    assert [task.status for task in tasks.values()] == [dag.SUCCESS]
+
+    assert sorted(p.name for p in (tmp_path / "dicom" / "ses-1" / "MNI001").iterdir()) == ["img1.dcm"]
+    with open(tmp_path / "scratch" / "logs" / "invalid_dicom_dir" / "MNI_001_invalid_dicoms.json") as f:
+        assert len(json.load(f)["MNI_001"]) == 1
+
+    # the status file is updated as soon as the task is done
+    fpath_status = tmp_path / "scratch" / "raw_dicom" / "doughnut.csv"
+    assert load_status(fpath_status)[COL_ORG_STATUS].tolist() == [True]
+    with open(dag.get_task_status_file(global_configs)) as f:
+        assert [json.loads(line)["status"] for line in f] == [dag.SUCCESS]
+    assert len(dag.build_tasks(global_configs, ["1"], [dag.STAGE_DICOM_ORG], logger)) == 0
+
+def test_status_file_reset(tmp_path):
+    global_configs = make_dataset(tmp_path)
+    dag.run(global_configs, ["1"], [dag.STAGE_DICOM_ORG], 1, logger, skip_dcm_check=True)
+
+    # a participant reset in the status file is scheduled again, whatever the task log says
+    fpath_status = tmp_path / "scratch" / "raw_dicom" / "doughnut.csv"
+    status_df = load_status(fpath_status)
+    status_df[COL_ORG_STATUS] = False
+    fpath_status.unlink()
+    status_df.to_csv(fpath_status, index=False)
+
+    tasks = dag.build_tasks(global_configs, ["1"], [dag.STAGE_DICOM_ORG], logger)
+    assert [task.status for task in tasks.values()] == [dag.PENDING]
@@ -0,0 +1,53 @@
+import numpy as np
+from sklearn.covariance import GraphicalLasso
+
+import fc_estimators
+
+def get_time_series_list(n_bold=4, n_volumes=60, n_rois=5):
+    rng = np.random.default_rng(0)
+    mixing = rng.standard_normal((n_rois, n_rois))
+    return [rng.standard_normal((n_volumes, n_rois)) @ mixing for _ in range(n_bold)]
+
+def test_select_pilot():
+    bold_files = [f"sub-{i:02d}_bold.nii.gz" for i in range(20)]
+    assert fc_estimators.select_pilot(bold_files[:5], pilot_size=10) == bold_files[:5]
+    pilot = fc_estimators.select_pilot(reversed(bold_files), pilot_size=4)
+    assert pilot == [bold_files[i] for i in [0, 6, 13, 19]]
+
+def test_pilot_modes():
+    time_series_list = get_time_series_list()
+    pilot = fc_estimators.fit_pilot(time_series_list[:2], ["a", "b"], "pilot")
+    assert pilot["alpha"] > 0
+
+    covariance, precision, alpha = fc_estimators.estimate_precision(time_series_list[2], "pilot", pilot)
+    assert alpha == pilot["alpha"]
+    np.testing.assert_allclose(precision, GraphicalLasso(alpha=alpha).fit(time_series_list[2]).precision_)
+
+    # the pilot key changes with the pilot BOLD files
+    assert fc_estimators.fit_pilot(time_series_list[:2], ["a", "c"], "pilot", alphas=[pilot["alpha"]] * 2)["pilot_key"] != pilot["pilot_key"]
+
+def test_warm_mode_is_deterministic():
+    time_series_list = get_time_series_list()
+    pilot = fc_estimators.fit_pilot(time_series_list[:2], ["a", "b"], "warm")
+
+    # the same precision whatever was estimated before in the process
+    first = fc_estimators.estimate_precision(time_series_list[3], "warm", pilot)
+    for time_series in time_series_list[:3]:
+        fc_estimators.estimate_precision(time_series, "warm", pilot)
+    second = fc_estimators.estimate_precision(time_series_list[3], "warm", pilot)
+    np.testing.assert_array_equal(first[1], second[1])
+    assert first[2] in list(pilot["alpha"] * fc_estimators.WARM_GRID)
+
+def test_save_load_pilot(tmp_path):
+    time_series_list = get_time_series_list()
+    pilot_file = fc_estimators.get_pilot_file(f"{tmp_path}/FC_atlas-schaefer_desc-no_motion.h5")
+    pilot = fc_estimators.fit_pilot(time_series_list[:2], ["a", "b"], "pilot", tangent=True, alphas=[0.1, 0.3])
+    fc_estimators.save_pilot(pilot_file, pilot)
+
+    loaded = fc_estimators.load_pilot(pilot_file, "pilot", tangent=True)
+    assert loaded["pilot_key"] == pilot["pilot_key"]
+    np.testing.assert_allclose(fc_estimators.get_tangent(time_series_list[2], loaded),
+                               fc_estimators.get_tangent(time_series_list[2], pilot))
+    # a pilot fitted for another mode is not reused
+    assert fc_estimators.load_pilot(pilot_file, "warm") is None
+    assert fc_estimators.load_pilot(pilot_file, "pilot")["pilot_key"] != pilot["pilot_key"]
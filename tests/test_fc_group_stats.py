@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import fc_group_stats
+import fc_store
+
+ROI_LABELS = ["roi1", "roi2", "roi3"]
+
+def make_store(tmp_path, n_subjects=7):
+    rng = np.random.default_rng(0)
+    store_file = fc_store.get_store_file(tmp_path, "schaefer", "no_motion")
+    covariances = [np.cov(rng.standard_normal((20, 3)), rowvar=False) for _ in range(n_subjects)]
+    fc_store.write_rows(store_file, [{"bold_prefix": f"sub-{i:02d}_task-rest", "input_key": "", "covariance": covariance}
+                                     for i, covariance in enumerate(covariances)], ROI_LABELS)
+    # edges then diagonal, as stored (float32)
+    vecs = np.array([np.concatenate([fc_store.matrix_to_vec(c), np.diag(c).astype(np.float32)]) for c in covariances], dtype=np.float64)
+    return store_file, vecs
+
+def test_merge_stats():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((50, 4))
+    stats = fc_group_stats.init_stats(4)
+    for block in np.array_split(x, [1, 20, 21]):
+        stats = fc_group_stats.update_stats(stats, block)
+    assert stats["n"] == 50
+    np.testing.assert_allclose(stats["mean"], x.mean(axis=0))
+    np.testing.assert_allclose(stats["M2"] / (stats["n"] - 1), x.var(axis=0, ddof=1))
+
+@pytest.mark.parametrize("n_jobs,block_size", [(1, 256), (1, 2), (3, 2)])
+def test_aggregate_groups(tmp_path, n_jobs, block_size):
+    store_file, vecs = make_store(tmp_path)
+    groups = np.array(["A", "B", "A", None, "B", "A", "ALL"], dtype=object)
+    bids_id_groups = {f"sub-{i:02d}": group for i, group in enumerate(groups) if group is not None}
+
+    results = fc_group_stats.aggregate_groups(store_file, "covariance", bids_id_groups, n_jobs, block_size)
+    # a group called ALL is kept apart from the statistics of all rows
+    assert sorted(results.keys()) == sorted(["A", "ALL", "B", fc_group_stats.ALL_GROUP])
+    for group, rows in [("A", groups == "A"), ("B", groups == "B"), ("ALL", groups == "ALL"),
+                        (fc_group_stats.ALL_GROUP, np.ones(len(groups), dtype=bool))]:
+        assert results[group]["n"] == rows.sum()
+        np.testing.assert_allclose(results[group]["mean"], vecs[rows].mean(axis=0), rtol=1e-6)
+        if rows.sum() > 1:
+            np.testing.assert_allclose(results[group]["var"], vecs[rows].var(axis=0, ddof=1), rtol=1e-6)
+        else:
+            assert np.isnan(results[group]["var"]).all()
+
+    matrices = fc_group_stats.get_group_matrices(results, len(ROI_LABELS))
+    np.testing.assert_allclose(np.diag(matrices["A"]["mean"]), vecs[groups == "A"][:, 3:].mean(axis=0), rtol=1e-6)
+
+def test_reserved_group(tmp_path):
+    store_file, _ = make_store(tmp_path)
+    with pytest.raises(ValueError):
+        fc_group_stats.aggregate_groups(store_file, "covariance", {"sub-00": fc_group_stats.ALL_GROUP})
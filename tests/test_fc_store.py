@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import fc_store
+
+ROI_LABELS = ["roi1", "roi2", "roi3", "roi4"]
+
+def random_matrix(rng, n_rois=len(ROI_LABELS)):
+    x = rng.standard_normal((20, n_rois))
+    return np.cov(x, rowvar=False)
+
+def get_row(bold_prefix, matrices):
+    row = {"bold_prefix": bold_prefix, "input_key": f"key-{bold_prefix}"}
+    row.update(matrices)
+    return row
+
+def test_matrix_vec_round_trip():
+    matrix = random_matrix(np.random.default_rng(0))
+    vec = fc_store.matrix_to_vec(matrix)
+    assert vec.shape == (6,)
+    np.testing.assert_allclose(fc_store.vec_to_matrix(vec, 4, np.diag(matrix)), matrix, rtol=1e-6)
+
+def test_write_rows(tmp_path):
+    rng = np.random.default_rng(0)
+    store_file = fc_store.get_store_file(tmp_path, "schaefer", "no_motion")
+    assert len(fc_store.read_index(store_file)) == 0
+
+    covariance = random_matrix(rng)
+    correlation = np.corrcoef(rng.standard_normal((20, 4)), rowvar=False)
+    fc_store.write_rows(store_file, [
+        get_row("sub-01_ses-01_task-rest_run-1", {"correlation": correlation, "covariance": covariance}),
+        get_row("sub-02_ses-01_task-rest_run-1", {"correlation": correlation, "covariance": covariance}),
+    ], ROI_LABELS)
+
+    index_df = fc_store.read_index(store_file)
+    assert index_df["participant_id"].tolist() == ["sub-01", "sub-02"]
+    assert index_df["session_id"].tolist() == ["01", "01"]
+    assert list(fc_store.load_roi_labels(store_file)) == ROI_LABELS
+    np.testing.assert_allclose(fc_store.load_matrix(store_file, "correlation", "sub-02_ses-01_task-rest_run-1"), correlation, rtol=1e-6)
+    # the diagonal of covariances is stored too
+    np.testing.assert_allclose(fc_store.load_matrix(store_file, "covariance", "sub-01_ses-01_task-rest_run-1"), covariance, rtol=1e-6)
+
+    # rows are replaced on bold_prefix, and new measures are added to the existing rows
+    new_correlation = np.corrcoef(rng.standard_normal((20, 4)), rowvar=False)
+    fc_store.write_rows(store_file, [
+        get_row("sub-01_ses-01_task-rest_run-1", {"correlation": new_correlation, "precision": np.linalg.inv(covariance)}),
+        get_row("sub-03_ses-02_task-rest_run-1", {"correlation": correlation}),
+    ], ROI_LABELS)
+    index_df, vecs = fc_store.load_measure(store_file, "correlation")
+    assert index_df["bold_prefix"].tolist() == ["sub-01_ses-01_task-rest_run-1", "sub-02_ses-01_task-rest_run-1", "sub-03_ses-02_task-rest_run-1"]
+    np.testing.assert_allclose(vecs[0], fc_store.matrix_to_vec(new_correlation))
+    _, precision_vecs = fc_store.load_measure(store_file, "precision", ["sub-01_ses-01_task-rest_run-1"])
+    np.testing.assert_allclose(precision_vecs[0], fc_store.matrix_to_vec(np.linalg.inv(covariance)))
+
+    with pytest.raises(ValueError):
+        fc_store.write_rows(store_file, [get_row("sub-04", {"correlation": np.eye(3)})], ROI_LABELS[:3])
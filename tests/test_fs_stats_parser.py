@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from freesurfer_stats import CorticalParcellationStats
+
+import fs_stats_parser
+
+STATS_DIR = Path(__file__).parent / "data" / "freesurfer" / "sub-0001" / "stats"
+ASEG_FILE = str(STATS_DIR / "aseg.stats")
+APARC_FILE = str(STATS_DIR / "lh.aparc.stats")
+
+def write_modified(src_file, dst_file, modify):
+    lines = Path(src_file).read_text().splitlines(keepends=True)
+    Path(dst_file).write_text("".join(modify(lines)))
+    return str(dst_file)
+
+def test_read_aseg():
+    stats = fs_stats_parser.read_stats(ASEG_FILE)
+    assert stats["headers"]["subjectname"] == "sub-0001"
+    assert stats["columns"]["SegId"].dtype == np.int64
+    assert stats["columns"]["StructName"][0] == "Left-Lateral-Ventricle"
+    assert stats["field_names"]["Volume_mm3"] == "volume_mm^3"
+
+    aseg_df = fs_stats_parser.get_aseg_measurements(stats, "Volume_mm3")
+    ref_df = fs_stats_parser.legacy_parse_aseg(ASEG_FILE, "Volume_mm3")
+    assert fs_stats_parser.compare_tables(aseg_df, ref_df) == ""
+    assert list(aseg_df.columns) == ["hemi_ROI", "Volume_mm3"]
+    # global measures follow the ROIs, with the UKBB names
+    assert aseg_df["hemi_ROI"].tolist()[-1] == "EstimatedTotalIntraCranial"
+
+def test_read_aparc():
+    stats = fs_stats_parser.read_stats(APARC_FILE)
+    ref_stats = CorticalParcellationStats.read(APARC_FILE)
+    assert stats["headers"]["hemi"] == "lh"
+
+    structural_df = fs_stats_parser.get_structural_measurements(stats)
+    assert list(structural_df.columns) == list(ref_stats.structural_measurements.columns)
+    assert fs_stats_parser.compare_tables(structural_df, ref_stats.structural_measurements) == ""
+    assert structural_df["average_thickness_mm"].dtype == np.float64
+
+    whole_brain = fs_stats_parser.get_whole_brain_measurements(stats)
+    for col, value in ref_stats.whole_brain_measurements.iloc[0].items():
+        assert whole_brain[col] == pytest.approx(value)
+
+@pytest.mark.parametrize("stats_file", [ASEG_FILE, APARC_FILE])
+def test_check_stats_file(stats_file):
+    record = fs_stats_parser.check_stats_file(stats_file)
+    assert record["passed"], record["mismatch"]
+
+def test_table_header_from_table_cols(tmp_path):
+    # ColHeaders line missing: the header comes from the TableCol lines
+    stats_file = write_modified(APARC_FILE, tmp_path / "lh.aparc.stats",
+                                lambda lines: [line for line in lines if not line.startswith("# ColHeaders")])
+    stats = fs_stats_parser.read_stats(stats_file)
+    assert list(stats["columns"]) == list(fs_stats_parser.read_stats(APARC_FILE)["columns"])
+
+def test_missing_table_header(tmp_path):
+    stats_file = write_modified(APARC_FILE, tmp_path / "lh.aparc.stats",
+                                lambda lines: [line for line in lines if not line.startswith(("# ColHeaders", "# TableCol"))])
+    with pytest.raises(ValueError, match="no table header"):
+        fs_stats_parser.read_stats(stats_file)
+
+def test_malformed_row(tmp_path):
+    # a truncated table row
+    stats_file = write_modified(ASEG_FILE, tmp_path / "aseg.stats", lambda lines: lines[:-1] + [" ".join(lines[-1].split()[:-2]) + "\n"])
+    with pytest.raises(ValueError, match="expected 10"):
+        fs_stats_parser.read_stats(stats_file)
+
+    record = fs_stats_parser.check_stats_file(stats_file)
+    assert not record["passed"]
+    assert record["mismatch"].startswith("read_stats failed: ValueError")
@@ -0,0 +1,64 @@
+import mriqc_tracker
+from tracker import dir_snapshot
+from workflow.proc_pipe.mriqc import run_mriqc
+from workflow.proc_pipe.mriqc.mriqc_outputs import MRIQC_SUCCESS_MSG, check_iqm_files
+
+def write_iqm(mriqc_out_dir, bids_id, session, datatype, suffix):
+    iqm_file = mriqc_out_dir / bids_id / session / datatype / f"{bids_id}_{session}_{suffix}.json"
+    iqm_file.parent.mkdir(parents=True, exist_ok=True)
+    iqm_file.write_text("{}")
+    return iqm_file
+
+def test_check_iqm_files():
+    rel_paths = ["mriqc_out_01.log", "ses-1/anat/sub-01_ses-1_T1w.json", "ses-1/func/sub-01_ses-1_task-rest_run-1_bold.json"]
+    assert check_iqm_files(rel_paths, "sub-01", "1")
+    assert check_iqm_files(rel_paths, "sub-01", "ses-1", "*T1w")
+    assert check_iqm_files(rel_paths, "sub-01", "1", "task-rest*_bold")
+    assert not check_iqm_files(rel_paths, "sub-01", "2")
+    assert not check_iqm_files(rel_paths, "sub-010", "1")
+    assert not check_iqm_files(rel_paths, "sub-01", "1", "*dwi")
+
+def test_check_mriqc_outputs(tmp_path):
+    assert not run_mriqc.check_mriqc_outputs(tmp_path, "sub-01", "1")
+    write_iqm(tmp_path, "sub-01", "ses-1", "anat", "T1w")
+    assert run_mriqc.check_mriqc_outputs(tmp_path, "sub-01", "1")
+    assert not run_mriqc.check_mriqc_outputs(tmp_path, "sub-01", "2")
+
+def test_split_log_marks_only_completed_participants(tmp_path):
+    write_iqm(tmp_path, "sub-01", "ses-1", "anat", "T1w")
+    batch_log = tmp_path / "batch.log"
+    batch_log.write_text(
+        "230321-14:20:05,123 nipype.workflow INFO: sub-01 started\n"
+        "230321-14:20:06,123 nipype.workflow INFO: sub-010 started\n"
+        "230321-14:20:07,123 nipype.workflow INFO: shared line\n"
+        f"{MRIQC_SUCCESS_MSG}\n"
+    )
+    run_mriqc.split_log(batch_log, ["sub-01", "sub-010"], "1", tmp_path)
+
+    log_01 = run_mriqc.get_participant_log(tmp_path, "sub-01")
+    log_010 = run_mriqc.get_participant_log(tmp_path, "sub-010")
+    assert log_01.name == "mriqc_out_01.log"
+    assert "sub-010 started" not in log_01.read_text()
+    assert "shared line" in log_010.read_text()
+    assert run_mriqc.check_mriqc_log(log_01)
+    assert not run_mriqc.check_mriqc_log(log_010)
+
+def test_tracker_agrees_with_runner(tmp_path):
+    subject_dir = tmp_path / "sub-01"
+    write_iqm(tmp_path, "sub-01", "ses-1", "anat", "T1w")
+    log_file = run_mriqc.get_participant_log(tmp_path, "sub-01")
+    log_file.write_text(f"{MRIQC_SUCCESS_MSG}\n")
+
+    assert run_mriqc.check_mriqc_outputs(tmp_path, "sub-01", "1")
+    with dir_snapshot(str(subject_dir)):
+        assert mriqc_tracker.eval_mriqc(str(subject_dir), "1") == mriqc_tracker.SUCCESS
+        assert mriqc_tracker.check_bold(str(subject_dir), "1") == mriqc_tracker.FAIL
+        assert mriqc_tracker.eval_mriqc(str(subject_dir), "2") == mriqc_tracker.FAIL
+
+    write_iqm(tmp_path, "sub-01", "ses-1", "func", "task-rest_bold")
+    assert mriqc_tracker.check_bold(str(subject_dir), "1") == mriqc_tracker.SUCCESS
+
+def test_tracker_requires_success_log(tmp_path):
+    subject_dir = tmp_path / "sub-01"
+    write_iqm(tmp_path, "sub-01", "ses-1", "anat", "T1w")
+    assert mriqc_tracker.eval_mriqc(str(subject_dir), "1") == mriqc_tracker.FAIL
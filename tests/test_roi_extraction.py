@@ -0,0 +1,59 @@
+import numpy as np
+import nibabel as nib
+from nilearn.maskers import NiftiLabelsMasker, NiftiSpheresMasker
+
+import roi_extraction
+
+AFFINE = np.diag([3.0, 3.0, 3.0, 1.0])
+
+def make_bold(tmp_path, shape=(8, 9, 7), n_volumes=30):
+    rng = np.random.default_rng(0)
+    bold = tmp_path / "sub-01_task-rest_bold.nii.gz"
+    nib.Nifti1Image(rng.standard_normal(shape + (n_volumes,)).astype(np.float32), AFFINE).to_filename(bold)
+    return str(bold)
+
+def make_labels_img(shape=(8, 9, 7)):
+    labels = np.zeros(shape, dtype=np.int32)
+    labels[:4, :, :] = 1
+    labels[4:, :5, :] = 2
+    labels[4:, 5:, 3:] = 3
+    return nib.Nifti1Image(labels, AFFINE)
+
+def test_labels_signals_match_masker(tmp_path):
+    bold = make_bold(tmp_path)
+    masker = NiftiLabelsMasker(labels_img=make_labels_img(), standardize=True)
+    confounds = np.random.default_rng(1).standard_normal((30, 2))
+    expected = masker.fit_transform(bold, confounds=confounds)
+
+    signals = roi_extraction.extract_roi_signals(bold, masker, cache_dir=str(tmp_path / "atlas_cache"))
+    np.testing.assert_allclose(roi_extraction.clean_roi_signals(signals, masker, confounds), expected, atol=1e-5)
+
+    # the ROI weights are reused from the atlas cache
+    roi_extraction._roi_weights_cache.clear()
+    cached_signals = roi_extraction.extract_roi_signals(bold, masker, cache_dir=str(tmp_path / "atlas_cache"))
+    np.testing.assert_allclose(cached_signals, signals)
+
+def test_sphere_signals_match_masker(tmp_path):
+    bold = make_bold(tmp_path)
+    masker = NiftiSpheresMasker(seeds=[(6.0, 6.0, 6.0), (15.0, 18.0, 9.0)], radius=4.0, standardize=True)
+    expected = masker.fit_transform(bold)
+
+    signals = roi_extraction.extract_roi_signals(bold, masker)
+    np.testing.assert_allclose(roi_extraction.clean_roi_signals(signals, masker), expected, atol=1e-5)
+
+def test_chunked_read(tmp_path):
+    bold = make_bold(tmp_path)
+    masker = NiftiLabelsMasker(labels_img=make_labels_img())
+
+    whole = roi_extraction.extract_roi_signals(bold, masker, chunk_size=0)
+    for chunk_size in [1, 7, 64]:
+        np.testing.assert_allclose(roi_extraction.extract_roi_signals(bold, masker, chunk_size=chunk_size), whole)
+
+def test_multi_atlas_signals(tmp_path):
+    bold = make_bold(tmp_path)
+    maskers = [NiftiLabelsMasker(labels_img=make_labels_img()),
+               NiftiSpheresMasker(seeds=[(6.0, 6.0, 6.0)], radius=4.0)]
+
+    signals = roi_extraction.extract_multi_roi_signals(bold, maskers, chunk_size=7)
+    for atlas_signals, masker in zip(signals, maskers):
+        np.testing.assert_allclose(atlas_signals, roi_extraction.extract_roi_signals(bold, masker, chunk_size=0))
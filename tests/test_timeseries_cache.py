@@ -0,0 +1,44 @@
+import numpy as np
+
+import timeseries_cache
+
+def make_bold(func_dir):
+    bold = func_dir / "sub-01_ses-01_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    func_dir.mkdir(parents=True)
+    bold.write_bytes(b"bold")
+    (func_dir / "sub-01_ses-01_task-rest_desc-confounds_timeseries.tsv").write_text("a\tb\n")
+    return str(bold)
+
+def test_cache_key(tmp_path):
+    bold = make_bold(tmp_path / "func")
+    params = {"masker": {"standardize": True, "detrend": False}, "confounds": {"strategy": ["motion"]}}
+    key = timeseries_cache.get_cache_key(bold, "schaefer", "no_motion", params)
+    assert timeseries_cache.get_cache_key(bold, "schaefer", "no_motion", dict(reversed(list(params.items())))) == key
+
+    assert timeseries_cache.get_cache_key(bold, "schaefer", "no_motion_no_gsr", params) != key
+    other_params = {"masker": {"standardize": True, "detrend": True}, "confounds": {"strategy": ["motion"]}}
+    assert timeseries_cache.get_cache_key(bold, "schaefer", "no_motion", other_params) != key
+
+    # the confounds file is an input of the cached time series
+    (tmp_path / "func" / "sub-01_ses-01_task-rest_desc-confounds_timeseries.tsv").write_text("a\tb\tc\n")
+    assert timeseries_cache.get_cache_key(bold, "schaefer", "no_motion", params) != key
+
+def test_get_time_series(tmp_path):
+    bold = make_bold(tmp_path / "func")
+    cache_dir = str(tmp_path / "timeseries")
+    rng = np.random.default_rng(0)
+    calls = []
+    def extract():
+        calls.append(1)
+        return rng.standard_normal((20, 4)), np.arange(2, 20)
+
+    params = {"masker": {"standardize": True}}
+    time_series, sample_mask = timeseries_cache.get_time_series(bold, "schaefer", "no_motion", cache_dir, extract, params)
+    cached_time_series, cached_sample_mask = timeseries_cache.get_time_series(bold, "schaefer", "no_motion", cache_dir, extract, params)
+    assert len(calls) == 1
+    # stored as float32
+    np.testing.assert_allclose(cached_time_series, time_series, rtol=1e-6)
+    np.testing.assert_array_equal(cached_sample_mask, sample_mask)
+
+    timeseries_cache.get_time_series(bold, "schaefer", "no_motion", cache_dir, extract, {"masker": {"standardize": False}})
+    assert len(calls) == 2
@@ -0,0 +1,126 @@
+import os
+
+import pandas as pd
+
+import run_tracker
+import watch_tracker
+from tracker import get_dir_fingerprint, load_tracker_cache, save_tracker_cache
+
+def make_subject_dir(subject_dir):
+    (subject_dir / "log").mkdir(parents=True)
+    (subject_dir / "anat").mkdir()
+    (subject_dir / "run.log").write_text("start\n")
+    (subject_dir / "log" / "fmriprep_out.log").write_text("start\n")
+    (subject_dir / "anat" / "T1w.nii.gz").write_text("")
+    return subject_dir
+
+def append(log_file, text):
+    # same mtime as before: only the size tells the change apart
+    stat = os.stat(log_file)
+    with open(log_file, "a") as f:
+        f.write(text)
+    os.utime(log_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def test_dir_fingerprint(tmp_path):
+    subject_dir = make_subject_dir(tmp_path / "sub-01")
+    fingerprint = get_dir_fingerprint(subject_dir)
+    assert get_dir_fingerprint(subject_dir) == fingerprint
+
+    append(subject_dir / "log" / "fmriprep_out.log", "done\n")
+    assert get_dir_fingerprint(subject_dir) != fingerprint
+
+    fingerprint = get_dir_fingerprint(subject_dir)
+    (subject_dir / "func").mkdir()
+    assert get_dir_fingerprint(subject_dir) != fingerprint
+
+def test_tracker_cache(tmp_path):
+    cache_file = f"{tmp_path}/cache/mriqc_v1_ses-1.json"
+    assert load_tracker_cache(cache_file, ["pipeline_complete"]) == {}
+
+    subjects = {"sub-01": {"fingerprint": "abc", "record": {"bids_id": "sub-01", "pipeline_complete": "SUCCESS"}}}
+    save_tracker_cache(cache_file, ["pipeline_complete"], subjects)
+    assert load_tracker_cache(cache_file, ["pipeline_complete"]) == subjects
+    # a cache made with other checks is discarded
+    assert load_tracker_cache(cache_file, ["pipeline_complete", "STAGE_MRIQC_BOLD"]) == {}
+
+def test_check_subject_reuses_cached_record(tmp_path):
+    subject_dir = make_subject_dir(tmp_path / "sub-01")
+    calls = []
+    def check(subject_dir, session_id, run_id):
+        calls.append(subject_dir)
+        return run_tracker.SUCCESS
+    status_check_dict = {"pipeline_complete": check}
+
+    record, fingerprint = run_tracker.check_subject("sub-01", "01", str(subject_dir), "1", status_check_dict, 1)
+    assert record["pipeline_complete"] == run_tracker.SUCCESS
+    assert len(calls) == 1
+
+    cached = {"fingerprint": fingerprint, "record": record}
+    cached_record, _ = run_tracker.check_subject("sub-01", "01", str(subject_dir), "1", status_check_dict, 1, cached=cached)
+    assert cached_record == record
+    assert len(calls) == 1
+
+    append(subject_dir / "run.log", "done\n")
+    run_tracker.check_subject("sub-01", "01", str(subject_dir), "1", status_check_dict, 1, cached=cached)
+    assert len(calls) == 2
+
+    record, fingerprint = run_tracker.check_subject("sub-02", "02", str(tmp_path / "sub-02"), "1", status_check_dict, 1)
+    assert record["pipeline_complete"] == run_tracker.UNAVAILABLE
+    assert fingerprint is None
+
+def get_bagel_df(rows):
+    columns = ["bids_id", "pipeline_name", "pipeline_version", "session", "pipeline_complete"]
+    return pd.DataFrame(rows, columns=columns).set_index("bids_id")
+
+def test_upsert_bagel(tmp_path):
+    tracker_csv = tmp_path / "bagel.csv"
+    run_tracker.upsert_bagel(get_bagel_df([
+        ["sub-01", "mriqc", "23.1.0", "1", "FAIL"],
+        ["sub-02", "mriqc", "23.1.0", "1", "FAIL"],
+        ["sub-01", "mriqc", "23.1.0", "2", "FAIL"],
+        ["sub-01", "fmriprep", "20.2.7", "1", "SUCCESS"],
+    ]), tracker_csv)
+
+    # rows of the same (bids_id, pipeline, version, session) are replaced, the others are kept
+    run_tracker.upsert_bagel(get_bagel_df([
+        ["sub-01", "mriqc", "23.1.0", "1", "SUCCESS"],
+        ["sub-03", "mriqc", "23.1.0", "1", "SUCCESS"],
+    ]), tracker_csv)
+
+    bagel_df = pd.read_csv(tracker_csv, dtype=str)
+    assert len(bagel_df) == 5
+    status = bagel_df.set_index(["bids_id", "pipeline_name", "session"])["pipeline_complete"]
+    assert status[("sub-01", "mriqc", "1")] == "SUCCESS"
+    assert status[("sub-02", "mriqc", "1")] == "FAIL"
+    assert status[("sub-01", "mriqc", "2")] == "FAIL"
+    assert status[("sub-01", "fmriprep", "1")] == "SUCCESS"
+    assert status[("sub-03", "mriqc", "1")] == "SUCCESS"
+
+class FailingINotify:
+    """ add_watch fails for the dirs of a subject (e.g. max_user_watches reached)
+    """
+    def __init__(self, failing_subject):
+        self.failing_subject = failing_subject
+        self.n_watches = 0
+
+    def add_watch(self, dpath, mask):
+        if self.failing_subject in dpath:
+            raise OSError(28, "No space left on device")
+        self.n_watches += 1
+        return self.n_watches
+
+def test_unwatched_subtrees_are_polled(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch_tracker, "WATCH_FLAGS", 0, raising=False)
+    output_root = tmp_path / "output"
+    for bids_id in ["sub-01", "sub-02"]:
+        make_subject_dir(output_root / bids_id)
+
+    watcher = watch_tracker.InotifyWatcher.__new__(watch_tracker.InotifyWatcher)
+    watcher.inotify = FailingINotify("sub-02")
+    watcher.wd_paths = {}
+    watcher.unwatched_dirs = set()
+    watcher.add_watches(str(output_root))
+
+    assert watcher.unwatched_dirs == {str(output_root / "sub-02")}
+    assert not any("sub-02" in dpath for dpath in watcher.wd_paths.values())
+    assert watcher.get_unwatched_subjects(str(output_root), ["sub-01", "sub-02"]) == ["sub-02"]
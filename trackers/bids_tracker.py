@@ -3,92 +3,184 @@ import pandas as pd
 from pathlib import Path
 import argparse
 import glob
-from bids import BIDSLayout 
+import json
+import hashlib
+from joblib import Parallel, delayed
 import os
 
 
 HELPTEXT = """
-Script to check participant-session availability 
+Script to check participant-session availability
 """
 #Author: nikhil153
-#Date: 1-Dec-2022 
+#Date: 1-Dec-2022
 
 modality_suffic_dict = {
     "anat": "T1w",
     "dwi": "dwi"
 }
 
-# argparse
-parser = argparse.ArgumentParser(description=HELPTEXT)
-
-# data
-parser.add_argument('--bids_dir', help='path to bids_dir with all the subjects')
-parser.add_argument('--modalities', nargs='*', default=["anat"], 
-                    help='modalities to check') 
-parser.add_argument('--file_ext', default='nii.gz', help='file extension to query')
-parser.add_argument('--output_csv', help='path to output csv file')
-
-args = parser.parse_args()
-bids_dir = args.bids_dir
-modalities = args.modalities
-file_ext = args.file_ext
-
-print(f"Validating output in: {modalities}")
-
-output_csv = args.output_csv
-participants_tsv = f"{bids_dir}/participants.tsv"
-
-# Check participants tsv and actual participant dirs
-tsv_participants = set(pd.read_csv(participants_tsv,sep="\t")["participant_id"].values)
-bids_dir_paths = glob.glob(f"{bids_dir}/sub*")
-bids_dir_participants = set([os.path.basename(x) for x in bids_dir_paths])
-
-participants_missing_in_tsv = list(bids_dir_participants - tsv_participants)
-participants_missing_in_bids_dir = list(tsv_participants - bids_dir_participants)
-
-print(f"n_participants_tsv: {len(tsv_participants)}, \
-        n_participants_bids_dir: {len(bids_dir_participants)}, \
-        n_participants_missing_in_tsv: {len(participants_missing_in_tsv)}, \
-        n_participants_missing_in_bids_dir: {len(participants_missing_in_bids_dir)}")
-
-if tsv_participants == bids_dir_participants:
-    layout = BIDSLayout(bids_dir)
-    sessions = layout.get_sessions()
-
-    bids_status_df = pd.DataFrame()    
-    for participant in tsv_participants:
-        participant_id = participant.split("-",2)[1]
-
-        session_df = pd.DataFrame(index=sessions, columns=modalities)
-        for ses in sessions:
-            f_count = []
-            for modality in modalities:
-                file_suffix = modality_suffic_dict[modality]
-                f = layout.get(subject=participant_id, 
-                                        session=ses, 
-                                        extension=file_ext, 
-                                        suffix=file_suffix,                 
-                                        return_type='filename')
-                
-                f_count.append(len(f))
-
-            session_df.loc[ses] = f_count
-
-        session_df = session_df.reset_index().rename(columns={"index":"session_id"})
-        session_df["participant_id"] = participant
-        bids_status_df = bids_status_df.append(session_df)
-
-    print(f"Saving bids_status_df at {output_csv}")        
-    bids_status_df = bids_status_df.set_index("participant_id")
-    bids_status_df.to_csv(output_csv)
-
-else:
-    print(f"participants_tsv and bids_dir participants mismatch...")
-    output_csv = os.path.join(os.path.dirname(output_csv) + "/mismatched_participants.csv")
-    missing_tsv_status = len(participants_missing_in_tsv) * ["participants_missing_in_tsv"]
-    missing_bids_status = len(participants_missing_in_bids_dir) * ["participants_missing_in_bids_dir"]
-    missing_df = pd.DataFrame()
-    missing_df["participant_id"] = participants_missing_in_tsv + participants_missing_in_bids_dir
-    missing_df["status"] = missing_tsv_status + missing_bids_status
-    print(f"Saving missing participants csv at {output_csv}")
-    missing_df.to_csv(output_csv,index=None)
+# BIDS entity index: one row per file
+# (participant_id, session_id, datatype, suffix, extension)
+INDEX_COLUMNS = ["participant_id", "session_id", "datatype", "suffix", "extension"]
+
+def parse_bids_filename(fname):
+    """ Split a BIDS filename into its entities, suffix and extension
+        e.g. sub-01_ses-1_run-1_T1w.nii.gz --> ({"sub": "01", "ses": "1", "run": "1"}, "T1w", "nii.gz")
+    """
+    stem, _, extension = fname.partition(".")
+    parts = stem.split("_")
+    entities = {}
+    for part in parts[:-1]:
+        key, _, value = part.partition("-")
+        entities[key] = value
+    return entities, parts[-1], extension
+
+def get_subject_fingerprint(subject_dir):
+    """ Fingerprint of a subject dir from the mtimes of its subject / session / datatype dirs
+        (adding or removing files changes the mtime of their datatype dir)
+    """
+    dir_mtimes = []
+    stack = [(subject_dir, 0)]
+    while stack:
+        dpath, depth = stack.pop()
+        dir_mtimes.append(f"{os.path.relpath(dpath, subject_dir)}:{os.stat(dpath).st_mtime_ns}")
+        if depth < 2:
+            with os.scandir(dpath) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        stack.append((entry.path, depth + 1))
+    return hashlib.md5("\n".join(sorted(dir_mtimes)).encode()).hexdigest()
+
+def index_subject(subject_dir):
+    """ Index all files of a subject (sub-<label>/[ses-<label>/]<datatype>/<file>) with scandir
+    """
+    rows = []
+    with os.scandir(subject_dir) as it:
+        top_dirs = [entry for entry in it if entry.is_dir()]
+
+    for top_dir in top_dirs:
+        if top_dir.name.startswith("ses-"):
+            with os.scandir(top_dir.path) as it:
+                datatype_dirs = [entry for entry in it if entry.is_dir()]
+        else:
+            datatype_dirs = [top_dir]
+
+        for datatype_dir in datatype_dirs:
+            with os.scandir(datatype_dir.path) as it:
+                for entry in it:
+                    if not entry.name.startswith("sub-"):
+                        continue
+                    entities, suffix, extension = parse_bids_filename(entry.name)
+                    rows.append([entities.get("ses"), datatype_dir.name, suffix, extension])
+    return rows
+
+def build_bids_index(bids_dir, participants, n_jobs=8, index_file=None):
+    """ BIDS entity index of all participants (subject dirs are indexed in parallel).
+        Subjects that did not change since the persisted index_file was saved are not re-indexed.
+    """
+    cached = {}
+    if index_file is not None and Path(index_file).is_file():
+        with open(index_file, 'r') as f:
+            cached = json.load(f)
+
+    fingerprints = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(get_subject_fingerprint)(
+        f"{bids_dir}/{participant}") for participant in participants)
+    fingerprint_dict = dict(zip(participants, fingerprints))
+
+    stale = [participant for participant in participants
+             if cached.get(participant, {}).get("fingerprint") != fingerprint_dict[participant]]
+    print(f"Indexing {len(stale)} participant(s), reusing {len(participants) - len(stale)} from the persisted index")
+
+    # scandir is I/O bound, so threads are enough
+    stale_rows = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(index_subject)(
+        f"{bids_dir}/{participant}") for participant in stale)
+
+    stale_rows = dict(zip(stale, stale_rows))
+    subject_index = {}
+    for participant in participants:
+        if participant in stale_rows:
+            subject_index[participant] = {"fingerprint": fingerprint_dict[participant], "rows": stale_rows[participant]}
+        else:
+            subject_index[participant] = cached[participant]
+
+    if index_file is not None:
+        with open(index_file, 'w') as f:
+            json.dump(subject_index, f)
+
+    records = [[participant] + row for participant, entry in subject_index.items() for row in entry["rows"]]
+    return pd.DataFrame.from_records(records, columns=INDEX_COLUMNS)
+
+def get_bids_status(bids_index_df, participants, modalities, file_ext):
+    """ Number of files per participant, session and modality (single groupby over the index)
+    """
+    sessions = sorted(bids_index_df["session_id"].dropna().unique())
+    if len(sessions) == 0:
+        sessions = [np.nan]
+
+    file_ext = file_ext.lstrip(".")
+    query_df = bids_index_df[bids_index_df["extension"] == file_ext]
+    query_df = query_df[query_df["datatype"].isin(modalities)]
+    query_df = query_df[query_df["suffix"] == query_df["datatype"].map(modality_suffic_dict)]
+
+    counts_df = query_df.groupby(["participant_id", "session_id", "datatype"], dropna=False).size().unstack(fill_value=0)
+    all_index = pd.MultiIndex.from_product([sorted(participants), sessions], names=["participant_id", "session_id"])
+    bids_status_df = counts_df.reindex(index=all_index, columns=modalities, fill_value=0)
+    bids_status_df.columns.name = None
+    bids_status_df = bids_status_df.reset_index().set_index("participant_id")
+    return bids_status_df
+
+if __name__ == '__main__':
+    # argparse
+    parser = argparse.ArgumentParser(description=HELPTEXT)
+
+    # data
+    parser.add_argument('--bids_dir', help='path to bids_dir with all the subjects')
+    parser.add_argument('--modalities', nargs='*', default=["anat"],
+                        help='modalities to check')
+    parser.add_argument('--file_ext', default='nii.gz', help='file extension to query')
+    parser.add_argument('--output_csv', help='path to output csv file')
+    parser.add_argument('--index_file', default=None, help='path to a (persisted) BIDS index json reused between runs')
+    parser.add_argument('--n_jobs', type=int, default=8, help='number of subject dirs indexed in parallel (default: 8)')
+
+    args = parser.parse_args()
+    bids_dir = args.bids_dir
+    modalities = args.modalities
+    file_ext = args.file_ext
+
+    print(f"Validating output in: {modalities}")
+
+    output_csv = args.output_csv
+    participants_tsv = f"{bids_dir}/participants.tsv"
+
+    # Check participants tsv and actual participant dirs
+    tsv_participants = set(pd.read_csv(participants_tsv,sep="\t")["participant_id"].values)
+    bids_dir_paths = glob.glob(f"{bids_dir}/sub*")
+    bids_dir_participants = set([os.path.basename(x) for x in bids_dir_paths])
+
+    participants_missing_in_tsv = list(bids_dir_participants - tsv_participants)
+    participants_missing_in_bids_dir = list(tsv_participants - bids_dir_participants)
+
+    print(f"n_participants_tsv: {len(tsv_participants)}, \
+            n_participants_bids_dir: {len(bids_dir_participants)}, \
+            n_participants_missing_in_tsv: {len(participants_missing_in_tsv)}, \
+            n_participants_missing_in_bids_dir: {len(participants_missing_in_bids_dir)}")
+
+    if tsv_participants == bids_dir_participants:
+        participants = sorted(tsv_participants)
+        bids_index_df = build_bids_index(bids_dir, participants, n_jobs=args.n_jobs, index_file=args.index_file)
+        bids_status_df = get_bids_status(bids_index_df, participants, modalities, file_ext)
+
+        print(f"Saving bids_status_df at {output_csv}")
+        bids_status_df.to_csv(output_csv)
+
+    else:
+        print(f"participants_tsv and bids_dir participants mismatch...")
+        output_csv = os.path.join(os.path.dirname(output_csv) + "/mismatched_participants.csv")
+        missing_tsv_status = len(participants_missing_in_tsv) * ["participants_missing_in_tsv"]
+        missing_bids_status = len(participants_missing_in_bids_dir) * ["participants_missing_in_bids_dir"]
+        missing_df = pd.DataFrame()
+        missing_df["participant_id"] = participants_missing_in_tsv + participants_missing_in_bids_dir
+        missing_df["status"] = missing_tsv_status + missing_bids_status
+        print(f"Saving missing participants csv at {output_csv}")
+        missing_df.to_csv(output_csv,index=None)
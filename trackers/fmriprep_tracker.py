@@ -1,5 +1,7 @@
-from pathlib import Path
+import datetime
+import functools
 import os
+from tracker import get_dir_snapshot, get_log_times
 
 # Status flags
 SUCCESS="SUCCESS"
@@ -13,6 +15,11 @@ UNAVAILABLE="UNAVAILABLE"
 # sub-MNI0056D864854_ses-01_task-rest_run-1_space-T1w_desc-brain_mask.json
 # sub-PD01134_ses-01_task-rest_run-1_space-MNI152NLin2009cSym_res-1_desc-brain_mask.json
 
+# Logs
+FMRIPREP_LOG = "log/fmriprep_out.log" # stdout of the container (written by run_fmriprep.py)
+FMRIPREP_END_MSG = "fMRIPrep finished successfully"
+RUN_DIR_TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S" # fMRIPrep run dirs: log/20230321-142005_<uuid>
+
 # Globals (any one of this would qualify as success)
 default_tpl_spaces = ["MNI152NLin2009cAsym","MNI152NLin2009cSym"]
 default_tpl_resolutions = ["res-1","res-2"]
@@ -34,44 +41,47 @@ func_files_dict = {
     "preproc_bold.nii": "desc-preproc_bold.nii.gz",
 }
 
-def check_output(subject_dir, file_check_dict, session_id, run_id, modality, 
-                    tpl_spaces=default_tpl_spaces, tpl_resolutions=default_tpl_resolutions, task=None):
+@functools.lru_cache(maxsize=None)
+def compile_output_patterns(file_check_items, session_id, run_id, modality, tpl_spaces, tpl_resolutions, task):
+    """ Compile expected output files into groups of relative path templates 
+        (one group per file key, any path of a group qualifies)
+    """
     session = f"ses-{session_id}"
     run = f"run-{run_id}"
+    if modality == "anat":
+        entities = session if run_id == None else f"{session}_{run}"
+    elif modality == "func":
+        entities = f"{session}_{task}" if run_id == None else f"{session}_{task}_{run}"
+    else:
+        print(f"Unknown modality: {modality}")
+        return None
+
+    patterns = []
+    for k,v in file_check_items:
+        group = []
+        for tpl_space in tpl_spaces:
+            for tpl_res in tpl_resolutions:
+                file_suffix = f"space-{tpl_space}_{tpl_res}_{v}"
+                group.append(f"{session}/{modality}/{{participant_id}}_{entities}_{file_suffix}")
+        patterns.append(tuple(group))
+
+    return tuple(patterns)
+
+def check_output(subject_dir, file_check_dict, session_id, run_id, modality, 
+                    tpl_spaces=default_tpl_spaces, tpl_resolutions=default_tpl_resolutions, task=None):
     participant_id = os.path.basename(subject_dir)
-    status_msg = SUCCESS
-    for k,v in file_check_dict.items():
-        if status_msg == SUCCESS:    
-            default_tpl_status = []
-            for tpl_space in tpl_spaces:
-                for tpl_res in tpl_resolutions:
-                    file_suffix = f"space-{tpl_space}_{tpl_res}_{v}"
-                    if modality == "anat":
-                        if run_id == None:
-                            filepath = Path(f"{subject_dir}/{session}/{modality}/{participant_id}_{session}_{file_suffix}")
-                        else:
-                            filepath = Path(f"{subject_dir}/{session}/{modality}/{participant_id}_{session}_{run}_{file_suffix}")
-
-                    elif modality == "func":
-                        if run_id == None:
-                            filepath = Path(f"{subject_dir}/{session}/{modality}/{participant_id}_{session}_{task}_{file_suffix}")
-                        else:
-                            filepath = Path(f"{subject_dir}/{session}/{modality}/{participant_id}_{session}_{task}_{run}_{file_suffix}")
-
-                    else:
-                        print(f"Unknown modality: {modality}")
-
-                    filepath_status = Path.is_file(filepath)
-
-                    default_tpl_status.append(filepath_status)
-
-            if not any(default_tpl_status):
-                status_msg = FAIL                    
-                break
-        else:
-            break
+    patterns = compile_output_patterns(tuple(file_check_dict.items()), session_id, run_id, modality,
+                                        tuple(tpl_spaces), tuple(tpl_resolutions), task)
+    if patterns is None:
+        return FAIL
 
-    return status_msg
+    # single directory pass per subject instead of one stat per candidate file
+    snapshot = get_dir_snapshot(subject_dir)
+    for group in patterns:
+        if not any([snapshot.is_file(p.format(participant_id=participant_id)) for p in group]):
+            return FAIL
+
+    return SUCCESS
 
 def check_anat_output(subject_dir, session_id, run_id):
     """ Check output paths for anat stream
@@ -132,7 +142,25 @@ def check_MNI152Lin(subject_dir, session_id, run_id):
     file_dict = anat_files_dict
     status_msg = check_output(subject_dir, file_dict, session_id, run_id, modality,
                                 tpl_spaces=custom_tpl_spaces, tpl_resolutions=custom_tpl_resolutions)
-    return status_msg   
+    return status_msg
+
+def get_run_times(subject_dir, session_id=None):
+    """ fMRIPrep start / end times from the container log, 
+        or start time of the first fMRIPrep run dir if the log is not available
+    """
+    if os.path.isfile(f"{subject_dir}/{FMRIPREP_LOG}"):
+        return get_log_times(f"{subject_dir}/{FMRIPREP_LOG}", FMRIPREP_END_MSG)
+
+    run_start_times = []
+    for d in get_dir_snapshot(subject_dir).dirs:
+        if d.startswith("log/") and d.count("/") == 1:
+            try:
+                run_start_times.append(datetime.datetime.strptime(d[4:].split("_")[0], RUN_DIR_TIMESTAMP_FORMAT))
+            except ValueError:
+                continue
+    start_time = min(run_start_times) if len(run_start_times) > 0 else None
+    return start_time, None
+
 
 tracker_configs = {
     "pipeline_complete": check_anat_output,
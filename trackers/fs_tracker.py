@@ -1,4 +1,5 @@
-from pathlib import Path
+import functools
+from tracker import get_dir_snapshot, get_log_times
 
 # Status flags
 SUCCESS="SUCCESS"
@@ -12,69 +13,38 @@ HEMISPHERES = ["lh","rh"]
 DEFAULT_PARCELS = ["aparc","aparc.a2009s"]
 ALL_PARCELS = ["aparc","aparc.a2009s","aparc.DKTatlas"]
 SURF_MEASURES = ["curv","area","thickness","volume","sulc","midthickness"]
+STATUS_LOG = "scripts/recon-all-status.log"
+STATUS_LOG_END_MSG = "finished without error"
+
+# Expected files (relative to the subject dir)
+MRI_FILES = [f"mri/{parc}+aseg.mgz" for parc in DEFAULT_PARCELS]
+LABEL_FILES = [f"label/{hemi}.{parc}.annot" for parc in DEFAULT_PARCELS for hemi in HEMISPHERES]
+SURF_FILES = [f"surf/{hemi}.{measure}" for measure in SURF_MEASURES for hemi in HEMISPHERES]
+
+@functools.lru_cache(maxsize=None)
+def get_stats_files(parcels):
+    return [f"stats/{hemi}.{parc}.stats" for parc in parcels for hemi in HEMISPHERES] + ["stats/aseg.stats"]
 
 def check_fsdirs(subject_dir):
-    filepath_status = True
-    for fsdir in FIRST_LEVEL_DIRS:
-        dirpath = Path(f"{subject_dir}/{fsdir}")
-        dirpath_status = Path.is_dir(dirpath)
-        if not dirpath_status:
-            break
-    return filepath_status
+    snapshot = get_dir_snapshot(subject_dir)
+    return all([snapshot.is_dir(fsdir) for fsdir in FIRST_LEVEL_DIRS])
+
+def check_files(subject_dir, rel_paths):
+    # single directory pass per subject instead of one stat per file
+    snapshot = get_dir_snapshot(subject_dir)
+    return all([snapshot.is_file(p) for p in rel_paths])
 
 def check_mri(subject_dir):
-    filepath_status = True
-    for parc in DEFAULT_PARCELS:
-        filepath = Path(f"{subject_dir}/mri/{parc}+aseg.mgz")
-        filepath_status = Path.is_file(filepath)
-        if not filepath_status:
-            break
-    return filepath_status
+    return check_files(subject_dir, MRI_FILES)
 
 def check_label(subject_dir):
-    filepath_status = True
-    for parc in DEFAULT_PARCELS:
-        if filepath_status:
-            for hemi in HEMISPHERES:
-                filepath = Path(f"{subject_dir}/label/{hemi}.{parc}.annot")
-                filepath_status = Path.is_file(filepath)
-                if not filepath_status:
-                    break
-        else:
-            break
-    return filepath_status
+    return check_files(subject_dir, LABEL_FILES)
 
 def check_surf(subject_dir):
-    filepath_status = True
-    for measure in SURF_MEASURES:
-        if filepath_status:
-            for hemi in HEMISPHERES:
-                filepath = Path(f"{subject_dir}/surf/{hemi}.{measure}")
-                filepath_status = Path.is_file(filepath)
-                if not filepath_status:
-                    break
-        else:
-            break
-            
-    return filepath_status
+    return check_files(subject_dir, SURF_FILES)
 
 def check_stats(subject_dir, PARCELS=DEFAULT_PARCELS):
-    filepath_status = True
-    for parc in PARCELS:
-        if filepath_status:
-            for hemi in HEMISPHERES:
-                filepath = Path(f"{subject_dir}/stats/{hemi}.{parc}.stats")
-                filepath_status = Path.is_file(filepath)
-                if not filepath_status:
-                    break
-        else:
-            break
-
-    # check aseg
-    filepath = Path(f"{subject_dir}/stats/aseg.stats")
-    aseg_status = Path.is_file(filepath)
-
-    return filepath_status & aseg_status
+    return check_files(subject_dir, get_stats_files(tuple(PARCELS)))
 
 def check_run_status(subject_dir, session_id=None, run_id=None):
     check_list = [check_fsdirs,check_mri,check_label,check_surf,check_stats]
@@ -96,6 +66,11 @@ def check_parcels(subject_dir, session_id=None, run_id=None):
         status_msg = FAIL
     return status_msg
 
+def get_run_times(subject_dir, session_id=None):
+    """ recon-all start / end times from recon-all-status.log
+    """
+    return get_log_times(f"{subject_dir}/{STATUS_LOG}", STATUS_LOG_END_MSG)
+
 
 tracker_configs = {
     "pipeline_complete": check_run_status,
@@ -1,70 +1,53 @@
+import os
 import sys
-import json
-import glob
+from pathlib import Path
+from tracker import get_dir_snapshot, get_log_times, log_contains
 
+# MRIQC output layout and success marker are shared with the runner (workflow/proc_pipe/mriqc)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from workflow.proc_pipe.mriqc.mriqc_outputs import MRIQC_SUCCESS_MSG, check_iqm_files, get_participant_log_name
 
-#/scratch/qpn/sub-01/
+# Status flags
+SUCCESS="SUCCESS"
+FAIL="FAIL"
 
-def eval_mriqc(subject_dir, session_id, run_id=None):
-    
-       
-    #get subject id from directory
-    subject_id = subject_dir.split('/')[-1].split('-')[-1]
+#/scratch/qpn/sub-01/
 
+def check_mriqc_output(subject_dir, session_id, output_pattern):
+    """ Check the MRIQC log for the completion marker and the subject dir for the expected IQM jsons
+    """
+    #get bids id from directory
+    bids_id = os.path.basename(subject_dir.rstrip('/'))
 
-    #read MRIQC pipeline output log
-    output_log = subject_dir + '/mriqc_out_' + str(subject_id) + '.log'
-    f = open(output_log, 'r')
+    #read MRIQC pipeline output log (scanned from the end, cached per file size/mtime)
+    output_log = f"{subject_dir}/{get_participant_log_name(bids_id)}"
 
-    #set up dictionary to return
-    results = {'participant_id': [subject_id], 'PIPELINE_STATUS_COLUMNS': []} 
-    
-        
     #check if participant successfully passed MRIQC pipeline
-    if "Participant level finished successfully." in f.read(): 
-        
-        #create path string
-        acq_T1w = subject_dir + '/' + str(subject_id) + '_ses-' + str(session_id) + '*_run-*_T1w*'
-        
-        #check if string is an existing path
-        if glob.glob(acq_T1w):
-                results['PIPELINE_STATUS_COLUMNS'].append('SUCCESS')
-        else: results['PIPELINE_STATUS_COLUMNS'].append('FAIL')
-            
-    
-    else: #no sign participant passed, assume failure for all datatypes
-        results['PIPELINE_STATUS_COLUMNS'].append('FAIL')
-        
-    return results
+    if log_contains(output_log, MRIQC_SUCCESS_MSG):
 
+        #check expected output against the (shared, recursive) listing of the subject dir
+        if check_iqm_files(get_dir_snapshot(subject_dir).files, bids_id, session_id, output_pattern):
+            return SUCCESS
+        else:
+            return FAIL
 
-def check_bold(subject_dir, session_id, run_id=None):
-    
-    #get subject id from directory
-    subject_id = subject_dir.split('/')[-1].split('-')[-1]
+    else: #no sign participant passed, assume failure for all datatypes
+        return FAIL
 
-    
-    #read MRIQC pipeline output log
+def get_run_times(subject_dir, session_id=None):
+    """ MRIQC start / end times from the participant log
+    """
+    subject_id = subject_dir.split('/')[-1].split('-')[-1]
     output_log = subject_dir + '/mriqc_out_' + str(subject_id) + '.log'
+    return get_log_times(output_log, MRIQC_SUCCESS_MSG)
 
-    f = open(output_log, 'r')
-    
-    #check if participant successfully passed MRIQC pipeline
-    if "Participant level finished successfully." in f.read(): 
-        
-        #create path string
-        acq_bold = subject_dir + '/' + subject_id + '_ses-' + session_id + '*_task-rest_run-*_bold*'
-    
-    	#check if string is existing path
-        if glob.glob(acq_bold):
-                return 'SUCCESS'
-        else: return 'FAIL'
+def eval_mriqc(subject_dir, session_id, run_id=None):
+    return check_mriqc_output(subject_dir, session_id, '*T1w')
+
+def check_bold(subject_dir, session_id, run_id=None):
+    return check_mriqc_output(subject_dir, session_id, 'task-rest*_bold')
 
-    else: #no sign participant passed, assume failure for all datatypes
-        return 'FAIL'
-         
 
-#eval_mriqc returns participant_id and pass/fail while check_bold only returns pass/fail
 tracker_configs = {
     "pipeline_complete": eval_mriqc,
     
@@ -72,4 +55,3 @@ tracker_configs = {
             "MRIQC_BOLD": check_bold
             }
 }
-
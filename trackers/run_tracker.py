@@ -1,8 +1,11 @@
 import pandas as pd
 from pathlib import Path
 import argparse
-from tracker import tracker, get_start_time
+from joblib import Parallel, delayed
+from tracker import (tracker, dir_snapshot, get_dir_fingerprint,
+                     load_tracker_cache, save_tracker_cache)
 import fs_tracker, fmriprep_tracker, mriqc_tracker
+import tracker_store
 
 # Status flags
 SUCCESS="SUCCESS"
@@ -17,81 +20,210 @@ pipeline_tracker_config_dict = {
     "fmriprep": fmriprep_tracker.tracker_configs,
     "mriqc": mriqc_tracker.tracker_configs
 }
+# log-derived start / end times of a pipeline run
+pipeline_run_times_dict = {
+    "freesurfer": fs_tracker.get_run_times,
+    "fmriprep": fmriprep_tracker.get_run_times,
+    "mriqc": mriqc_tracker.get_run_times
+}
 BIDS_PIPES = ["mriqc","fmriprep"]
+BAGEL_KEY_COLUMNS = ["bids_id", "pipeline_name", "pipeline_version", "session"]
+TRACKER_CACHE_DIR = ".tracker_cache"
+OUTPUT_FORMATS = ["csv", "parquet", "both"]
+RUN_TIME_COLUMNS = ["pipeline_starttime", "pipeline_endtime", "pipeline_duration_hours"]
+
+def get_subject_dir(mr_proc_root_dir, pipeline, version, session_id, bids_id):
+    """ pipeline output dir of a participant
+    """
+    if pipeline == "freesurfer":
+        subject_dir = f"{mr_proc_root_dir}/derivatives/{pipeline}/v{version}/output/ses-{session_id}/{bids_id}" 
+    elif pipeline in BIDS_PIPES:
+        subject_dir = f"{mr_proc_root_dir}/derivatives/{pipeline}/v{version}/output/{bids_id}" 
+    else:
+        print(f"unknown pipeline: {pipeline}")
+        subject_dir = None
+    return subject_dir
+
+def get_run_time_columns(start_time, end_time):
+    """ Start, end and duration (hours) of a pipeline run (UNAVAILABLE if not found in the logs)
+    """
+    duration = UNAVAILABLE
+    if start_time is not None and end_time is not None:
+        duration = round((end_time - start_time).total_seconds() / 3600, 2)
+    return {
+        "pipeline_starttime": str(start_time) if start_time is not None else UNAVAILABLE,
+        "pipeline_endtime": str(end_time) if end_time is not None else UNAVAILABLE,
+        "pipeline_duration_hours": duration
+    }
+
+def get_throughput(_df):
+    """ Completed subjects per day over the span of the logged runs of a pipeline session
+    """
+    start_times = pd.to_datetime(_df["pipeline_starttime"], errors="coerce")
+    end_times = pd.to_datetime(_df["pipeline_endtime"], errors="coerce")
+    n_completed = end_times.notna().sum()
+    if n_completed == 0:
+        return UNAVAILABLE
+    span_days = (end_times.max() - start_times.min()).total_seconds() / 86400
+    if not span_days > 0:
+        return UNAVAILABLE
+    return round(n_completed / span_days, 2)
+
+def check_subject(bids_id, participant_id, subject_dir, session_id, status_check_dict, run_id, cached=None, run_times_func=None):
+    """ Run all tracker checks of a participant and return its status record and output fingerprint.
+        The cached record is reused if the output tree did not change.
+    """
+    record = {"bids_id": bids_id, "participant_id": participant_id}
+    fingerprint = None
+
+    dir_status = subject_dir is not None and Path(subject_dir).is_dir()
+    if dir_status:
+        fingerprint = get_dir_fingerprint(subject_dir)
+        if cached is not None and cached["fingerprint"] == fingerprint:
+            return dict(cached["record"], **record), fingerprint
+
+        # all checks of a subject share one directory snapshot
+        with dir_snapshot(subject_dir):
+            for name, func in status_check_dict.items():
+                record[name] = func(subject_dir, session_id, run_id)
+            # only the head and the tail of the run logs are read
+            start_time, end_time = run_times_func(subject_dir, session_id) if run_times_func is not None else (None, None)
+        record.update(get_run_time_columns(start_time, end_time))
+    else:
+        for name in status_check_dict.keys():
+            record[name] = UNAVAILABLE
+        record.update(get_run_time_columns(None, None))
+
+    return record, fingerprint
+
+def upsert_bagel(proc_status_df, tracker_csv):
+    """ Replace/add rows of the existing bagel (matched on bids_id, pipeline, version and session)
+    """
+    if Path(tracker_csv).is_file():
+        old_df = pd.read_csv(tracker_csv, dtype=str)
+        new_df = proc_status_df.reset_index()
+        new_keys = pd.MultiIndex.from_frame(new_df[BAGEL_KEY_COLUMNS].astype(str))
+        old_keys = pd.MultiIndex.from_frame(old_df[BAGEL_KEY_COLUMNS])
+        old_df = old_df[~old_keys.isin(new_keys)].set_index("bids_id")
+        print(f"Keeping {len(old_df)} rows of the existing bagel")
+        proc_status_df = pd.concat([old_df, proc_status_df], axis='index')
+
+    proc_status_df.to_csv(tracker_csv)
+
+def get_pipeline_setup(global_config_file, dash_schema_file, pipeline):
+    """ Configs, participants and status checks of a pipeline (shared by run_tracker and watch_tracker)
+    """
+    pipe_tracker = tracker(global_config_file, dash_schema_file, pipeline) 
+        
+    mr_proc_root_dir, session_ids, version = pipe_tracker.get_global_configs()
+    schema = pipe_tracker.get_dash_schema()
+    tracker_configs = pipeline_tracker_config_dict[pipeline]
+
+    mr_proc_manifest = f"{mr_proc_root_dir}/tabular/mr_proc_manifest.csv"
+    manifest_df = pd.read_csv(mr_proc_manifest)
+    manifest_df = manifest_df[~manifest_df["bids_id"].isna()].copy()
+    manifest_df["bids_id"] = manifest_df["bids_id"].astype(str).str.strip()
+
+    # bids_id --> participant_id lookup (first match, computed once)
+    participant_id_dict = manifest_df.drop_duplicates(subset="bids_id").set_index("bids_id")["participant_id"].to_dict()
+
+    status_check_dict = pipe_tracker.get_pipe_tasks(tracker_configs, PIPELINE_STATUS_COLUMNS)
+
+    dash_col_list = list(schema["GLOBAL_COLUMNS"].keys()) 
+    record_col_list = ["bids_id", "participant_id"] + list(status_check_dict.keys()) + RUN_TIME_COLUMNS
+
+    return {
+        "pipeline": pipeline,
+        "version": version,
+        "mr_proc_root_dir": mr_proc_root_dir,
+        "session_ids": session_ids,
+        "participant_id_dict": participant_id_dict,
+        "status_check_dict": status_check_dict,
+        "run_times_func": pipeline_run_times_dict.get(pipeline),
+        "col_list": dash_col_list + [col for col in record_col_list if col not in dash_col_list],
+        # cached records are only valid for the same set of record columns
+        "cache_keys": record_col_list[2:],
+    }
+
+def get_cache_file(setup, session_id):
+    return f"{setup['mr_proc_root_dir']}/derivatives/{TRACKER_CACHE_DIR}/{setup['pipeline']}_v{setup['version']}_ses-{session_id}.json"
+
+def get_session_df(setup, session_id, records):
+    """ Tracker rows of a pipeline session (records are ordered like the manifest participants)
+    """
+    _df = pd.DataFrame.from_records(records).reindex(columns=setup["col_list"])
+    _df["session"] = session_id
+    _df["pipeline_name"] = setup["pipeline"]
+    _df["pipeline_version"] = setup["version"]
+    _df["pipeline_throughput_per_day"] = get_throughput(_df)
+    _df = _df.set_index(pd.Index(list(setup["participant_id_dict"].keys())))
+    return _df
+
+def save_proc_status(proc_status_dfs, mr_proc_root_dir, status_cols, output_format="csv"):
+    """ Upsert tracker rows into bagel.csv and / or the parquet tracker store
+    """
+    proc_status_df = pd.concat(proc_status_dfs, axis='index')
+    proc_status_df = proc_status_df.drop(columns="bids_id")
+    proc_status_df.index.name = "bids_id"
+
+    if output_format in ["parquet", "both"]:
+        if tracker_store.check_parquet_support():
+            store_dir = f"{mr_proc_root_dir}/derivatives/{tracker_store.TRACKER_STORE_DIR}"
+            tracker_store.update_store(proc_status_df, store_dir, status_cols)
+        else:
+            print("Falling back to csv output")
+            output_format = "csv"
+
+    if output_format in ["csv", "both"]:
+        tracker_csv = f"{mr_proc_root_dir}/derivatives/bagel.csv"
+        upsert_bagel(proc_status_df, tracker_csv)
+        print(f"Saved to {tracker_csv}")
 
-def run(global_config_file, dash_schema_file, pipelines, run_id=1):
+def run(global_config_file, dash_schema_file, pipelines, run_id=1, n_jobs=8, use_cache=True, output_format="csv"):
     """ driver code running pipeline specific trackers
     """
 
     proc_status_dfs = [] # list of dataframes
+    status_cols = [] # status check columns of all pipelines (summarized in the tracker store)
     for pipeline in pipelines:
-        pipe_tracker = tracker(global_config_file, dash_schema_file, pipeline) 
-            
-        mr_proc_root_dir, session_ids, version = pipe_tracker.get_global_configs()
-        schema = pipe_tracker.get_dash_schema()
-        tracker_configs = pipeline_tracker_config_dict[pipeline]
-
-        mr_proc_manifest = f"{mr_proc_root_dir}/tabular/mr_proc_manifest.csv"
-        manifest_df = pd.read_csv(mr_proc_manifest)
-        participants = manifest_df[~manifest_df["bids_id"].isna()]["bids_id"].drop_duplicates().astype(str).str.strip().values
-        n_participants = len(participants)
+        setup = get_pipeline_setup(global_config_file, dash_schema_file, pipeline)
+        mr_proc_root_dir, session_ids, version = setup["mr_proc_root_dir"], setup["session_ids"], setup["version"]
+        participant_id_dict = setup["participant_id_dict"]
+        status_check_dict = setup["status_check_dict"]
+        status_cols += [col for col in status_check_dict.keys() if col not in status_cols]
+        participants = list(participant_id_dict.keys())
 
         print("-"*50)
         print(f"pipeline: {pipeline}, version: {version}")
-        print(f"n_participants: {n_participants}, session_ids: {session_ids}")
+        print(f"n_participants: {len(participants)}, session_ids: {session_ids}")
         print("-"*50)
 
-        status_check_dict = pipe_tracker.get_pipe_tasks(tracker_configs, PIPELINE_STATUS_COLUMNS)
-
-        dash_col_list = list(schema["GLOBAL_COLUMNS"].keys()) 
-        
         for session_id in session_ids:
             print(f"Checking session: {session_id}")    
-            _df = pd.DataFrame(index=participants, columns=dash_col_list)          
-            _df["session"] = session_id
-            _df["pipeline_name"] = pipeline        
-            _df["pipeline_version"] = version
-            
-            for bids_id in participants:
-                participant_id = manifest_df[manifest_df["bids_id"]==bids_id]["participant_id"].values[0]
-                _df.loc[bids_id,"participant_id"] = participant_id
-                # print(f"bids_id: {bids_id}, participant_id: {participant_id}")
-
-                if pipeline == "freesurfer":
-                    subject_dir = f"{mr_proc_root_dir}/derivatives/{pipeline}/v{version}/output/ses-{session_id}/{bids_id}" 
-                elif pipeline in BIDS_PIPES:
-                    subject_dir = f"{mr_proc_root_dir}/derivatives/{pipeline}/v{version}/output/{bids_id}" 
-                else:
-                    print(f"unknown pipeline: {pipeline}")
-                    
-                dir_status = Path(subject_dir).is_dir()
-                # print(f"subject_dir:{subject_dir}, dir_status: {dir_status}")
-                
-                if dir_status:                
-                    for name, func in status_check_dict.items():
-                        status = func(subject_dir, session_id, run_id)
-                        # print(f"task_name: {name}, status: {status}")
-                        _df.loc[bids_id,name] = status
-                        _df.loc[bids_id,"pipeline_starttime"] = get_start_time(subject_dir)
-                        _df.loc[bids_id,"pipeline_endtime"] = UNAVAILABLE # TODO
-                else:
-                    # print(f"Pipeline output not found for bids_id: {bids_id}, session: {session}")
-                    for name in status_check_dict.keys():                    
-                        _df.loc[bids_id,name] = UNAVAILABLE
-                        _df.loc[bids_id,"pipeline_starttime"] = UNAVAILABLE
-                        _df.loc[bids_id,"pipeline_endtime"] = UNAVAILABLE
-
-            proc_status_dfs.append(_df)
 
-    proc_status_df = pd.concat(proc_status_dfs, axis='index')
+            # per-subject records from previous runs, keyed on output-tree fingerprints
+            cache_file = get_cache_file(setup, session_id)
+            cache = load_tracker_cache(cache_file, setup["cache_keys"]) if use_cache else {}
 
-    # Save proc_status_df
-    tracker_csv = f"{mr_proc_root_dir}/derivatives/bagel.csv"
-    proc_status_df = proc_status_df.drop(columns="bids_id")
-    proc_status_df.index.name = "bids_id"
-    proc_status_df.to_csv(tracker_csv)
+            # status checks are mostly filesystem bound, so threads are enough
+            results = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(check_subject)(
+                bids_id, participant_id_dict[bids_id], 
+                get_subject_dir(mr_proc_root_dir, pipeline, version, session_id, bids_id),
+                session_id, status_check_dict, run_id, cache.get(bids_id), setup["run_times_func"]
+                ) for bids_id in participants)
+            records = [record for record, _ in results]
 
-    print(f"Saved to {tracker_csv}")
+            new_cache = {record["bids_id"]: {"fingerprint": fingerprint, "record": record}
+                        for record, fingerprint in results if fingerprint is not None}
+            n_unchanged = sum([cache.get(bids_id, {}).get("fingerprint") == entry["fingerprint"] 
+                            for bids_id, entry in new_cache.items()])
+            print(f"Reused {n_unchanged} cached (unchanged) subject(s), checked {len(records) - n_unchanged}")
+            save_tracker_cache(cache_file, setup["cache_keys"], new_cache)
+
+            proc_status_dfs.append(get_session_df(setup, session_id, records))
+
+    # Save proc_status_df
+    save_proc_status(proc_status_dfs, mr_proc_root_dir, status_cols, output_format)
 
 if __name__ == '__main__':
     # argparse
@@ -102,6 +234,10 @@ if __name__ == '__main__':
     parser.add_argument('--global_config', type=str, help='path to global config file for your mr_proc dataset', required=True)
     parser.add_argument('--dash_schema', type=str, help='path to dashboard schema to display tracker status', required=True)
     parser.add_argument('--pipelines', nargs='+', help='list of pipelines to track', required=True)
+    parser.add_argument('--n_jobs', type=int, default=8, help='number of parallel participant checks (default: 8)')
+    parser.add_argument('--output_format', type=str, default="csv", choices=OUTPUT_FORMATS,
+                        help='bagel.csv, partitioned parquet tracker store (requires pyarrow) or both (default: csv)')
+    parser.add_argument('--no_cache', action='store_true', help='re-check all subjects (default: reuse cached status of unchanged subjects)')
     args = parser.parse_args()
 
     # read global configs
@@ -113,4 +249,5 @@ if __name__ == '__main__':
 
     print(f"Tracking pipelines: {pipelines}")
 
-    run(global_config_file, dash_schema_file, pipelines)
+    run(global_config_file, dash_schema_file, pipelines, n_jobs=args.n_jobs, use_cache=not args.no_cache,
+        output_format=args.output_format)
@@ -1,6 +1,10 @@
+import contextlib
 import json 
 import datetime
+import hashlib
 import os
+import re
+import threading
 
 class tracker:
     # constructor
@@ -50,4 +54,210 @@ def get_start_time(subject_dir):
     m_time = os.path.getmtime(subject_dir)
     # convert timestamp into DateTime object
     dt_m = datetime.datetime.fromtimestamp(m_time)
-    return dt_m
\ No newline at end of file
+    return dt_m
+
+class DirSnapshot:
+    """ In-memory listing of all files and dirs under a subject dir (one recursive scandir pass).
+        Paths are relative to the subject dir and use "/" separators.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = str(root_dir)
+        self.files = set()
+        self.dirs = set()
+
+        stack = [("", self.root_dir)]
+        while stack:
+            rel_dir, abs_dir = stack.pop()
+            try:
+                it = os.scandir(abs_dir)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    rel_path = f"{rel_dir}{entry.name}"
+                    try:
+                        if entry.is_dir():
+                            self.dirs.add(rel_path)
+                            # do not follow symlinked dirs (avoids loops)
+                            if not entry.is_symlink():
+                                stack.append((f"{rel_path}/", entry.path))
+                        elif entry.is_file():
+                            self.files.add(rel_path)
+                    except OSError:
+                        continue
+
+    def is_file(self, rel_path):
+        return rel_path in self.files
+
+    def is_dir(self, rel_path):
+        return rel_path in self.dirs
+
+    def listdir(self, rel_dir=""):
+        """ names of the files and dirs directly inside rel_dir
+        """
+        prefix = f"{rel_dir}/" if rel_dir else ""
+        return [p[len(prefix):] for p in self.files | self.dirs 
+                if p.startswith(prefix) and "/" not in p[len(prefix):]]
+
+
+# snapshots of the subject dirs currently being tracked (see dir_snapshot)
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+@contextlib.contextmanager
+def dir_snapshot(subject_dir):
+    """ Share one DirSnapshot between all tracker checks of a subject
+    """
+    snapshot = DirSnapshot(subject_dir)
+    with _snapshots_lock:
+        _snapshots[str(subject_dir)] = snapshot
+    try:
+        yield snapshot
+    finally:
+        with _snapshots_lock:
+            _snapshots.pop(str(subject_dir), None)
+
+def get_dir_snapshot(subject_dir):
+    """ Snapshot of a subject dir (shared one if inside dir_snapshot, otherwise a fresh one)
+    """
+    snapshot = _snapshots.get(str(subject_dir))
+    if snapshot is None:
+        snapshot = DirSnapshot(subject_dir)
+    return snapshot
+
+
+# files stat-ed at any depth by get_dir_fingerprint (rewritten / appended in place, e.g. <bids_id>/log/fmriprep_out.log)
+FINGERPRINT_FILE_SUFFIXES = (".log",)
+
+def get_dir_fingerprint(subject_dir):
+    """ Cheap fingerprint of a subject output tree: (mtime, n_entries) of every dir 
+        plus (mtime, size) of the top-level files and of the logs in subdirs (files rewritten in place).
+        Other files are not stat-ed below the top level.
+    """
+    fingerprint = hashlib.sha1()
+    stack = [("", str(subject_dir))]
+    while stack:
+        rel_dir, abs_dir = stack.pop()
+        try:
+            dir_stat = os.stat(abs_dir)
+            entries = sorted(os.scandir(abs_dir), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        fingerprint.update(f"{rel_dir}:{dir_stat.st_mtime_ns}:{len(entries)}\n".encode())
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((f"{rel_dir}{entry.name}/", entry.path))
+                elif rel_dir == "" or entry.name.endswith(FINGERPRINT_FILE_SUFFIXES):
+                    entry_stat = entry.stat()
+                    fingerprint.update(f"{rel_dir}{entry.name}:{entry_stat.st_mtime_ns}:{entry_stat.st_size}\n".encode())
+            except OSError:
+                continue
+    return fingerprint.hexdigest()
+
+def load_tracker_cache(cache_file, check_names):
+    """ Cached subject records ({bids_id: {"fingerprint": str, "record": dict}}).
+        The cache is discarded if the tracked checks changed.
+    """
+    if not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        cache = json.load(f)
+    if cache.get("checks") != list(check_names):
+        return {}
+    return cache["subjects"]
+
+def save_tracker_cache(cache_file, check_names, subjects):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({"checks": list(check_names), "subjects": subjects}, f, default=str)
+    os.replace(tmp_file, cache_file)
+
+
+# Log probes: the result of the last probe of every (file, marker) is cached with the file size and mtime,
+# so unchanged logs are never re-read (one entry per file and marker: bounded for long-running trackers)
+LOG_BLOCK_SIZE = 1024**2 # bytes
+_log_probe_cache = {}
+_log_probe_lock = threading.Lock()
+
+def log_contains(log_file, marker, block_size=LOG_BLOCK_SIZE):
+    """ Check if a (potentially huge) log contains a marker by reading it backwards in blocks.
+        Completion markers are at the end of the log, so successful runs only need one block.
+    """
+    try:
+        log_stat = os.stat(log_file)
+    except OSError:
+        return False
+
+    key = (str(log_file), marker)
+    version = (log_stat.st_size, log_stat.st_mtime_ns)
+    with _log_probe_lock:
+        cached = _log_probe_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    marker_bytes = marker.encode()
+    found = False
+    with open(log_file, 'rb') as f:
+        end = log_stat.st_size
+        tail = b"" # start of the previous block (marker can span two blocks)
+        while end > 0 and not found:
+            start = max(0, end - block_size)
+            f.seek(start)
+            block = f.read(end - start) + tail
+            found = marker_bytes in block
+            tail = block[:len(marker_bytes) - 1]
+            end = start
+
+    with _log_probe_lock:
+        _log_probe_cache[key] = (version, found)
+    return found
+
+
+# Run times from logs: only the head and the tail of a log are read
+LOG_TIME_PROBE_SIZE = 64 * 1024 # bytes
+LOG_TIMESTAMP_FORMATS = [
+    (re.compile(r"\b(\d{6}-\d{2}:\d{2}:\d{2})"), "%y%m%d-%H:%M:%S"), # nipype: 230321-14:20:05,123
+    (re.compile(r"\b(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})"), "%Y-%m-%d %H:%M:%S"), # iso: 2023-03-21 14:20:05
+    (re.compile(r"\b([A-Z][a-z]{2} [A-Z][a-z]{2} +\d{1,2} \d{2}:\d{2}:\d{2})(?: [A-Z]{2,5})? (\d{4})\b"), 
+        "%a %b %d %H:%M:%S %Y"), # date (FreeSurfer): Tue Mar 21 14:20:05 EDT 2023 (timezone is dropped)
+]
+
+def parse_log_timestamps(text):
+    """ All timestamps found in a chunk of log text (in order of appearance)
+    """
+    timestamps = []
+    for line in text.splitlines():
+        for pattern, fmt in LOG_TIMESTAMP_FORMATS:
+            match = pattern.search(line)
+            if match is not None:
+                try:
+                    timestamps.append(datetime.datetime.strptime(" ".join(match.groups()), fmt))
+                    break
+                except ValueError:
+                    continue
+    return timestamps
+
+def get_log_times(log_file, end_marker=None, probe_size=LOG_TIME_PROBE_SIZE):
+    """ Start (first timestamp of the head) and end (last timestamp of the tail) of a run from its log.
+        The end time is only reported if the end_marker is found in the tail. Returns None if unavailable.
+    """
+    try:
+        log_size = os.path.getsize(log_file)
+        with open(log_file, 'rb') as f:
+            head = f.read(probe_size).decode(errors="replace")
+            f.seek(max(0, log_size - probe_size))
+            tail = f.read().decode(errors="replace")
+    except OSError:
+        return None, None
+
+    head_timestamps = parse_log_timestamps(head)
+    start_time = head_timestamps[0] if len(head_timestamps) > 0 else None
+
+    end_time = None
+    if end_marker is None or end_marker in tail:
+        tail_timestamps = parse_log_timestamps(tail)
+        end_time = tail_timestamps[-1] if len(tail_timestamps) > 0 else None
+
+    return start_time, end_time
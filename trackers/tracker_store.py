@@ -0,0 +1,84 @@
+import os
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Columnar tracker store (alternative to the flat bagel.csv):
+# <DATASET_ROOT>/derivatives/tracker_store/
+#     participants/pipeline_name=<pipeline>/pipeline_version=<version>/session=<session>/status.parquet
+#     summary.parquet --> n_participants per pipeline x version x session x stage x status
+# The dashboard can load the (small) summary table and only read participant rows on drill-down.
+
+TRACKER_STORE_DIR = "tracker_store"
+PARTITION_COLUMNS = ["pipeline_name", "pipeline_version", "session"]
+SUMMARY_COLUMNS = PARTITION_COLUMNS + ["stage", "status", "n_participants"]
+
+def check_parquet_support():
+    if pyarrow is None:
+        print("pyarrow is not installed (pip install pyarrow), parquet tracker store is not available")
+        return False
+    return True
+
+def get_partition_dir(store_dir, pipeline, version, session):
+    return f"{store_dir}/participants/pipeline_name={pipeline}/pipeline_version={version}/session={session}"
+
+def write_parquet(df, fpath):
+    """ Atomic parquet write (readers never see a partially written file)
+    """
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    tmp_file = f"{fpath}.tmp"
+    df.to_parquet(tmp_file, engine="pyarrow", index=False)
+    os.replace(tmp_file, fpath)
+
+def summarize_partition(partition_df, status_cols):
+    """ Number of participants per stage (status column) and status
+    """
+    status_cols = [col for col in status_cols if col in partition_df.columns]
+    summary_df = partition_df.melt(id_vars=PARTITION_COLUMNS, value_vars=status_cols,
+                                    var_name="stage", value_name="status").dropna(subset=["status"])
+    summary_df = summary_df.groupby(PARTITION_COLUMNS + ["stage", "status"]).size().rename("n_participants")
+    return summary_df.reset_index()
+
+def update_store(proc_status_df, store_dir, status_cols):
+    """ Replace the partitions (pipeline, version, session) present in proc_status_df
+        and update their rows of the summary table
+    """
+    proc_status_df = proc_status_df.reset_index()
+    # mixed status / time / numeric columns are stored as (nullable) strings, like in bagel.csv
+    proc_status_df = proc_status_df.astype("string")
+
+    summary_dfs = []
+    updated_partitions = set()
+    for (pipeline, version, session), partition_df in proc_status_df.groupby(PARTITION_COLUMNS):
+        partition_df = partition_df.dropna(axis="columns", how="all")
+        partition_file = f"{get_partition_dir(store_dir, pipeline, version, session)}/status.parquet"
+        write_parquet(partition_df.drop(columns=PARTITION_COLUMNS), partition_file)
+        summary_dfs.append(summarize_partition(partition_df, status_cols))
+        updated_partitions.add((pipeline, version, session))
+
+    summary_file = f"{store_dir}/summary.parquet"
+    if os.path.isfile(summary_file):
+        old_summary_df = pd.read_parquet(summary_file).astype({col: "string" for col in PARTITION_COLUMNS})
+        old_keys = pd.Series(list(zip(*[old_summary_df[col] for col in PARTITION_COLUMNS])), index=old_summary_df.index)
+        summary_dfs.insert(0, old_summary_df[~old_keys.isin(updated_partitions)])
+
+    summary_df = pd.concat(summary_dfs, axis="index").reindex(columns=SUMMARY_COLUMNS)
+    write_parquet(summary_df.sort_values(SUMMARY_COLUMNS[:-1]), summary_file)
+    print(f"Updated {len(updated_partitions)} partition(s) of the tracker store: {store_dir}")
+
+def load_summary(store_dir):
+    """ Precomputed status counts of all partitions
+    """
+    return pd.read_parquet(f"{store_dir}/summary.parquet")
+
+def load_participants(store_dir, pipeline, version, session):
+    """ Participant rows of a single partition (drill-down)
+    """
+    partition_df = pd.read_parquet(f"{get_partition_dir(store_dir, pipeline, version, session)}/status.parquet")
+    partition_df["pipeline_name"] = pipeline
+    partition_df["pipeline_version"] = version
+    partition_df["session"] = session
+    return partition_df.set_index("bids_id")
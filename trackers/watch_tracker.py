@@ -0,0 +1,233 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from run_tracker import (OUTPUT_FORMATS, check_subject, get_cache_file, get_pipeline_setup, get_session_df,
+                         get_subject_dir, save_proc_status)
+import run_tracker
+from tracker import get_dir_fingerprint, load_tracker_cache, save_tracker_cache
+
+# Live tracker: watches derivatives/<pipeline>/v<version>/output (inotify, or polling e.g. on NFS)
+# and only re-runs the tracker checks of the subjects whose output changed.
+
+# Globals
+POLL_INTERVAL = 60 # seconds between two polls of the subject fingerprints (polling mode)
+SETTLE_TIME = 10 # seconds without new events before a changed subject is re-checked
+if INotify is not None:
+    WATCH_FLAGS = flags.CREATE | flags.DELETE | flags.MODIFY | flags.CLOSE_WRITE | \
+        flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE_SELF
+
+def get_output_root(setup, session_id):
+    """ Dir containing the subject dirs of a pipeline session
+    """
+    # subject dirs are direct children of the output root
+    subject_dir = get_subject_dir(setup["mr_proc_root_dir"], setup["pipeline"], setup["version"], session_id, "sub-")
+    return os.path.dirname(subject_dir)
+
+class SessionState:
+    """ In-memory tracker cache of a single pipeline session
+    """
+    def __init__(self, setup, session_id):
+        self.setup = setup
+        self.session_id = session_id
+        self.output_root = get_output_root(setup, session_id)
+        self.cache_file = get_cache_file(setup, session_id)
+        self.cache = load_tracker_cache(self.cache_file, setup["cache_keys"])
+
+    def get_changed_subjects(self, bids_ids=None):
+        """ Subjects (all, or only bids_ids) whose output fingerprint differs from the cached one (polling mode)
+        """
+        if bids_ids is None:
+            bids_ids = self.setup["participant_id_dict"].keys()
+        changed = []
+        for bids_id in bids_ids:
+            subject_dir = get_subject_dir(self.setup["mr_proc_root_dir"], self.setup["pipeline"],
+                                          self.setup["version"], self.session_id, bids_id)
+            fingerprint = get_dir_fingerprint(subject_dir) if Path(subject_dir).is_dir() else None
+            if fingerprint != self.cache.get(bids_id, {}).get("fingerprint"):
+                changed.append(bids_id)
+        return changed
+
+    def update(self, bids_ids, run_id=1):
+        """ Re-check the given subjects and return the tracker rows of the session
+            (other subjects are taken from the cache without touching the filesystem)
+        """
+        setup = self.setup
+        for bids_id in bids_ids:
+            subject_dir = get_subject_dir(setup["mr_proc_root_dir"], setup["pipeline"], setup["version"], self.session_id, bids_id)
+            record, fingerprint = check_subject(bids_id, setup["participant_id_dict"][bids_id], subject_dir, self.session_id,
+                                                setup["status_check_dict"], run_id, None, setup["run_times_func"])
+            if fingerprint is None:
+                self.cache.pop(bids_id, None)
+            else:
+                self.cache[bids_id] = {"fingerprint": fingerprint, "record": record}
+        save_tracker_cache(self.cache_file, setup["cache_keys"], self.cache)
+
+        records = []
+        for bids_id, participant_id in setup["participant_id_dict"].items():
+            if bids_id in self.cache:
+                records.append(dict(self.cache[bids_id]["record"], bids_id=bids_id, participant_id=participant_id))
+            else:
+                record, _ = check_subject(bids_id, participant_id, None, self.session_id, setup["status_check_dict"], run_id)
+                records.append(record)
+        return get_session_df(setup, self.session_id, records)
+
+
+class InotifyWatcher:
+    """ Recursive inotify watches on the output roots (a watch per dir).
+        Subtrees that cannot be watched (e.g. max_user_watches reached) are listed in unwatched_dirs and polled instead.
+    """
+    def __init__(self, output_roots):
+        self.inotify = INotify()
+        self.wd_paths = {}
+        self.unwatched_dirs = set()
+        for output_root in output_roots:
+            Path(output_root).mkdir(parents=True, exist_ok=True)
+            self.add_watches(output_root)
+        print(f"Watching {len(self.wd_paths)} dir(s) with inotify")
+
+    def add_watches(self, root_dir):
+        for dpath, dnames, _ in os.walk(root_dir):
+            try:
+                wd = self.inotify.add_watch(dpath, WATCH_FLAGS)
+            except OSError as e:
+                print(f"Warning: could not watch {dpath} ({e}), polling this subtree instead")
+                self.unwatched_dirs.add(dpath)
+                dnames.clear()
+                continue
+            self.wd_paths[wd] = dpath
+
+    def get_unwatched_subjects(self, output_root, bids_ids):
+        """ Subjects (among bids_ids) with outputs in an unwatched subtree
+        """
+        unwatched = set()
+        for dpath in self.unwatched_dirs:
+            if not os.path.relpath(output_root, dpath).startswith(".."):
+                return list(bids_ids) # the whole output root is unwatched
+            bids_id = get_subject_from_path(dpath, output_root)
+            if bids_id in bids_ids:
+                unwatched.add(bids_id)
+        return sorted(unwatched)
+
+    def read(self, timeout_s):
+        """ Paths of all changed files / dirs (new dirs are watched as well)
+        """
+        paths = []
+        for event in self.inotify.read(timeout=int(timeout_s * 1000)):
+            dpath = self.wd_paths.get(event.wd)
+            if dpath is None:
+                continue
+            path = os.path.join(dpath, event.name)
+            if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                self.add_watches(path)
+            if event.mask & flags.IGNORED:
+                self.wd_paths.pop(event.wd, None)
+            paths.append(path)
+        return paths
+
+
+def get_subject_from_path(path, output_root):
+    """ bids_id of the subject dir containing a changed path (None if outside of a subject dir)
+    """
+    rel_path = os.path.relpath(path, output_root)
+    if rel_path.startswith(".."):
+        return None
+    bids_id = rel_path.split(os.sep)[0]
+    return bids_id if bids_id.startswith("sub-") else None
+
+def watch(global_config_file, dash_schema_file, pipelines, run_id=1, output_format="csv",
+          use_polling=False, poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME):
+    """ Keep the tracker output up to date by re-checking only the subjects whose output changed
+    """
+    # initial (cached) pass so that the output and the caches are in sync
+    run_tracker.run(global_config_file, dash_schema_file, pipelines, run_id=run_id, output_format=output_format)
+
+    states = []
+    status_cols = []
+    for pipeline in pipelines:
+        setup = get_pipeline_setup(global_config_file, dash_schema_file, pipeline)
+        status_cols += [col for col in setup["status_check_dict"].keys() if col not in status_cols]
+        for session_id in setup["session_ids"]:
+            states.append(SessionState(setup, session_id))
+    mr_proc_root_dir = states[0].setup["mr_proc_root_dir"]
+
+    watcher = None
+    if not use_polling:
+        if INotify is None:
+            print("inotify_simple is not installed (pip install inotify_simple), falling back to polling")
+        else:
+            try:
+                watcher = InotifyWatcher([state.output_root for state in states])
+            except OSError as e:
+                print(f"Could not set up inotify watches ({e}), falling back to polling")
+    if watcher is None:
+        print(f"Polling subject outputs every {poll_interval}s")
+
+    pending = {} # (state index, bids_id) --> time of the last change
+    last_poll = time.monotonic()
+    while True:
+        if watcher is not None:
+            for path in watcher.read(timeout_s=1):
+                for i, state in enumerate(states):
+                    bids_id = get_subject_from_path(path, state.output_root)
+                    if bids_id in state.setup["participant_id_dict"]:
+                        pending[(i, bids_id)] = time.monotonic()
+            # subtrees without inotify watches are polled
+            if len(watcher.unwatched_dirs) > 0 and time.monotonic() - last_poll >= poll_interval:
+                for i, state in enumerate(states):
+                    bids_ids = watcher.get_unwatched_subjects(state.output_root, state.setup["participant_id_dict"])
+                    for bids_id in state.get_changed_subjects(bids_ids):
+                        pending.setdefault((i, bids_id), time.monotonic())
+                last_poll = time.monotonic()
+        else:
+            time.sleep(1)
+            if time.monotonic() - last_poll >= poll_interval:
+                for i, state in enumerate(states):
+                    for bids_id in state.get_changed_subjects():
+                        pending.setdefault((i, bids_id), time.monotonic())
+                last_poll = time.monotonic()
+
+        # re-check subjects once their output stopped changing for settle_time
+        now = time.monotonic()
+        due = [key for key, t in pending.items() if now - t >= settle_time]
+        if len(due) == 0:
+            continue
+
+        proc_status_dfs = []
+        for i in sorted(set([i for i, _ in due])):
+            bids_ids = [bids_id for j, bids_id in due if j == i]
+            state = states[i]
+            print(f"Re-checking {state.setup['pipeline']} ses-{state.session_id}: {bids_ids}")
+            proc_status_dfs.append(state.update(bids_ids, run_id))
+        for key in due:
+            pending.pop(key)
+
+        save_proc_status(proc_status_dfs, mr_proc_root_dir, status_cols, output_format)
+
+if __name__ == '__main__':
+    # argparse
+    HELPTEXT = """
+    Script to keep the tracker output up to date while pipelines are running (re-checks changed subjects only)
+    """
+    parser = argparse.ArgumentParser(description=HELPTEXT)
+    parser.add_argument('--global_config', type=str, help='path to global config file for your mr_proc dataset', required=True)
+    parser.add_argument('--dash_schema', type=str, help='path to dashboard schema to display tracker status', required=True)
+    parser.add_argument('--pipelines', nargs='+', help='list of pipelines to track', required=True)
+    parser.add_argument('--output_format', type=str, default="csv", choices=OUTPUT_FORMATS,
+                        help='bagel.csv, partitioned parquet tracker store (requires pyarrow) or both (default: csv)')
+    parser.add_argument('--poll', action='store_true', help='poll subject outputs instead of using inotify (e.g. on NFS)')
+    parser.add_argument('--poll_interval', type=int, default=POLL_INTERVAL, help=f'seconds between polls (default: {POLL_INTERVAL})')
+    parser.add_argument('--settle_time', type=int, default=SETTLE_TIME,
+                        help=f'seconds without changes before a subject is re-checked (default: {SETTLE_TIME})')
+    args = parser.parse_args()
+
+    print(f"Watching pipelines: {args.pipelines}")
+
+    watch(args.global_config, args.dash_schema, args.pipelines, output_format=args.output_format,
+          use_polling=args.poll, poll_interval=args.poll_interval, settle_time=args.settle_time)
@@ -14,6 +14,7 @@ from bids.layout import parse_file_entities
 
 import workflow.catalog as catalog
 import workflow.logger as my_logger
+from workflow.telemetry import get_telemetry_dir, run_with_telemetry
 from workflow.utils import (
     COL_CONV_STATUS,
     COL_DICOM_ID,
@@ -82,13 +83,32 @@ def run_heudiconv(dicom_id, global_configs, session_id, stage, logger):
     logger.info(f"CMD:\n{CMD}")
     heudiconv_proc_success = True
     try:
-        subprocess.run(CMD, check=True) # raises CalledProcessError if non-zero return code
+        # raises CalledProcessError if non-zero return code
+        run_with_telemetry(CMD, "heudiconv", dicom_id, session_id, get_telemetry_dir(global_configs), logger, check=True)
     except Exception as e:
         logger.error(f"bids run failed with exceptions: {e}")
         heudiconv_proc_success = False
 
     return heudiconv_proc_success
 
+def copy_heuristic(global_configs, logger):
+    """ Make heuristic.py visible to the Singularity container (needed for stage 2)
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    logger.info(f"Copying ./heuristic.py to {DATASET_ROOT}/proc/heuristic.py (to be seen by Singularity container)")
+    shutil.copyfile(f"{CWD}/heuristic.py", f"{DATASET_ROOT}/proc/heuristic.py")
+
+def convert_participant(global_configs, session_id, dicom_id, bids_id, logger, stage=2):
+    """ Run HeuDiConv for a single participant and check its BIDS session dir (used by the mr_proc task scheduler)
+    """
+    heudiconv_proc_success = run_heudiconv(dicom_id, global_configs, session_id, stage, logger)
+    if stage == 1 or not heudiconv_proc_success:
+        return heudiconv_proc_success
+
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    session = session_id_to_bids_session(session_id)
+    return Path(f"{DATASET_ROOT}/bids/{bids_id}/{session}").is_dir()
+
 def run(global_configs, session_id, logger=None, stage=2, n_jobs=2, dicom_id=None):
     """ Runs the bids conv tasks 
     """
@@ -125,8 +145,7 @@ def run(global_configs, session_id, logger=None, stage=2, n_jobs=2, dicom_id=Non
         logger.info(f"\nStarting bids conversion for {n_heudiconv_participants} participant(s)")
     
         if stage == 2:
-            logger.info(f"Copying ./heuristic.py to {DATASET_ROOT}/proc/heuristic.py (to be seen by Singularity container)")
-            shutil.copyfile(f"{CWD}/heuristic.py", f"{DATASET_ROOT}/proc/heuristic.py")
+            copy_heuristic(global_configs, logger)
 
         if n_jobs > 1:
             ## Process in parallel! (Won't write to logs)
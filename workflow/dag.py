@@ -0,0 +1,245 @@
+import datetime
+import heapq
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import workflow.catalog as catalog
+from workflow.bids_conv import run_bids_conv
+from workflow.dicom_org import run_dicom_org
+from workflow.utils import (
+    COL_BIDS_ID_MANIFEST,
+    COL_CONV_STATUS,
+    COL_DICOM_ID,
+    COL_DOWNLOAD_STATUS,
+    COL_ORG_STATUS,
+    COL_PARTICIPANT_DICOM_DIR,
+    COL_SESSION_MANIFEST,
+    COL_SUBJECT_MANIFEST,
+    DNAME_BACKUPS_STATUS,
+    FNAME_STATUS,
+    load_status,
+    save_backup,
+    session_id_to_bids_session,
+)
+
+# Task-level scheduler: each (participant, session, stage) is a task that only
+# depends on the previous stage of the same participant and session. Tasks from
+# all stages share one worker pool, so a participant's bids_conv starts as soon
+# as its own dicom_org is done.
+
+# Task status flags
+PENDING = "PENDING"
+SUCCESS = "SUCCESS"
+FAIL = "FAIL"
+SKIPPED = "SKIPPED" # upstream task failed
+
+# Stages (in dependency order) and the status file column they update
+STAGE_DICOM_ORG = "dicom_org"
+STAGE_BIDS_CONV = "bids_conv"
+STAGES = [STAGE_DICOM_ORG, STAGE_BIDS_CONV]
+STAGE_STATUS_COLS = {
+    STAGE_DICOM_ORG: COL_ORG_STATUS,
+    STAGE_BIDS_CONV: COL_CONV_STATUS,
+}
+
+# per-task status log (append only, survives crashes)
+FNAME_TASK_STATUS = "mr_proc_tasks.jsonl"
+
+class Task:
+    def __init__(self, participant_id, session_id, stage, dicom_id, bids_id, participant_dicom_dir):
+        self.participant_id = participant_id
+        self.session_id = session_id
+        self.stage = stage
+        self.dicom_id = dicom_id
+        self.bids_id = bids_id
+        self.participant_dicom_dir = participant_dicom_dir
+        self.deps = []
+        self.dependents = []
+        self.status = PENDING
+
+    @property
+    def key(self):
+        return (self.participant_id, self.session_id, self.stage)
+
+    @property
+    def priority(self):
+        # downstream stages first: finish participants end-to-end before starting new ones
+        return -STAGES.index(self.stage)
+
+    def __repr__(self):
+        return f"{self.stage}({self.participant_id}, ses-{self.session_id})"
+
+
+def get_task_status_file(global_configs):
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    return Path(f"{DATASET_ROOT}/scratch/logs/{FNAME_TASK_STATUS}")
+
+def build_tasks(global_configs, session_ids, workflows, logger):
+    """ Create (participant, session, stage) tasks from the status file
+        (the status file is updated after every successful task, so it alone decides what is left to run)
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    fpath_status = Path(DATASET_ROOT, "scratch", "raw_dicom", FNAME_STATUS)
+
+    stages = []
+    for wf in workflows:
+        if wf in STAGES:
+            stages.append(wf)
+        else:
+            logger.error(f"Unknown workflow: {wf}")
+    stages = sorted(stages, key=STAGES.index)
+
+    tasks = {}
+    for session_id in session_ids:
+        status_df = catalog.read_and_process_status(fpath_status, session_id, logger)
+        for row in status_df.to_dict("records"):
+            upstream = None
+            for stage in stages:
+                done = bool(row[STAGE_STATUS_COLS[stage]])
+                if stage == STAGE_DICOM_ORG:
+                    needed = bool(row[COL_DOWNLOAD_STATUS]) and not done
+                else:
+                    needed = not done and (bool(row[COL_ORG_STATUS]) or upstream is not None)
+
+                if not needed:
+                    upstream = None
+                    continue
+
+                task = Task(row[COL_SUBJECT_MANIFEST], session_id, stage, row[COL_DICOM_ID],
+                            row[COL_BIDS_ID_MANIFEST], row[COL_PARTICIPANT_DICOM_DIR])
+                if upstream is not None:
+                    task.deps.append(upstream)
+                    upstream.dependents.append(task)
+                tasks[task.key] = task
+                upstream = task
+
+    return tasks
+
+def run_task(task, global_configs, logger, use_symlinks=True, skip_dcm_check=False):
+    """ Run a single participant-level task
+    """
+    if task.stage == STAGE_DICOM_ORG:
+        return run_dicom_org.reorg_participant(global_configs, task.session_id, task.participant_id, task.participant_dicom_dir,
+                                                logger, use_symlinks=use_symlinks, skip_dcm_check=skip_dcm_check)
+    elif task.stage == STAGE_BIDS_CONV:
+        return run_bids_conv.convert_participant(global_configs, task.session_id, task.dicom_id, task.bids_id, logger)
+    else:
+        logger.error(f"Unknown stage: {task.stage}")
+        return False
+
+def run_dag(tasks, global_configs, n_jobs, logger, **task_kwargs):
+    """ Run tasks on a shared pool of n_jobs workers as soon as their dependencies succeed
+    """
+    fpath_task_status = get_task_status_file(global_configs)
+    fpath_task_status.parent.mkdir(parents=True, exist_ok=True)
+
+    def persist(task, start_time=None):
+        record = {
+            "participant_id": task.participant_id,
+            "session_id": task.session_id,
+            "stage": task.stage,
+            "status": task.status,
+            "start_time": start_time,
+            "end_time": datetime.datetime.now().isoformat(),
+        }
+        with open(fpath_task_status, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def skip_dependents(task):
+        for dependent in task.dependents:
+            dependent.status = SKIPPED
+            persist(dependent)
+            skip_dependents(dependent)
+
+    ready = []
+    seq = 0
+    def push_if_ready(task):
+        nonlocal seq
+        if task.status == PENDING and all([dep.status == SUCCESS for dep in task.deps]):
+            heapq.heappush(ready, (task.priority, seq, task))
+            seq += 1
+
+    for task in tasks.values():
+        push_if_ready(task)
+
+    n_pending = sum([task.status == PENDING for task in tasks.values()])
+    logger.info(f"Running {n_pending} task(s) with {n_jobs} worker(s)")
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        running = {}
+        while ready or running:
+            while ready and len(running) < n_jobs:
+                _, _, task = heapq.heappop(ready)
+                logger.info(f"Starting task: {task}")
+                start_time = datetime.datetime.now().isoformat()
+                future = executor.submit(run_task, task, global_configs, logger, **task_kwargs)
+                running[future] = (task, start_time)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, start_time = running.pop(future)
+                try:
+                    success = bool(future.result())
+                except Exception as e:
+                    logger.error(f"Task {task} failed with exceptions: {e}")
+                    success = False
+
+                task.status = SUCCESS if success else FAIL
+                persist(task, start_time)
+                logger.info(f"Finished task: {task}, status: {task.status}")
+
+                if success:
+                    # results are handled in this (single) scheduler thread: no concurrent status file writes
+                    update_status_file(global_configs, [task], logger)
+                    for dependent in task.dependents:
+                        push_if_ready(dependent)
+                else:
+                    skip_dependents(task)
+
+    return tasks
+
+def update_status_file(global_configs, tasks, logger):
+    """ Mark successful tasks in the status file
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    fpath_status = Path(DATASET_ROOT, "scratch", "raw_dicom", FNAME_STATUS)
+    df_status = load_status(fpath_status)
+
+    n_updated = 0
+    for task in tasks:
+        if task.status != SUCCESS:
+            continue
+        idx = (df_status[COL_SUBJECT_MANIFEST] == task.participant_id) & \
+            (df_status[COL_SESSION_MANIFEST] == session_id_to_bids_session(task.session_id))
+        col = STAGE_STATUS_COLS[task.stage]
+        n_updated += int((~df_status.loc[idx, col].astype(bool)).sum())
+        df_status.loc[idx, col] = True
+
+    if n_updated > 0:
+        save_backup(df_status, fpath_status, DNAME_BACKUPS_STATUS)
+    logger.info(f"Updated {n_updated} status entries in {fpath_status}")
+
+def run(global_configs, session_ids, workflows, n_jobs, logger, **task_kwargs):
+    """ Build and run the participant-level task graph for all sessions and workflows
+    """
+    tasks = build_tasks(global_configs, session_ids, workflows, logger)
+
+    if len(tasks) == 0:
+        logger.info("No new participants found for any workflow...")
+        return tasks
+
+    for stage in STAGES:
+        n_stage = sum([task.stage == stage for task in tasks.values()])
+        logger.info(f"{stage}: {n_stage} task(s)")
+
+    if any([task.stage == STAGE_BIDS_CONV and task.status == PENDING for task in tasks.values()]):
+        run_bids_conv.copy_heuristic(global_configs, logger)
+
+    run_dag(tasks, global_configs, n_jobs, logger, **task_kwargs)
+
+    for status in [SUCCESS, FAIL, SKIPPED]:
+        n_status = sum([task.status == status for task in tasks.values()])
+        logger.info(f"n_tasks {status}: {n_status}")
+
+    return tasks
@@ -8,6 +8,7 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from workflow.dicom_org.dicom_index import update_dicom_index
 from workflow.utils import (
     COL_BIDS_ID_MANIFEST,
     COL_CONV_STATUS,
@@ -146,6 +147,14 @@ def run(global_config_file, regenerate=False, empty=False):
 
     df_status = df_status[COLS_STATUS]
 
+    # refresh the cached dicom index of downloaded participants (used by mr_proc.py --plan)
+    df_downloaded = df_status.loc[
+        (df_status[COL_DOWNLOAD_STATUS].astype(str) == 'True') & ~df_status[COL_PARTICIPANT_DICOM_DIR].isna()
+    ]
+    for session, df_session in df_downloaded.groupby(COL_SESSION_MANIFEST):
+        n_indexed = update_dicom_index(dpath_dataset, session, df_session[COL_PARTICIPANT_DICOM_DIR])
+        print(f'Indexed {n_indexed} new/changed raw DICOM dirs for {session}')
+
     # do not write file if there are no changes from previous one
     if df_status_old is not None and df_status.equals(df_status_old):
         print(f'\nNo change from existing status file. Will not write new status file.')
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Cached per-participant summary of the downloaded (raw) dicoms:
+# <DATASET_ROOT>/scratch/raw_dicom/dicom_index.json
+# {session: {participant_dicom_dir: {"n_files": int, "n_bytes": int, "fingerprint": str}}}
+# The fingerprint covers the mtimes of all the dirs of the participant tree (nested series dirs included),
+# so adding or removing dicoms anywhere in the tree re-indexes the participant.
+# Used by the mr_proc planner so that it never has to walk the raw dicom trees.
+
+FNAME_DICOM_INDEX = "dicom_index.json"
+
+def get_dicom_index_file(dataset_root):
+    return Path(f"{dataset_root}/scratch/raw_dicom/{FNAME_DICOM_INDEX}")
+
+def load_dicom_index(dataset_root):
+    """ Load the cached dicom index (empty if it was never built)
+    """
+    fpath_index = get_dicom_index_file(dataset_root)
+    if not fpath_index.is_file():
+        return {}
+    with open(fpath_index, "r") as f:
+        return json.load(f)
+
+def summarize_dicom_dir(dpath):
+    """ Count files and bytes under a participant raw dicom dir (single scandir pass)
+    """
+    n_files, n_bytes = 0, 0
+    stack = [dpath]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    n_files += 1
+                    n_bytes += entry.stat().st_size
+    return n_files, n_bytes
+
+def get_dicom_dir_fingerprint(dpath):
+    """ Fingerprint of a participant raw dicom dir from the mtimes of all its dirs
+        (adding or removing files changes the mtime of the dir that contains them)
+    """
+    dir_mtimes = []
+    stack = [str(dpath)]
+    while stack:
+        dir_path = stack.pop()
+        dir_mtimes.append(f"{os.path.relpath(dir_path, dpath)}:{os.stat(dir_path).st_mtime_ns}")
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    return hashlib.md5("\n".join(sorted(dir_mtimes)).encode()).hexdigest()
+
+def update_dicom_index(dataset_root, session, participant_dicom_dirs):
+    """ Index new participant dicom dirs (or dirs whose tree changed) and save the index
+    """
+    dicom_index = load_dicom_index(dataset_root)
+    session_index = dicom_index.setdefault(session, {})
+
+    n_indexed = 0
+    for participant_dicom_dir in participant_dicom_dirs:
+        dpath = Path(f"{dataset_root}/scratch/raw_dicom/{session}/{participant_dicom_dir}")
+        if not dpath.is_dir():
+            continue
+        fingerprint = get_dicom_dir_fingerprint(dpath)
+        entry = session_index.get(participant_dicom_dir)
+        if entry is not None and entry.get("fingerprint") == fingerprint:
+            continue
+        n_files, n_bytes = summarize_dicom_dir(dpath)
+        session_index[participant_dicom_dir] = {"n_files": n_files, "n_bytes": n_bytes, "fingerprint": fingerprint}
+        n_indexed += 1
+
+    if n_indexed > 0:
+        fpath_index = get_dicom_index_file(dataset_root)
+        with open(fpath_index, "w") as f:
+            json.dump(dicom_index, f, indent=4)
+
+    return n_indexed
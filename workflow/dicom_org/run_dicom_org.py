@@ -43,7 +43,28 @@ def reorg(participant, participant_dicom_dir, raw_dicom_dir, dicom_dir, invalid_
     # Save skipped or invalid dicom file list
     with open(invalid_dicoms_file, "w") as outfile:
         json.dump(invalid_dicom_dict, outfile, indent=4)
-        
+
+    return True
+
+def get_dicom_org_dirs(global_configs, session):
+    """ Session specific raw_dicom, dicom, log and invalid_dicom dirs
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    raw_dicom_dir = f"{DATASET_ROOT}/scratch/raw_dicom/{session}/"
+    dicom_dir = f"{DATASET_ROOT}/dicom/{session}/"
+    log_dir = f"{DATASET_ROOT}/scratch/logs/"
+    invalid_dicom_dir = f"{log_dir}/invalid_dicom_dir/"
+    return raw_dicom_dir, dicom_dir, log_dir, invalid_dicom_dir
+
+def reorg_participant(global_configs, session_id, participant, participant_dicom_dir, logger, use_symlinks=True, skip_dcm_check=False):
+    """ Reorganize dicoms of a single participant (used by the mr_proc task scheduler)
+    """
+    session = session_id_to_bids_session(session_id)
+    raw_dicom_dir, dicom_dir, log_dir, invalid_dicom_dir = get_dicom_org_dirs(global_configs, session)
+    Path(dicom_dir).mkdir(parents=True, exist_ok=True)
+    Path(invalid_dicom_dir).mkdir(parents=True, exist_ok=True)
+
+    return reorg(participant, participant_dicom_dir, raw_dicom_dir, dicom_dir, invalid_dicom_dir, logger, use_symlinks, skip_dcm_check)
 
 def run(global_configs, session_id, logger=None, use_symlinks=True, skip_dcm_check=False, n_jobs=4):
     """ Runs the dicom reorg tasks 
@@ -52,10 +73,7 @@ def run(global_configs, session_id, logger=None, use_symlinks=True, skip_dcm_che
 
     # populate relative paths
     DATASET_ROOT = global_configs["DATASET_ROOT"]
-    raw_dicom_dir = f"{DATASET_ROOT}/scratch/raw_dicom/{session}/"
-    dicom_dir = f"{DATASET_ROOT}/dicom/{session}/"
-    log_dir = f"{DATASET_ROOT}/scratch/logs/"
-    invalid_dicom_dir = f"{log_dir}/invalid_dicom_dir/"
+    raw_dicom_dir, dicom_dir, log_dir, invalid_dicom_dir = get_dicom_org_dirs(global_configs, session)
 
     fpath_status = f"{DATASET_ROOT}/scratch/raw_dicom/doughnut.csv"
     df_status = load_status(fpath_status)
@@ -0,0 +1,83 @@
+import pandas as pd
+
+from workflow import dag
+from workflow.dicom_org.dicom_index import load_dicom_index
+from workflow.telemetry import get_telemetry_dir, summarize_telemetry
+from workflow.utils import session_id_to_bids_session
+
+# Dry-run planner for mr_proc.py --plan: reports the pending tasks of every
+# session and workflow using only the status file, the cached dicom index and
+# the telemetry records (no container launches, no walks of the data trees).
+
+# container (telemetry pipeline name) used by each workflow
+WORKFLOW_CONTAINERS = {
+    dag.STAGE_DICOM_ORG: None,
+    dag.STAGE_BIDS_CONV: "heudiconv",
+}
+
+def get_plan(global_configs, session_ids, workflows, logger):
+    """ Return a per-task dataframe with the dicom files/bytes and expected container time
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    tasks = dag.build_tasks(global_configs, session_ids, workflows, logger)
+    dicom_index = load_dicom_index(DATASET_ROOT)
+
+    telemetry_dir = get_telemetry_dir(global_configs)
+    wall_times = {}
+    for wf, container in WORKFLOW_CONTAINERS.items():
+        if container is not None:
+            wall_times[wf] = summarize_telemetry(telemetry_dir, container)["wall_time_s"]
+
+    records = []
+    for task in tasks.values():
+        session = session_id_to_bids_session(task.session_id)
+        index_entry = dicom_index.get(session, {}).get(task.participant_dicom_dir, {})
+        wall_time = wall_times.get(task.stage)
+        records.append({
+            "session": session,
+            "workflow": task.stage,
+            "participant_id": task.participant_id,
+            "bids_id": task.bids_id,
+            "n_dicom_files": index_entry.get("n_files"),
+            "dicom_bytes": index_entry.get("n_bytes"),
+            "expected_container_hours": None if wall_time is None else wall_time / 3600,
+        })
+
+    return pd.DataFrame(records, columns=["session", "workflow", "participant_id", "bids_id",
+                                           "n_dicom_files", "dicom_bytes", "expected_container_hours"])
+
+def summarize_plan(plan_df):
+    """ Aggregate the per-task plan for every session and workflow
+    """
+    summary_df = plan_df.groupby(["session", "workflow"], sort=True).agg(
+        n_participants=("participant_id", "count"),
+        n_not_indexed=("n_dicom_files", lambda x: x.isna().sum()),
+        n_dicom_files=("n_dicom_files", "sum"),
+        dicom_gb=("dicom_bytes", lambda x: x.sum() / 1024**3),
+        expected_container_hours=("expected_container_hours", lambda x: x.sum(min_count=1)),
+    )
+    return summary_df
+
+def run(global_configs, session_ids, workflows, logger):
+    """ Log the pending work and estimated cost, and save the per-task plan
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    plan_df = get_plan(global_configs, session_ids, workflows, logger)
+
+    logger.info("-"*50)
+    if len(plan_df) == 0:
+        logger.info("No pending tasks for any session / workflow")
+        return plan_df
+
+    summary_df = summarize_plan(plan_df)
+    logger.info(f"Pending tasks per session and workflow:\n\n{summary_df.to_string()}\n")
+    logger.info("(dicom files/bytes come from the cached dicom index: " \
+                "run check_dicom_status.py to index new downloads; bytes are only copied with --no_symlinks)")
+    logger.info("(expected container hours = n_participants x median wall time of the recorded telemetry runs)")
+
+    plan_csv = f"{DATASET_ROOT}/scratch/logs/mr_proc_plan.csv"
+    plan_df.to_csv(plan_csv, index=False)
+    logger.info(f"Saved participant-level plan to {plan_csv}")
+    logger.info("-"*50)
+
+    return plan_df
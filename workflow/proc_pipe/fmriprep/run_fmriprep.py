@@ -4,6 +4,7 @@ import subprocess
 import os
 from pathlib import Path
 import workflow.logger as my_logger
+from workflow.telemetry import get_telemetry_dir, run_with_telemetry
 import shutil
 
 #Author: nikhil153
@@ -21,13 +22,19 @@ os.environ['SINGULARITYENV_TEMPLATEFLOW_HOME'] = SINGULARITY_TEMPLATEFLOW_DIR
 
 MEM_MB = 4000
 
-def run_fmriprep(participant_id, bids_dir, fmriprep_dir, fs_dir, templateflow_dir, SINGULARITY_CONTAINER, use_bids_filter, anat_only, logger):
+def run_fmriprep(participant_id, bids_dir, fmriprep_dir, fs_dir, templateflow_dir, SINGULARITY_CONTAINER, use_bids_filter, anat_only, logger,
+                 session_id=None, telemetry_dir=None):
     """ Launch fmriprep container"""
 
     fmriprep_out_dir = f"{fmriprep_dir}/output/"
     fmriprep_home_dir = f"{fmriprep_out_dir}/fmriprep_home_{participant_id}/"
     Path(f"{fmriprep_home_dir}").mkdir(parents=True, exist_ok=True)
 
+    # container stdout/stderr (parsed by trackers/fmriprep_tracker.py for run times)
+    bids_id = participant_id if participant_id.startswith("sub-") else f"sub-{participant_id}"
+    fmriprep_log = f"{fmriprep_out_dir}/{bids_id}/log/fmriprep_out.log"
+    Path(fmriprep_log).parent.mkdir(parents=True, exist_ok=True)
+
     # Singularity CMD 
     SINGULARITY_CMD=f"singularity run \
         -B {bids_dir}:/data_dir \
@@ -71,12 +78,23 @@ def run_fmriprep(participant_id, bids_dir, fmriprep_dir, fs_dir, templateflow_di
     logger.info("-"*50)
     logger.info(f"CMD:\n{CMD}")
     logger.info("-"*50)
+    logger.info(f"fmriprep output is logged in {fmriprep_log}")
+    returncode = None
     try:
-        fmriprep_proc = subprocess.run(CMD)
+        with open(fmriprep_log, "w") as log:
+            if telemetry_dir is None:
+                fmriprep_proc = subprocess.run(CMD, stdout=log, stderr=subprocess.STDOUT)
+                returncode = fmriprep_proc.returncode
+            else:
+                returncode = run_with_telemetry(CMD, "fmriprep", participant_id, session_id, telemetry_dir, logger,
+                                                stdout=log, stderr=subprocess.STDOUT)
     except Exception as e:
         logger.error(f"fmriprep run failed with exceptions: {e}")
-    
-    logger.info(f"Successfully completed fmriprep run for participant: {participant_id}")
+
+    if returncode == 0:
+        logger.info(f"Successfully completed fmriprep run for participant: {participant_id}")
+    elif returncode is not None:
+        logger.error(f"fmriprep run failed for participant: {participant_id} (exit status: {returncode}), see {fmriprep_log}")
     logger.info("-"*75)
     logger.info("")
 
@@ -94,6 +112,7 @@ def run(participant_id, global_configs, session_id, output_dir, use_bids_filter,
     SINGULARITY_FMRIPREP = f"{CONTAINER_STORE}{FMRIPREP_CONTAINER}"
 
     log_dir = f"{DATASET_ROOT}/scratch/logs/"
+    telemetry_dir = get_telemetry_dir(global_configs)
 
     if logger is None:
         log_file = f"{log_dir}/fmriprep.log"
@@ -125,7 +144,8 @@ def run(participant_id, global_configs, session_id, output_dir, use_bids_filter,
         shutil.copyfile(f"{CWD}/bids_filter.json", f"{bids_dir}/bids_filter.json")
 
     # launch fmriprep
-    run_fmriprep(participant_id, bids_dir, fmriprep_dir, fs_dir, TEMPLATEFLOW_DIR, SINGULARITY_FMRIPREP, use_bids_filter, anat_only, logger)
+    run_fmriprep(participant_id, bids_dir, fmriprep_dir, fs_dir, TEMPLATEFLOW_DIR, SINGULARITY_FMRIPREP, use_bids_filter, anat_only, logger,
+                 session_id=session_id, telemetry_dir=telemetry_dir)
 
 if __name__ == '__main__':
     # argparse
@@ -0,0 +1,24 @@
+import fnmatch
+
+from workflow.utils import session_id_to_bids_session
+
+# MRIQC output layout, shared by run_mriqc.py and trackers/mriqc_tracker.py
+#   <mriqc_out_dir>/<bids_id>/mriqc_out_<label>.log (participant log split from the batch log)
+#   <mriqc_out_dir>/<bids_id>/<session>/<datatype>/<bids_id>_<session>_[<entities>_]<suffix>.json (IQMs)
+
+# Globals
+MRIQC_SUCCESS_MSG = "Participant level finished successfully."
+
+def get_participant_log_name(bids_id):
+    """ Name of the per-participant log inside <mriqc_out_dir>/<bids_id>
+    """
+    participant_label = bids_id.split("-")[-1]
+    return f"mriqc_out_{participant_label}.log"
+
+def check_iqm_files(rel_paths, bids_id, session_id, pattern="*"):
+    """ Check if the files of a participant output dir (paths relative to <mriqc_out_dir>/<bids_id>)
+        contain IQM jsons of the session. pattern matches the end of the file name,
+        after <bids_id>_<session>_ and before .json (e.g. "*T1w", "task-rest*_bold")
+    """
+    session = session_id_to_bids_session(session_id)
+    return len(fnmatch.filter(rel_paths, f"{session}/*/{bids_id}_{session}_{pattern}.json")) > 0
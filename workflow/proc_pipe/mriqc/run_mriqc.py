@@ -1,30 +1,235 @@
-import subprocess
+#!/usr/bin/env python
+
 import argparse
-# import json
+import json
+import re
+from pathlib import Path
+
+from joblib import Parallel, delayed
+
+import workflow.logger as my_logger
+from workflow.proc_pipe.mriqc.mriqc_outputs import MRIQC_SUCCESS_MSG, check_iqm_files, get_participant_log_name
+from workflow.telemetry import get_telemetry_dir, run_with_telemetry
+from workflow.utils import (
+    BIDS_SUBJECT_PREFIX,
+    COL_BIDS_ID_MANIFEST,
+    COL_CONV_STATUS,
+    COL_SESSION_MANIFEST,
+    FNAME_STATUS,
+    load_status,
+    session_id_to_bids_session,
+)
+
+# Globals
+MEM_GB = 8 # default memory limit per MRIQC invocation
+
+# env vars relative to the container.
+SINGULARITY_BIDS_DIR = "/data"
+SINGULARITY_OUTPUT_DIR = "/out"
+SINGULARITY_WORK_DIR = "/work"
+
+def get_participant_log(mriqc_out_dir, bids_id):
+    """ Per-participant log file that is parsed by trackers/mriqc_tracker.py
+    """
+    return Path(f"{mriqc_out_dir}/{bids_id}/{get_participant_log_name(bids_id)}")
+
+def check_mriqc_log(log_file):
+    """ Check if a participant log reports a successful MRIQC run
+    """
+    if not Path(log_file).is_file():
+        return False
+    with open(log_file, "r") as f:
+        for line in f:
+            if MRIQC_SUCCESS_MSG in line:
+                return True
+    return False
+
+def check_mriqc_outputs(mriqc_out_dir, bids_id, session_id):
+    """ Check if MRIQC wrote image quality metrics (IQM jsons) for a participant session
+    """
+    participant_dir = Path(mriqc_out_dir, bids_id)
+    rel_paths = [p.relative_to(participant_dir).as_posix() for p in participant_dir.rglob("*.json")]
+    return check_iqm_files(rel_paths, bids_id, session_id)
+
+def get_pending_participants(global_configs, session_id, mriqc_out_dir, logger):
+    """ Identify BIDSified participants without a successful MRIQC run
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    fpath_status = Path(DATASET_ROOT, "scratch", "raw_dicom", FNAME_STATUS)
+    df_status = load_status(fpath_status)
+
+    session = session_id_to_bids_session(session_id)
+    df_status = df_status[df_status[COL_SESSION_MANIFEST] == session]
+    converted = df_status.loc[df_status[COL_CONV_STATUS], COL_BIDS_ID_MANIFEST].dropna().unique()
+
+    pending = [bids_id for bids_id in sorted(converted)
+                if not check_mriqc_log(get_participant_log(mriqc_out_dir, bids_id))]
+
+    logger.info("-"*50)
+    logger.info(
+        "Identifying participants to be processed with MRIQC\n\n"
+        f"- n_converted (listed in the status file): {len(converted)}\n"
+        f"- n_pending: {len(pending)}\n"
+    )
+    logger.info("-"*50)
+
+    return pending
+
+def split_log(batch_log, bids_ids, session_id, mriqc_out_dir):
+    """ Split a batch log into per-participant logs (single pass over the batch log).
+        Lines mentioning a participant go to its log, shared lines go to all logs, except the
+        shared success marker which only goes to the participants with MRIQC outputs.
+    """
+    completed = [bids_id for bids_id in bids_ids if check_mriqc_outputs(mriqc_out_dir, bids_id, session_id)]
+    # avoid matching sub-01 inside sub-010
+    patterns = {bids_id: re.compile(rf"{re.escape(bids_id)}(?![A-Za-z0-9])") for bids_id in bids_ids}
+    log_files = {}
+    for bids_id in bids_ids:
+        label = bids_id.split("-")[-1]
+        log_file = get_participant_log(mriqc_out_dir, bids_id)
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        log_files[bids_id] = open(log_file, "w")
+        log_files[bids_id].write(f"subject: {label} session: {session_id}\n")
+        log_files[bids_id].write(f"batch log: {batch_log}\n")
+
+    try:
+        with open(batch_log, "r", errors="replace") as f:
+            for line in f:
+                matches = [bids_id for bids_id in bids_ids if patterns[bids_id].search(line)]
+                if len(matches) == 0:
+                    matches = completed if MRIQC_SUCCESS_MSG in line else bids_ids
+                for bids_id in matches:
+                    log_files[bids_id].write(line)
+    finally:
+        for f in log_files.values():
+            f.close()
+
+def run_mriqc_batch(batch_idx, bids_ids, global_configs, session_id, mriqc_dir, nprocs, logger, mem_gb=MEM_GB):
+    """ Launch a single MRIQC container for a group of participants
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    SINGULARITY_PATH = global_configs["SINGULARITY_PATH"]
+    CONTAINER_STORE = global_configs["CONTAINER_STORE"]
+    MRIQC_CONTAINER = global_configs["PROC_PIPELINES"]["mriqc"]["CONTAINER"]
+    MRIQC_VERSION = global_configs["PROC_PIPELINES"]["mriqc"]["VERSION"]
+    MRIQC_CONTAINER = MRIQC_CONTAINER.format(MRIQC_VERSION)
+    SINGULARITY_MRIQC = f"{CONTAINER_STORE}/{MRIQC_CONTAINER}"
+
+    bids_dir = f"{DATASET_ROOT}/bids/"
+    mriqc_out_dir = f"{mriqc_dir}/output"
+
+    # one work dir and one pybids index per batch
+    batch_name = f"ses-{session_id}_batch-{batch_idx:03d}"
+    batch_work_dir = f"{mriqc_dir}/work/{batch_name}"
+    Path(batch_work_dir).mkdir(parents=True, exist_ok=True)
+    batch_log = f"{mriqc_dir}/work/{batch_name}.log"
+
+    participant_labels = [bids_id[len(BIDS_SUBJECT_PREFIX):] for bids_id in bids_ids]
+    logger.info(f"Starting MRIQC {batch_name} with {len(bids_ids)} participant(s): {bids_ids}")
+
+    # Singularity CMD
+    SINGULARITY_CMD = f"{SINGULARITY_PATH} run --cleanenv \
+        -B {bids_dir}:{SINGULARITY_BIDS_DIR}:ro \
+        -B {mriqc_out_dir}:{SINGULARITY_OUTPUT_DIR} \
+        -B {batch_work_dir}:{SINGULARITY_WORK_DIR} \
+        {SINGULARITY_MRIQC}"
+
+    # MRIQC CMD
+    MRIQC_CMD = f" {SINGULARITY_BIDS_DIR} {SINGULARITY_OUTPUT_DIR} participant \
+        --participant-label {' '.join(participant_labels)} \
+        --session-id {session_id} \
+        -w {SINGULARITY_WORK_DIR} \
+        --bids-database-dir {SINGULARITY_WORK_DIR}/bids_db \
+        --nprocs {nprocs} --mem_gb {mem_gb} \
+        --no-sub -v"
+
+    CMD = (SINGULARITY_CMD + MRIQC_CMD).split()
+    logger.info(f"CMD:\n{CMD}")
+
+    try:
+        with open(batch_log, "w") as log:
+            returncode = run_with_telemetry(CMD, "mriqc", bids_ids, session_id, get_telemetry_dir(global_configs), logger,
+                                            stdout=log, stderr=log)
+    except Exception as e:
+        logger.error(f"MRIQC {batch_name} failed with exceptions: {e}")
+        returncode = None
+
+    if Path(batch_log).is_file():
+        split_log(batch_log, bids_ids, session_id, mriqc_out_dir)
+
+    batch_results = {bids_id: check_mriqc_log(get_participant_log(mriqc_out_dir, bids_id)) for bids_id in bids_ids}
+    logger.info(f"MRIQC {batch_name} finished (return code: {returncode}), " \
+                f"successful participants: {sum(batch_results.values())}/{len(bids_ids)}")
+
+    return batch_results
+
+def run(global_configs, session_id, output_dir=None, logger=None, participant_id=None, batch_size=4, n_jobs=2, nprocs=8, mem_gb=MEM_GB):
+    """ Runs MRIQC on all pending participants in groups of batch_size participants
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    MRIQC_VERSION = global_configs["PROC_PIPELINES"]["mriqc"]["VERSION"]
+    log_dir = f"{DATASET_ROOT}/scratch/logs/"
+
+    if logger is None:
+        log_file = f"{log_dir}/mriqc.log"
+        logger = my_logger.get_logger(log_file)
+
+    if output_dir is None:
+        output_dir = f"{DATASET_ROOT}/derivatives/"
+
+    mriqc_dir = f"{output_dir}/mriqc/v{MRIQC_VERSION}"
+    mriqc_out_dir = f"{mriqc_dir}/output"
+    Path(mriqc_out_dir).mkdir(parents=True, exist_ok=True)
+
+    logger.info("-"*50)
+    logger.info(f"Using DATASET_ROOT: {DATASET_ROOT}")
+    logger.info(f"session: {session_id}, batch_size: {batch_size}, n_jobs: {n_jobs}, nprocs: {nprocs}, mem_gb: {mem_gb}")
+
+    if participant_id is not None:
+        logger.info(f"Only running for participant: {participant_id}")
+        pending = [participant_id]
+    else:
+        pending = get_pending_participants(global_configs, session_id, mriqc_out_dir, logger)
 
-parser = argparse.ArgumentParser(description='')
+    n_pending = len(pending)
+    if n_pending > 0:
+        batches = [pending[i:i+batch_size] for i in range(0, n_pending, batch_size)]
+        logger.info(f"\nStarting MRIQC for {n_pending} participant(s) in {len(batches)} batch(es)")
 
-parser.add_argument('--global_config', type=str, help='path to global configs for a given mr_proc dataset')
-parser.add_argument('--output_dir', type=str, help='overwrite path to put results in case of issues with default')
-parser.add_argument('--participant_id', type=str, help='subject ID to be processed')
-parser.add_argument('--session_id', type=str, help='session ID to be processed')
+        # the heavy lifting happens in the containers, so threads are enough to supervise them
+        batch_results = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(run_mriqc_batch)(
+            batch_idx, bids_ids, global_configs, session_id, mriqc_dir, nprocs, logger, mem_gb
+            ) for batch_idx, bids_ids in enumerate(batches))
 
-args = parser.parse_args()
+        n_success = sum([sum(br.values()) for br in batch_results])
+        logger.info(f"Successfully ran MRIQC for {n_success} out of {n_pending} participants")
+    else:
+        logger.info(f"No new participants found for MRIQC...")
 
-DATASET_ROOT = args.global_config["DATASET_ROOT"]
-CONTAINER_STORE = args.global_config["CONTAINER_STORE"]
-#is currently mriqc_patch.simg
-MRIQC_CONTAINER = args.global_config["PROC_PIPELINES"]["mriqc"]["CONTAINER"]
+    logger.info("-"*50)
+    logger.info("")
 
-# config = json.load(open(args.global_config))
+if __name__ == '__main__':
+    # argparse
+    HELPTEXT = """
+    Script to run MRIQC on all pending participants (in batches of participants per container)
+    """
+    parser = argparse.ArgumentParser(description=HELPTEXT)
 
-output_dir = args.output_dir
-participant_id = args.participant_id
-session_id = args.session_id
+    parser.add_argument('--global_config', type=str, help='path to global configs for a given mr_proc dataset', required=True)
+    parser.add_argument('--session_id', type=str, help='session ID to be processed', required=True)
+    parser.add_argument('--participant_id', type=str, default=None, help='single bids_id (sub-<label>) to run (default: all pending participants)')
+    parser.add_argument('--output_dir', type=str, default=None, help='specify custom output dir (if None --> <DATASET_ROOT>/derivatives)')
+    parser.add_argument('--batch_size', type=int, default=4, help='number of participants per MRIQC invocation (default: 4)')
+    parser.add_argument('--n_jobs', type=int, default=2, help='number of MRIQC invocations running concurrently (default: 2)')
+    parser.add_argument('--nprocs', type=int, default=8, help='number of processes per MRIQC invocation (default: 8)')
+    parser.add_argument('--mem_gb', type=int, default=MEM_GB, help=f'memory limit (GB) per MRIQC invocation (default: {MEM_GB})')
 
-subprocess.run([f"echo subject: {participant_id} session: {session_id} >> {output_dir}/mriqc_out_{participant_id}.log"], shell=True)
+    args = parser.parse_args()
 
-subprocess.run([f"singularity run --cleanenv -B {DATASET_ROOT}:/data:ro -B {output_dir}:/out --no-sub /data /out \
-                {CONTAINER_STORE}/{MRIQC_CONTAINER} participant --participant-label {participant_id} --session-id {session_id} \
-                >> {output_dir}/mriqc_out_{participant_id}.log"], shell=True)
+    # Read global configs
+    with open(args.global_config, 'r') as f:
+        global_configs = json.load(f)
 
+    run(global_configs, args.session_id, output_dir=args.output_dir, participant_id=args.participant_id,
+        batch_size=args.batch_size, n_jobs=args.n_jobs, nprocs=args.nprocs, mem_gb=args.mem_gb)
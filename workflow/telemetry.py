@@ -0,0 +1,271 @@
+import datetime
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+# Telemetry records are written as:
+# <telemetry_dir>/<pipeline>/<participant_id>_ses-<session_id>_<timestamp>.json
+
+# Globals
+SAMPLING_INTERVAL = 1.0 # seconds between /proc samples of the child process tree
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S_%f" # with microseconds, so back-to-back runs never share a record file
+PROC_DIR = "/proc"
+CGROUP_ROOT = "/sys/fs/cgroup"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+def get_telemetry_dir(global_configs):
+    """ Default location of the telemetry records for a dataset
+    """
+    DATASET_ROOT = global_configs["DATASET_ROOT"]
+    return f"{DATASET_ROOT}/scratch/logs/telemetry"
+
+def get_ppid_map():
+    """ Map every visible pid to its parent pid (single pass over /proc)
+    """
+    ppid_map = {}
+    for entry in os.scandir(PROC_DIR):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"{entry.path}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm (2nd field) can contain spaces, so split after the closing parenthesis
+        fields = stat[stat.rfind(b")") + 2:].split()
+        ppid_map[int(entry.name)] = int(fields[1])
+    return ppid_map
+
+def get_process_tree(root_pid):
+    """ Return root_pid and all of its (currently alive) descendants
+    """
+    children = {}
+    for pid, ppid in get_ppid_map().items():
+        children.setdefault(ppid, []).append(pid)
+
+    tree = []
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+def read_proc_stats(pid):
+    """ Read rss, cpu time and io bytes of a single process from /proc
+    """
+    stats = {"rss": 0, "cpu_time": 0.0, "read_bytes": 0, "write_bytes": 0}
+    try:
+        with open(f"{PROC_DIR}/{pid}/stat", "rb") as f:
+            stat = f.read()
+        fields = stat[stat.rfind(b")") + 2:].split()
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat (11 and 12 after comm)
+        stats["cpu_time"] = (int(fields[11]) + int(fields[12])) / CLK_TCK
+        with open(f"{PROC_DIR}/{pid}/statm", "rb") as f:
+            stats["rss"] = int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+    # io accounting is not readable for setuid processes (e.g. singularity starter)
+    try:
+        with open(f"{PROC_DIR}/{pid}/io", "r") as f:
+            for line in f:
+                k, v = line.split(":")
+                if k in ["read_bytes", "write_bytes"]:
+                    stats[k] = int(v)
+    except (OSError, ValueError):
+        pass
+
+    return stats
+
+def get_cgroup(pid):
+    """ Return the cgroup v2 path of a process (None if unavailable)
+    """
+    try:
+        with open(f"{PROC_DIR}/{pid}/cgroup", "r") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return line.strip()[3:]
+    except OSError:
+        pass
+    return None
+
+def read_cgroup_stats(cgroup):
+    """ Read peak memory and io bytes of a (dedicated) cgroup v2
+    """
+    cgroup_dir = f"{CGROUP_ROOT}{cgroup}"
+    stats = {}
+    try:
+        with open(f"{cgroup_dir}/memory.peak", "r") as f:
+            stats["peak_rss"] = int(f.read())
+    except (OSError, ValueError):
+        pass
+    try:
+        read_bytes, write_bytes = 0, 0
+        with open(f"{cgroup_dir}/io.stat", "r") as f:
+            for line in f:
+                for kv in line.split()[1:]:
+                    k, v = kv.split("=")
+                    if k == "rbytes":
+                        read_bytes += int(v)
+                    elif k == "wbytes":
+                        write_bytes += int(v)
+        stats["read_bytes"] = read_bytes
+        stats["write_bytes"] = write_bytes
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+class TreeSampler(threading.Thread):
+    """ Periodically sample rss / cpu / io of a process tree until stopped
+    """
+    def __init__(self, root_pid, interval=SAMPLING_INTERVAL):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.parent_cgroup = get_cgroup(os.getpid())
+        self.cgroup = None
+        self.peak_rss = 0
+        self.pids_seen = set()
+        # last known counters of every process (kept after the process exits)
+        self.last_stats = {}
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        tree_rss = 0
+        for pid in get_process_tree(self.root_pid):
+            stats = read_proc_stats(pid)
+            if stats is None:
+                continue
+            self.pids_seen.add(pid)
+            self.last_stats[pid] = stats
+            tree_rss += stats["rss"]
+
+            # containers launched with their own cgroup give exact peak memory and io
+            if self.cgroup is None:
+                cgroup = get_cgroup(pid)
+                if cgroup is not None and cgroup != self.parent_cgroup:
+                    self.cgroup = cgroup
+
+        self.peak_rss = max(self.peak_rss, tree_rss)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def get_totals(self):
+        totals = {"cpu_time": 0.0, "read_bytes": 0, "write_bytes": 0}
+        for stats in self.last_stats.values():
+            for k in totals.keys():
+                totals[k] += stats[k]
+        return totals
+
+
+def write_telemetry_record(record, telemetry_dir, pipeline, participant_id, session_id):
+    """ Save a telemetry record as json (one file per participant and run)
+    """
+    timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+    record_dir = Path(f"{telemetry_dir}/{pipeline}")
+    record_dir.mkdir(parents=True, exist_ok=True)
+    record_file = record_dir / f"{participant_id}_ses-{session_id}_{timestamp}.json"
+
+    record = dict(record, participant_id=participant_id)
+    with open(record_file, "w") as outfile:
+        json.dump(record, outfile, indent=4)
+
+    return record_file
+
+def run_with_telemetry(CMD, pipeline, participant_ids, session_id, telemetry_dir, logger=None,
+                        check=False, interval=SAMPLING_INTERVAL, **popen_kwargs):
+    """ Launch a (container) command and record wall time, cpu time, peak rss and io bytes
+        of its process tree. Writes one json record per participant and returns the exit code.
+    """
+    if isinstance(participant_ids, str):
+        participant_ids = [participant_ids]
+
+    start_time = datetime.datetime.now()
+    start = time.monotonic()
+    proc = subprocess.Popen(CMD, **popen_kwargs)
+
+    sampler = TreeSampler(proc.pid, interval)
+    sampler.start()
+
+    # wait4 gives exact rusage of the child and all of its reaped descendants
+    _, wait_status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+
+    wall_time = time.monotonic() - start
+    sampler.stop()
+    end_time = datetime.datetime.now()
+
+    sampled = sampler.get_totals()
+    cgroup_stats = read_cgroup_stats(sampler.cgroup) if sampler.cgroup is not None else {}
+
+    # ru_maxrss is in KB on linux and only covers the largest single process
+    peak_rss = cgroup_stats.get("peak_rss", max(sampler.peak_rss, rusage.ru_maxrss * 1024))
+    read_bytes = cgroup_stats.get("read_bytes", max(sampled["read_bytes"], rusage.ru_inblock * 512))
+    write_bytes = cgroup_stats.get("write_bytes", max(sampled["write_bytes"], rusage.ru_oublock * 512))
+
+    record = {
+        "pipeline": pipeline,
+        "session_id": session_id,
+        "batch_participant_ids": participant_ids,
+        "hostname": socket.gethostname(),
+        "cmd": CMD if isinstance(CMD, str) else " ".join(CMD),
+        "returncode": proc.returncode,
+        "start_time": start_time.isoformat(),
+        "end_time": end_time.isoformat(),
+        "wall_time_s": round(wall_time, 3),
+        "cpu_user_s": round(rusage.ru_utime, 3),
+        "cpu_system_s": round(rusage.ru_stime, 3),
+        "cpu_time_s": round(max(rusage.ru_utime + rusage.ru_stime, sampled["cpu_time"]), 3),
+        "peak_rss_mb": round(peak_rss / 1024**2, 1),
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+        "n_processes": len(sampler.pids_seen),
+        "cgroup": sampler.cgroup,
+        "sampling_interval_s": interval,
+    }
+
+    for participant_id in participant_ids:
+        record_file = write_telemetry_record(record, telemetry_dir, pipeline, participant_id, session_id)
+
+    if logger is not None:
+        logger.info(f"{pipeline} telemetry: wall_time={record['wall_time_s']}s, cpu_time={record['cpu_time_s']}s, " \
+                    f"peak_rss={record['peak_rss_mb']}MB, read={read_bytes}B, write={write_bytes}B")
+        logger.info(f"Saved telemetry record(s) in {Path(record_file).parent}")
+
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, CMD)
+
+    return proc.returncode
+
+def summarize_telemetry(telemetry_dir, pipeline):
+    """ Median wall time / cpu time / peak rss of the recorded runs of a pipeline
+        (records of multi-participant runs are counted once)
+    """
+    records = {}
+    for record_file in Path(f"{telemetry_dir}/{pipeline}").glob("*.json"):
+        try:
+            with open(record_file, "r") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        records[(record["start_time"], record["cmd"])] = record
+
+    summary = {"n_runs": len(records)}
+    for k in ["wall_time_s", "cpu_time_s", "peak_rss_mb"]:
+        values = sorted([record[k] for record in records.values()])
+        summary[k] = values[len(values) // 2] if len(values) > 0 else None
+    return summary